@@ -6,6 +6,7 @@ django.setup()
 
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
+from main.media import MediaApplication
 from main.middleware import JWTAuthMiddleware
 import main.routing
 
@@ -13,7 +14,7 @@ import main.routing
 django_asgi_application = get_asgi_application()
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": MediaApplication(django_asgi_application),   # MEDIA_URL is served before reaching Django
     "websocket": JWTAuthMiddleware(
         URLRouter(main.routing.websocket_urlpatterns)
     ),
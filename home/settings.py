@@ -3,6 +3,7 @@ from pathlib import Path
 from datetime import timedelta
 import os
 from dotenv import load_dotenv
+from django.core.exceptions import ImproperlyConfigured
 
 load_dotenv()
 
@@ -81,11 +82,79 @@ TEMPLATES = [
 
 ASGI_APPLICATION = 'home.asgi.application'
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-    },
-}
+# Channel layer selected by CHANNEL_LAYER_URL (falls back to REDIS_URL):
+#   redis://host:6379/0      Redis pub/sub, for several hosts (needs channels_redis)
+#   unix:///run/chat-layer   local datagram sockets in that directory, for several workers on one host
+#   unset                    in-memory, single process only
+CHANNEL_LAYER_URL = os.environ.get("CHANNEL_LAYER_URL", os.environ.get("REDIS_URL", ""))
+
+if CHANNEL_LAYER_URL.startswith(("redis://", "rediss://")):
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
+            "CONFIG": {"hosts": [CHANNEL_LAYER_URL]},
+        },
+    }
+elif CHANNEL_LAYER_URL.startswith("unix://"):
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "main.layers.LocalSocketChannelLayer",
+            "CONFIG": {"path": CHANNEL_LAYER_URL[len("unix://"):]},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+
+# Cache of rooms, presence, the delivery log and rate limits, selected by CACHE_URL:
+#   redis://host:6379/1   shared by every worker and host (needs redis)
+#   file:///var/chat-cache  files shared by the workers of one host
+#   unset                 memory of each process. The delivery log keeps CHAT_DELIVERY_LOG_SIZE + 2
+#                         entries per room and user group, CACHE_MAX_ENTRIES bounds them all
+# Several workers need a shared cache: a membership change must reach the room cache of every
+# worker. The cache defaults to the same Redis as a Redis channel layer, and to files next to
+# the sockets of the local socket layer; a Redis layer serves several hosts and needs Redis.
+CACHE_URL = os.environ.get("CACHE_URL", "")
+if not CACHE_URL and CHANNEL_LAYER_URL.startswith(("redis://", "rediss://")):
+    CACHE_URL = CHANNEL_LAYER_URL
+elif not CACHE_URL and CHANNEL_LAYER_URL.startswith("unix://"):
+    CACHE_URL = "file://" + CHANNEL_LAYER_URL[len("unix://"):].rstrip("/") + "-cache"
+
+if CHANNEL_LAYER_URL.startswith(("redis://", "rediss://")) and not CACHE_URL.startswith(("redis://", "rediss://")):
+    raise ImproperlyConfigured(
+        "A Redis CHANNEL_LAYER_URL serves several hosts, set CACHE_URL to a Redis URL they share: "
+        "room membership, presence, the delivery log and rate limits live in the cache"
+    )
+if CHANNEL_LAYER_URL and not CACHE_URL.startswith(("redis://", "rediss://", "file://")):
+    raise ImproperlyConfigured(
+        "CHANNEL_LAYER_URL serves several workers, set CACHE_URL to a cache they share (redis:// or file://)"
+    )
+
+if CACHE_URL.startswith(("redis://", "rediss://")):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_URL,
+        },
+    }
+elif CACHE_URL.startswith("file://"):
+    CACHES = {
+        "default": {
+            "BACKEND": "main.filecache.LocalFileCache",
+            "LOCATION": CACHE_URL[len("file://"):],
+            "OPTIONS": {"MAX_ENTRIES": int(os.environ.get("CACHE_MAX_ENTRIES", 200000))},
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "OPTIONS": {"MAX_ENTRIES": int(os.environ.get("CACHE_MAX_ENTRIES", 200000))},
+        },
+    }
 
 db_url = os.environ.get("DATABASE_URL", os.environ.get("MYSQL_URL"))
 
@@ -136,6 +205,10 @@ REST_FRAMEWORK = {
         'rest_framework.throttling.UserRateThrottle',
         'rest_framework.throttling.AnonRateThrottle',
     ], 
+    'DEFAULT_THROTTLE_RATES': {
+        'user': '5000/hour',    # message sends have their own budgets, see CHAT_SEND_BUDGETS
+        'anon': '100/minute',
+    },
 }
 
 AUTHENTICATION_BACKENDS = [
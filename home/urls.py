@@ -2,8 +2,8 @@ from django.contrib import admin
 from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
-from django.views.static import serve # Import serve
 from main import views
+from main.media import media_view
 
 
 urlpatterns = [
@@ -11,7 +11,6 @@ urlpatterns = [
     path( "", views.login_page, name="login_page"),
 
     path('api/', include('main.urls')),
-    re_path(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT}),
+    re_path(r'^media/(?P<path>.*)$', media_view),   # WSGI fallback, ASGI requests are answered by MediaApplication
 ]
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -11,12 +11,11 @@ class ProfileAdmin(admin.ModelAdmin):
     list_editable = ["verified"]
 
 class ChatMessageAdmin(admin.ModelAdmin):
-    list_display = ["id", "sender", "read_by", "message"]
-    list_editable = ["read_by"]
+    list_display = ["id", "sender", "message"]
 
 class MessageInline(admin.TabularInline):
     model = Message
-    fields = ["sender", "short_message", "read_by", "created_at"]
+    fields = ["sender", "short_message", "created_at"]
     readonly_fields = ["short_message", "created_at"]
     extra = 0
 
@@ -0,0 +1,24 @@
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def cache_is_local():
+    """
+    True when the default cache lives in this process's memory and calls to it never wait
+    """
+    return isinstance(caches["default"], LocMemCache)
+
+
+async def cache_io(func, *args, **kwargs):
+    """
+    Run a function doing cache calls from async code. The in-process memory cache is called
+    inline; Redis and the file cache wait on I/O, so the function runs in a worker thread and
+    the event loop keeps serving other sockets. Functions passed here batch their calls
+    (get_many / set_many) so one thread hop covers them all. Django's own async cache methods
+    are not used: they run on the single thread shared with database_sync_to_async and make
+    one hop per key.
+    """
+    if cache_is_local():
+        return func(*args, **kwargs)
+    return await sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
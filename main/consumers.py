@@ -1,11 +1,121 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import Counter, deque
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 import json
-from .models import ChatRoom, Message, User
+import msgpack
+from .models import ChatRoomMember, Message
+from .ingest import ingest_message
+from .signals import (
+    chat_message_event, dump_frame, encode_chat_frames, message_frame, message_payload, notification_frame, room_group_name
+)
+from .cache_io import cache_io
+from .room_cache import cached_room_info, get_room_info
+from .layers import remember_server_loop
+from .delivery import current_cursor, missed_events, parse_cursor, record_event, start_log
+from .ratelimit import SOCKET_FRAME_BUDGET, TokenBucket, acheck_send
+from .presence import (
+    HEARTBEAT_INTERVAL, PRESENCE_TTL, get_presence_fanout, user_connected, user_disconnected, user_heartbeat
+)
+
+logger = logging.getLogger(__name__)
+
+CLIENT_ID_MAX_LENGTH = Message._meta.get_field("client_id").max_length
+
+TYPING_TTL = getattr(settings, "CHAT_TYPING_TTL", 6)            # seconds clients show an indicator that is not refreshed
+TYPING_REFRESH = getattr(settings, "CHAT_TYPING_REFRESH", 3)    # at most one typing event per user and room in this window
+
+SEND_TICK = getattr(settings, "CHAT_SOCKET_SEND_TICK", 0.01)        # seconds outbound frames are held to go out together
+SEND_BATCH_SIZE = getattr(settings, "CHAT_SOCKET_SEND_BATCH", 50)   # most frames in one "batch" frame
+FRAME_FORMATS = ("json", "msgpack")
+
+# Outbound queue of a socket. Frames are sent as they come while the socket is idle and only
+# queue behind a send still in flight, within a batch tick, or while the client is not reading;
+# these limits bound that queue. Daphne's send never waits for the client, it appends to the
+# Twisted transport's buffer: the consumer registers as the transport's producer and stops
+# sending while that buffer is over its size (64 KiB), until the client has drained it. A slow
+# client thus costs at most one transport buffer plus these limits.
+QUEUE_MAX_FRAMES = getattr(settings, "CHAT_SOCKET_QUEUE_FRAMES", 500)
+QUEUE_MAX_BYTES = getattr(settings, "CHAT_SOCKET_QUEUE_BYTES", 1024 * 1024)
+SLOW_CONSUMER_POLICY = getattr(settings, "CHAT_SLOW_CONSUMER_POLICY", "drop_notifications")   # or "resync", "disconnect"
+SLOW_CONSUMER_CLOSE_CODE = 4013     # "try again later" (1013) in the application range, Daphne refuses 1001-2999
+DROPPABLE_FRAMES = ("notification", "typing", "presence")   # lost without harm: the next message or change supersedes them
+
+FRAME_BUCKET = TokenBucket(*SOCKET_FRAME_BUDGET)
+PUSHED_IDS = 100    # message ids a socket remembers having pushed to its room
+
+_sockets = weakref.WeakSet()
+slow_consumer_events = Counter()    # policy actions taken by this process
+
+
+def socket_metrics():
+    """
+    Outbound queue figures of the sockets served by this process
+    """
+    sockets = list(_sockets)
+    depths = [(len(consumer.outbox), consumer.outbox_bytes) for consumer in sockets]
+    return {
+        "sockets": len(depths),
+        "not_reading": sum(consumer.transport_full for consumer in sockets),   # send buffer full
+        "queued_frames": sum(frames for frames, _ in depths),
+        "queued_bytes": sum(size for _, size in depths),
+        "max_queue_frames": max((frames for frames, _ in depths), default=0),
+        "max_queue_bytes": max((size for _, size in depths), default=0),
+        "limits": {"frames": QUEUE_MAX_FRAMES, "bytes": QUEUE_MAX_BYTES, "policy": SLOW_CONSUMER_POLICY},
+        "events": dict(slow_consumer_events),
+    }
+
+
+def msgpack_batch(frames):
+    """
+    {"type": "batch", "frames": [...]} around already packed frames
+    """
+    packer = msgpack.Packer()
+    return (packer.pack_map_header(2) + packer.pack("type") + packer.pack("batch")
+            + packer.pack("frames") + packer.pack_array_header(len(frames)) + b"".join(frames))
+
+
+class SendBufferWatch:
+    """
+    Streaming producer of a Daphne socket's transport (see UserConsumer.watch_send_buffer),
+    called from the reactor, which runs on the event loop. Calls are passed on to the producer
+    it replaced.
+    """
+
+    def __init__(self, consumer, previous=None):
+        self.consumer = consumer
+        self.previous = previous
+
+    def pauseProducing(self):
+        self.consumer.transport_full = True
+        if self.previous is not None:
+            self.previous.pauseProducing()
+
+    def resumeProducing(self):
+        self.consumer.transport_full = False
+        if self.previous is not None:
+            self.previous.resumeProducing()
+        if self.consumer.outbox:
+            self.consumer.schedule_flush()
+
+    def stopProducing(self):
+        if self.previous is not None:
+            self.previous.stopProducing()   # disconnect() follows
+
 
 class UserConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
+        remember_server_loop()  # background threads deliver their events through this loop
+
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.setup_outbound(query)
 
         if not self.user.is_authenticated:
             await self.close()
@@ -19,22 +129,335 @@ class UserConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
+        # Join one group per room so a message is dispatched once per room, not once per member
+        self.room_group_names = set()
+        for room_id in await self.get_room_ids():
+            await self.join_room(room_id)
+        await cache_io(start_log, [self.user_group_name, *self.room_group_names])
+
         await self.accept()
         print(f"WebSocket connected for {self.user.username}")
+        _sockets.add(self)
+        self.watch_send_buffer()
+
+        self.typing_sent = {}   # room_id -> time of the last typing event sent for this socket
+        self.frame_state = None     # (tokens, time) of the inbound frame bucket
+        self.frame_throttled = False
+        self.pushed = deque(maxlen=PUSHED_IDS)
+        self.last_frame = self.last_heartbeat = time.monotonic()
+        if user_connected(self.user.id):
+            get_presence_fanout().mark(self.user.id)
+        self.watchdog = asyncio.create_task(self.watch_heartbeat())
+
+        since = query.get("since")
+        if since:
+            await self.resume(since[0])
 
     async def disconnect(self, close_code):
 
+        if getattr(self, "outbox", None) is not None:
+            if self.flusher is not None:
+                self.flusher.cancel()   # the socket is gone, queued frames cannot be delivered
+            _sockets.discard(self)
+
+        if hasattr(self, "watchdog"):   # counted in presence
+            self.watchdog.cancel()
+            if user_disconnected(self.user.id):
+                get_presence_fanout().mark(self.user.id)
+
+        for room_id in list(getattr(self, "typing_sent", ())):
+            await self.set_typing({"room_id": room_id, "typing": False})
+
         if hasattr(self, "user_group_name"): # Check if user_group_name attribute exists before discarding group
             await self.channel_layer.group_discard(
                 self.user_group_name,
                 self.channel_name
             )
 
-    async def receive(self, text_data):
+        for group_name in getattr(self, "room_group_names", ()):
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+
+    async def resume(self, cursor):
+        """
+        Catch up a reconnecting client ("?since=<last seq>"): the events it missed, and the
+        overlap before its cursor, are replayed through the usual handlers into one "replay"
+        frame. When they are no longer all in the delivery log the client gets a "resync" frame
+        and reloads through the HTTP API.
+        """
+        groups = [self.user_group_name, *self.room_group_names]
+        events = await cache_io(missed_events, groups, cursor)
+        if events is None:
+            await self.send_frame({"type": "resync", "seq": await cache_io(current_cursor)})
+            return
+
+        self.replay_frames = []
+        try:
+            for event in events:
+                await self.dispatch(event)
+        finally:
+            frames, self.replay_frames = self.replay_frames, None
+        newest = events[-1]["seq"] if events else cursor
+        await self.send_frame({
+            "type": "replay",
+            "seq": newest if parse_cursor(newest)[1] > parse_cursor(cursor)[1] else cursor,   # overlap only: unchanged
+            "frames": frames,
+        })
+
+    async def dispatch(self, message):
+        self.event_seq = message.get("seq")     # delivery sequence of a logged group event
+        if self.event_seq and getattr(self, "replay_frames", None) is None:
+            self.latest_seq = self.event_seq    # what a resync resumes from, without a cache read
+        try:
+            await super().dispatch(message)
+        finally:
+            self.event_seq = None
+
+    def setup_outbound(self, query):
+        """
+        Outbound framing is negotiated in the URL: ?format=msgpack sends binary frames,
+        ?batch=1 lets frames queued within SEND_TICK go out as one "batch" frame
+        """
+        self.frame_format = query.get("format", ["json"])[0]
+        if self.frame_format not in FRAME_FORMATS:
+            self.frame_format = "json"
+        self.batch_frames = query.get("batch", ["0"])[0] == "1" and SEND_TICK > 0
+
+        self.outbox = deque()   # (encoded frame, frame type)
+        self.outbox_bytes = 0
+        self.resync_pending = False
+        self.latest_seq = None
+        self.closing = False
+        self.sending = False    # a send of this socket is in flight, new frames queue behind it
+        self.transport_full = False     # the server's send buffer is full, the client is not reading
+        self.flusher = None
+
+    async def send_frame(self, frame):
+        """
+        Send a frame produced by a logged event, tagged with its sequence number; collected
+        instead while replaying
+        """
+        if getattr(self, "event_seq", None):
+            frame["seq"] = self.event_seq
+        if getattr(self, "replay_frames", None) is not None:
+            self.replay_frames.append(frame)
+        else:
+            await self.push_frame(self.encode(frame), frame.get("type"))
+
+    def encode(self, frame):
+        return msgpack.packb(frame) if self.frame_format == "msgpack" else dump_frame(frame)
+
+    async def push_frame(self, data, frame_type=None):
+        """
+        Send an encoded frame right away when nothing is queued or in flight, otherwise queue it
+        """
+        if self.sending or self.transport_full or self.outbox or self.batch_frames or self.resync_pending or self.closing:
+            self.queue_frame(data, frame_type)
+            return
+
+        self.sending = True
+        try:
+            if self.frame_format == "msgpack":
+                await self.send(bytes_data=data)
+            else:
+                await self.send(text_data=data)
+            if self.outbox:
+                await self.drain()      # frames queued by other tasks while the send was pending
+        finally:
+            self.sending = False
+
+    def queue_frame(self, data, frame_type=None):
+        """
+        Queue an encoded frame; the send in flight drains the queue, otherwise a flush is scheduled.
+        When the queue is over its limits the slow consumer policy decides what is kept.
+        """
+        if self.resync_pending or self.closing:
+            slow_consumer_events["dropped_frames"] += 1   # the client reloads everything anyway
+            return
+        if len(self.outbox) >= QUEUE_MAX_FRAMES or self.outbox_bytes + len(data) > QUEUE_MAX_BYTES:
+            if not self.relieve_backpressure(data, frame_type):
+                return
+        self.outbox.append((data, frame_type))
+        self.outbox_bytes += len(data)
+        self.schedule_flush()
+
+    def relieve_backpressure(self, data, frame_type):
+        """
+        Apply SLOW_CONSUMER_POLICY to a full queue, True when the new frame can be queued.
+        "drop_notifications" drops notification-like frames, the new one or queued ones, and
+        falls back to "resync" when that is not enough; "resync" replaces the queue with a
+        resync frame, the client reloads through the HTTP API; "disconnect" closes the socket.
+        """
+        policy = SLOW_CONSUMER_POLICY
+        if policy == "drop_notifications":
+            if frame_type in DROPPABLE_FRAMES:
+                slow_consumer_events["dropped_frames"] += 1
+                return False
+            kept = deque(item for item in self.outbox if item[1] not in DROPPABLE_FRAMES)
+            slow_consumer_events["dropped_frames"] += len(self.outbox) - len(kept)
+            self.outbox = kept
+            self.outbox_bytes = sum(len(item[0]) for item in kept)
+            if len(self.outbox) < QUEUE_MAX_FRAMES and self.outbox_bytes + len(data) <= QUEUE_MAX_BYTES:
+                return True
+            policy = "resync"
+
+        slow_consumer_events["dropped_frames"] += len(self.outbox) + 1
+        self.outbox.clear()
+        self.outbox_bytes = 0
+
+        if policy == "disconnect":
+            slow_consumer_events["disconnects"] += 1
+            self.closing = True
+            logger.warning("Closing socket of user %s: outbound queue full", self.user.id)
+            asyncio.ensure_future(self.close(code=SLOW_CONSUMER_CLOSE_CODE))
+            return False
+
+        slow_consumer_events["resyncs"] += 1
+        logger.warning("Socket of user %s too slow, asking it to resync", self.user.id)
+        resync = self.encode({"type": "resync", "seq": self.latest_seq or current_cursor()})
+        self.outbox.append((resync, "resync"))
+        self.outbox_bytes = len(resync)
+        self.resync_pending = True
+        self.schedule_flush()
+        return False
+
+    def watch_send_buffer(self):
+        """
+        Register as the streaming producer of the socket's transport when the server is Daphne
+        (its send is partial(server.handle_reply, protocol)): Twisted pauses the producer when the
+        transport's buffer is full and resumes it once the client has read everything. The
+        producer left by the HTTP request that was upgraded is kept behind ours.
+        """
+        send_args = getattr(self.base_send, "args", ())
+        transport = getattr(send_args[0], "transport", None) if send_args else None
+        if not hasattr(transport, "registerProducer"):
+            return
+        previous = getattr(transport, "producer", None)
+        if previous is not None:
+            transport.unregisterProducer()
+        transport.registerProducer(SendBufferWatch(self, previous), True)
+
+    def take_frames(self, count):
+        frames = [self.outbox.popleft() for _ in range(min(count, len(self.outbox)))]
+        self.outbox_bytes -= sum(len(data) for data, _ in frames)
+        return frames
+
+    def schedule_flush(self):
+        if not self.sending and not self.transport_full and (self.flusher is None or self.flusher.done()):
+            self.flusher = asyncio.get_running_loop().create_task(self.flush_outbox())
+
+    async def flush_outbox(self):
+        """
+        Send what was queued while no send was in flight: frames of a batch tick, a resync
+        """
+        if self.batch_frames:
+            await asyncio.sleep(SEND_TICK)
+        if self.sending:
+            return
+        self.sending = True
+        try:
+            await self.drain()
+        finally:
+            self.sending = False
+
+    async def drain(self):
+        """
+        Send queued frames until the queue is empty or the client stops reading, batched when
+        the client negotiated it
+        """
+        while self.outbox and not self.transport_full:
+            frames = self.take_frames(SEND_BATCH_SIZE if self.batch_frames else 1)
+            await self.send_encoded([data for data, _ in frames])
+            if any(frame_type == "resync" for _, frame_type in frames):
+                self.resync_pending = False
+
+    async def send_encoded(self, frames):
+        """
+        Send encoded frames: alone when there is one, otherwise spliced into one "batch" frame
+        """
+        if not frames:
+            return
+        if self.frame_format == "msgpack":
+            await self.send(bytes_data=frames[0] if len(frames) == 1 else msgpack_batch(frames))
+        else:
+            await self.send(text_data=frames[0] if len(frames) == 1 else '{"type":"batch","frames":[' + ",".join(frames) + "]}")
+
+    async def close(self, code=None, reason=None):
+        if getattr(self, "outbox", None) is not None:
+            if self.flusher is not None:
+                self.flusher.cancel()
+            while self.outbox:
+                await self.send_encoded([data for data, _ in self.take_frames(SEND_BATCH_SIZE if self.batch_frames else 1)])
+        await super().close(code, reason)
+
+    async def watch_heartbeat(self):
+        """
+        Close a socket that has been silent for PRESENCE_TTL (half-open connection), so its
+        disconnect updates presence instead of leaving the user online
+        """
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            if time.monotonic() - self.last_frame > PRESENCE_TTL:
+                await self.close()
+                return
+
+    def heartbeat(self):
+        """
+        Any frame from the client proves the socket alive; the shared state is refreshed at most
+        twice per heartbeat interval
+        """
+        self.last_frame = time.monotonic()
+        if self.last_frame - self.last_heartbeat >= HEARTBEAT_INTERVAL / 2:
+            self.last_heartbeat = self.last_frame
+            if user_heartbeat(self.user.id):
+                get_presence_fanout().mark(self.user.id)
+
+    async def join_room(self, room_id):
+        group_name = room_group_name(room_id)
+        self.room_group_names.add(group_name)
+        await self.channel_layer.group_add(group_name, self.channel_name)
+
+    async def room_join(self, event):
+        """
+        User was added to a room while connected
         """
-        Receive a message from frontend and broadcast to room members
+        await self.join_room(event["room_id"])
+        await cache_io(start_log, [room_group_name(event["room_id"])])
+
+    async def room_leave(self, event):
         """
-        data = json.loads(text_data) # Parse JSON data from frontend 
+        User was removed from a room while connected
+        """
+        group_name = room_group_name(event["room_id"])
+        self.room_group_names.discard(group_name)
+        await self.channel_layer.group_discard(group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Receive a frame from frontend:
+        {"type": "send", "room_id", "message", "client_id"} stores and broadcasts a new message,
+        {"room_id", "message_id"} broadcasts a message the user stored through the HTTP API, once,
+        {"type": "heartbeat"} keeps the user online,
+        {"type": "typing", "room_id", "typing": true|false} shows or clears a typing indicator.
+        Binary frames are msgpack. Frames over the socket's budget and sends over the user's
+        budget are answered with {"type": "throttled", "client_id", "retry_after"}.
+        """
+        self.heartbeat()
+        if not await self.allow_frame():
+            return      # dropped unparsed
+
+        data = msgpack.unpackb(bytes_data) if bytes_data is not None else json.loads(text_data) # Parse frame from frontend
+
+        if data.get("type") == "heartbeat":
+            return
+
+        if data.get("type") == "typing":
+            await self.set_typing(data)
+            return
+
+        if data.get("type") == "send":
+            await self.send_message(data)
+            return
+
         room_id = data.get("room_id")
         
         message_id = data.get("message_id")#
@@ -42,77 +465,198 @@ class UserConsumer(AsyncWebsocketConsumer):
         if not room_id or not message_id:
             return
 
+        if str(message_id) in self.pushed:
+            return      # each message is pushed once, a repeated push would fan out again
         payload = await self.get_message_payload(message_id)
-        room_name, members = await self.get_room_info(room_id)
-
-        for member in members:
-            await self.channel_layer.group_send(
-                f'user_{member.id}',  # Send to the specific user's group 
-                {
-                    "type": "chat_message",
-                    "payload": payload,
-                    "room_id": room_id,
-                    "room_name": room_name,
-                    "is_group": len(members) > 2,
-                }
-            )
+        if payload is None or str(payload["room_id"]) != str(room_id):   # message must belong to the room it is pushed to
+            return
+        if payload["sender_id"] != self.user.id:    # its sending was counted against the sender's budget only
+            return
+        self.pushed.append(str(message_id))
 
-            if member.id != payload["sender_id"]:
-                await self.channel_layer.group_send(
-                    f'user_{member.id}',
-                    {
-                        "type": "notification",
-                        "room_id": room_id,
-                        "room_name": room_name,
-                        "sender_username": payload["sender_username"],
-                        "message": payload["message"],
-                    }
-                )
+        room = await self.get_room_info(payload["room_id"])
+        if room is None or self.user.id not in room.member_ids:  # only members can broadcast to a room
+            return
+
+        await self.broadcast(room, payload)
+
+    async def allow_frame(self):
+        """
+        Inbound frame budget of the socket. The first frame over it is answered with one
+        "throttled" frame, the following ones are dropped until the bucket refills.
+        """
+        now = time.monotonic()
+        tokens = FRAME_BUCKET.refill(self.frame_state, now)
+        if tokens >= 1:
+            self.frame_state = (tokens - 1, now)
+            self.frame_throttled = False
+            return True
+
+        if not self.frame_throttled:
+            self.frame_throttled = True
+            await self.send_frame({"type": "throttled", "client_id": None, "retry_after": round(FRAME_BUCKET.wait(tokens), 2)})
+        return False
+
+    async def send_message(self, data):
+        """
+        Validate membership, insert the message and broadcast it from memory in one step.
+        Retrying with the same client_id returns the stored message instead of creating another one.
+        """
+        room_id = str(data.get("room_id") or "")
+        text = str(data.get("message") or "").strip()
+        client_id = data.get("client_id")
+
+        if client_id is not None and (not isinstance(client_id, str) or len(client_id) > CLIENT_ID_MAX_LENGTH):
+            await self.send_error(client_id, "client_id must be a string of at most %d characters" % CLIENT_ID_MAX_LENGTH)
+            return
+
+        if not room_id.isdigit() or not text:
+            await self.send_error(client_id, "room_id and message are required")
+            return
+        room_id = int(room_id)
+
+        room = await self.get_room_info(room_id)
+        if room is None or self.user.id not in room.member_ids:
+            await self.send_error(client_id, "You are not a member of this chat room.")
+            return
+
+        retry_after = await acheck_send(self.user.id, room_id, room.is_group)
+        if retry_after:
+            await self.send_frame({"type": "throttled", "client_id": client_id, "retry_after": round(retry_after, 2)})
+            return
+
+        message, created = await self.save_message(room_id, text, client_id)
+        payload = message_payload(message, self.user.username)
+
+        await self.send_frame({
+            "type": "ack",
+            "client_id": client_id,
+            "id": message.id,
+            "room_id": message.room_id,
+            "created_at": payload["created_at"],
+            "stored": message.id is not None,   # False while queued in write_behind mode
+        })    #tell the sender the message is accepted
+
+        if created:   # a retry of an already accepted message is acknowledged but not broadcast again
+            self.typing_sent.pop(room_id, None)     # clients clear the sender's indicator on the message itself
+            await self.broadcast(room, payload)
+
+    async def set_typing(self, data):
+        """
+        Relay a typing indicator to the connected members of the room, in memory only.
+        Repeated "typing" frames are coalesced into one event per TYPING_REFRESH seconds; receivers
+        expire the indicator after TYPING_TTL, so a stop is only sent while it is still shown.
+        """
+        room_id = str(data.get("room_id") or "")
+        if not room_id.isdigit() or room_group_name(int(room_id)) not in self.room_group_names:
+            return      # joined room groups are the membership check, no lookup needed
+        room_id = int(room_id)
+
+        now = time.monotonic()
+        last = self.typing_sent.get(room_id)
+        if data.get("typing", True):
+            if last is not None and now - last < TYPING_REFRESH:
+                return
+            self.typing_sent[room_id] = now
+        else:
+            self.typing_sent.pop(room_id, None)
+            if last is None or now - last >= TYPING_TTL:
+                return
+
+        await self.channel_layer.group_send(room_group_name(room_id), {
+            "type": "user_typing",
+            "room_id": room_id,
+            "user_id": self.user.id,
+            "username": self.user.username,
+            "typing": bool(data.get("typing", True)),
+        })
+
+    async def send_error(self, client_id, detail):
+        await self.send_frame({"type": "error", "client_id": client_id, "detail": detail})
+
+    async def broadcast(self, room, payload):
+        # Single dispatch to the room group; the notification is folded into the same event
+        group_name = room_group_name(payload["room_id"])
+        event = await cache_io(record_event, group_name, chat_message_event(room, payload))
+        await self.channel_layer.group_send(group_name, encode_chat_frames(event))
 
 
     async def chat_message(self, event):
         """
-        Receive message from group_send and send to WebSocket
+        Receive message from the room group and send it to WebSocket,
+        followed by a notification for everyone except the sender.
+        JSON sockets forward the frames the sender encoded once for the whole room.
         """
-        print("chat_message event:", event)
-        
-        payload = event["payload"] # Get message payload from event
+        notify = event["payload"]["sender_id"] != self.user.id
 
-       # if payload["sender_id"] == self.user.id:   
-          #  return          # Avoid sending message back to sender
+        if "frame" in event and self.frame_format == "json" and getattr(self, "replay_frames", None) is None:
+            await self.push_frame(event["frame"])
+            if notify:
+                await self.push_frame(event["notification_frame"], "notification")
+            return
 
-        await self.send(text_data=json.dumps({
-            **event["payload"],
+        await self.send_frame(message_frame(event))      #Send event data to frontend
+        if notify:
+            await self.send_frame(notification_frame(event))
+
+    async def message_stored(self, event):
+        """
+        Ids of write-behind messages once their batch is committed
+        """
+        await self.send_frame({
+            "type": "message_stored",
             "room_id": event["room_id"],
-            "room_name": event["room_name"],
-            "is_group": event["is_group"]
-        }))      #Send event data as JSON to frontend
+            "messages": event["messages"],
+        })
 
+    async def message_thumbnails(self, event):
+        """
+        Thumbnail URLs of an image message, sent when the background job has written them
+        """
+        await self.send_frame({
+            "type": "message_thumbnails",
+            "room_id": event["room_id"],
+            "message_id": event["message_id"],
+            "thumbnails": event["thumbnails"],
+        })
 
-    async def notification(self, event):
+    async def user_typing(self, event):
         """
-        Send notification to WebSocket
+        Typing indicator of another member of one of the user's rooms
         """
-        await self.send(text_data=json.dumps({
-            "type": "notification",
+        if event["user_id"] == self.user.id:
+            return
+        await self.send_frame({
+            "type": "typing",
             "room_id": event["room_id"],
-            "room_name": event["room_name"],
-            "sender_username": event["sender_username"],
-            "message": event["message"],
-        }))    #Send notification data as JSON to frontend
+            "user_id": event["user_id"],
+            "username": event["username"],
+            "typing": event["typing"],
+            "expires_in": TYPING_TTL,
+        })
+
+    async def presence(self, event):
+        """
+        Online / last seen changes of the user's contacts, batched
+        """
+        await self.send_frame({
+            "type": "presence",
+            "users": event["users"],
+        })
 
     @database_sync_to_async
-    def save_message(self, room_id, sender_id, message, image_url=None, document_url=None):
-        room = ChatRoom.objects.get(id=room_id)
-        sender = User.objects.get(id=sender_id)
-        return Message.objects.create(room=room, sender=sender, message=message, image=image_url, document=document_url)
+    def save_message(self, room_id, message, client_id=None):
+        return ingest_message(room_id, self.user.id, message, client_id)
 
     @database_sync_to_async
-    def get_room_info(self, room_id):
-        room = ChatRoom.objects.get(id=room_id)
-        members = [m.user for m in room.members.all()]
-        room_name = room.group_name if room.is_group else " & ".join([m.username for m in members])
-        return room_name, members
+    def get_room_ids(self):
+        return list(ChatRoomMember.objects.filter(user_id=self.user.id).values_list("room_id", flat=True))
+
+    async def get_room_info(self, room_id):
+        room = await cache_io(cached_room_info, room_id)   # steady state: no database work
+        if room is None:
+            room = await database_sync_to_async(get_room_info)(room_id)
+        return room
 
     @database_sync_to_async
     def get_message(self, message_id):
@@ -126,15 +670,8 @@ class UserConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def get_message_payload(self, message_id):  
         
-        message = Message.objects.select_related("room", "sender").get(id=message_id)
-        
-        return{
-            "id": message.id,
-            "room_id": message.room.id,
-            "sender_id": message.sender.id,
-            "sender_username": message.sender.username,
-            "message": message.message,
-            "image_url": message.image.url if message.image else None,
-            "document_url": message.document.url if message.document else None,
-            "created_at": message.created_at.isoformat(),
-        }    #Return message payload as a dictionary 
\ No newline at end of file
+        message = Message.objects.select_related("sender").filter(id=message_id).first()
+        if message is None:
+            return None
+
+        return message_payload(message, message.sender.username) 
\ No newline at end of file
@@ -0,0 +1,149 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+LOG_SIZE = getattr(settings, "CHAT_DELIVERY_LOG_SIZE", 200)              # events kept per room / user group
+REPLAY_LIMIT = getattr(settings, "CHAT_DELIVERY_REPLAY_LIMIT", 1000)     # more missed events than this: resync
+REPLAY_OVERLAP = getattr(settings, "CHAT_DELIVERY_REPLAY_OVERLAP", 5)    # seconds replayed before the cursor, see missed_events
+READ_BATCH = 20
+
+EPOCH_KEY = "delivery:epoch"
+SEQ_KEY = "delivery:seq"
+
+
+def count_key(group):
+    return f"delivery:count:{group}"
+
+
+def origin_key(group):
+    return f"delivery:origin:{group}"
+
+
+def slot_key(group, number):
+    return f"delivery:log:{group}:{number % LOG_SIZE}"
+
+
+def current_epoch():
+    """
+    Random id of the log; a cursor from another epoch (cache flushed) cannot be replayed
+    """
+    epoch = cache.get(EPOCH_KEY)
+    if epoch is None:
+        cache.add(EPOCH_KEY, uuid.uuid4().hex[:8], None)
+        epoch = cache.get(EPOCH_KEY)
+    return epoch
+
+
+def make_cursor(seq):
+    return f"{current_epoch()}-{seq}"
+
+
+def current_cursor():
+    return make_cursor(cache.get(SEQ_KEY) or 0)
+
+
+def start_group(group, seq):
+    """
+    Create the counter of a group if it is missing, with the last sequence number it does not
+    cover: a counter lost to eviction starts again and older cursors cannot be replayed from it
+    """
+    if cache.add(count_key(group), 0, None):
+        cache.set(origin_key(group), seq, None)
+    else:
+        cache.add(origin_key(group), seq, None)
+
+
+def start_log(groups):
+    """
+    Log the groups a socket joins from now on, so a group without events is told apart from a
+    group whose counter was evicted. One read for all groups, writes only for missing counters.
+    """
+    keys = [SEQ_KEY] + [count_key(group) for group in groups] + [origin_key(group) for group in groups]
+    values = cache.get_many(keys)
+    seq = values.get(SEQ_KEY) or 0
+    for group in groups:
+        if count_key(group) not in values or origin_key(group) not in values:
+            start_group(group, seq)
+
+
+def record_event(group, event):
+    """
+    Give a channel layer event the next delivery sequence number and keep it in the ring of the
+    group it is sent to, returns the event to send. Sequence numbers are global, so the events
+    a user receives from all their groups are ordered by one cursor.
+    """
+    try:
+        seq = cache.incr(SEQ_KEY)
+    except ValueError:
+        if cache.add(SEQ_KEY, 0, None):
+            cache.set(EPOCH_KEY, uuid.uuid4().hex[:8], None)    # sequence lost or new: earlier cursors mean nothing
+        seq = cache.incr(SEQ_KEY)
+
+    try:
+        number = cache.incr(count_key(group))
+    except ValueError:
+        start_group(group, seq - 1)
+        number = cache.incr(count_key(group))
+
+    event = {**event, "seq": make_cursor(seq)}
+    cache.set(slot_key(group, number), (number, seq, time.time(), event), None)     # bounded by the ring, evicted slots force a resync
+    return event
+
+
+def parse_cursor(cursor):
+    epoch, _, seq = str(cursor).rpartition("-")
+    try:
+        return epoch, int(seq)
+    except ValueError:
+        return None, None
+
+
+def missed_events(groups, cursor):
+    """
+    Events sent to the groups after `cursor`, oldest first, preceded by the events logged up to
+    REPLAY_OVERLAP seconds before it. Sequence numbers are taken before the event is sent, so
+    concurrent senders can deliver N + 1 before N; a client that received N + 1 and not N holds
+    a cursor past N. The overlap replays such late events again, clients drop the ones they
+    have by their seq. Reads the newest slot of every group and then only the slots it returns.
+    None when some of them are no longer in the log (ring overwritten, evicted from the cache,
+    other epoch) and the client has to reload instead.
+    """
+    epoch, since = parse_cursor(cursor)
+    current = cache.get(SEQ_KEY) or 0
+    if epoch != current_epoch() or since is None or since > current:
+        return None
+
+    keys = [count_key(group) for group in groups] + [origin_key(group) for group in groups]
+    values = cache.get_many(keys)
+    missed = []
+    for group in groups:
+        number = values.get(count_key(group))
+        origin = values.get(origin_key(group))
+        if number is None or origin is None or origin > since:
+            return None     # counter evicted or started after the cursor: events may be missing
+        cutoff = None   # log time before which events are not replayed, set at the cursor
+        while number > 0:
+            numbers = range(number, max(number - READ_BATCH, 0), -1)
+            slots = cache.get_many([slot_key(group, n) for n in numbers])
+            for n in numbers:
+                slot = slots.get(slot_key(group, n))
+                if slot is None or slot[0] != n:
+                    return None     # dropped before the cursor and its overlap were reached
+                _, seq, logged, event = slot
+                if seq <= since:
+                    cutoff = logged - REPLAY_OVERLAP if cutoff is None else cutoff
+                    if logged < cutoff:
+                        number = 0
+                        break
+                if seq != since:    # the client has the cursor's own event
+                    missed.append((seq, event))
+            else:
+                number = numbers[-1] - 1
+
+            if len(missed) > REPLAY_LIMIT:
+                return None
+
+    missed.sort(key=lambda item: item[0])
+    return [event for _, event in missed]
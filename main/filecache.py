@@ -0,0 +1,67 @@
+import fcntl
+import os
+import pickle
+import time
+import zlib
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+
+CULL_INTERVAL = 10      # seconds between two counts of the cache files of one process
+
+
+class LocalFileCache(FileBasedCache):
+    """
+    File cache shared by the worker processes of one host (CACHE_URL=file:///path), the cache of
+    the local socket channel layer.
+
+    add() and incr() read and then write; they hold an exclusive lock of the directory so
+    concurrent workers neither lose increments of the delivery sequence or presence counters nor
+    both add the same key. Writes themselves are atomic renames and need no lock. The base class
+    lists the whole directory on every write to enforce MAX_ENTRIES, here it is done at most once
+    every CULL_INTERVAL seconds.
+    """
+
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        self.next_cull = 0
+
+    @contextmanager
+    def locked(self):
+        self._createdir()
+        fd = os.open(os.path.join(self._dir, "lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)    # releases the lock
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self.locked():
+            return super().add(key, value, timeout, version)
+
+    def incr(self, key, delta=1, version=None):   # decr() goes through here too
+        """
+        Unlike the base class the entry keeps its expiry, as on the other backends
+        """
+        with self.locked():
+            try:
+                with open(self._key_to_file(key, version), "rb") as f:
+                    expiry = pickle.load(f)
+                    value = pickle.loads(zlib.decompress(f.read()))
+            except (FileNotFoundError, EOFError):
+                expiry, value = 0, None
+            if value is None or (expiry is not None and expiry < time.time()):
+                raise ValueError(f"Key '{key}' not found")
+
+            value += delta
+            self.set(key, value, None if expiry is None else max(expiry - time.time(), 0.001), version)
+            return value
+
+    def _cull(self):
+        now = time.monotonic()
+        if now < self.next_cull:
+            return
+        self.next_cull = now + CULL_INTERVAL
+        super()._cull()
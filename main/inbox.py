@@ -0,0 +1,125 @@
+from collections import Counter, defaultdict
+from itertools import islice
+
+from django.db.models import Case, Count, F, Max, OuterRef, Subquery, Value, When, Q
+from django.db.models.functions import Coalesce, Substr
+
+from .models import ChatRoomMember, Message
+
+
+PREVIEW_LENGTH = ChatRoomMember._meta.get_field('last_message_preview').max_length
+OTHER_USER_BATCH = 1000
+
+
+def unread_after(room, last_read, user):
+    """
+    COUNT subquery of messages from others after a watermark; arguments may be values or OuterRefs
+    """
+    return Coalesce(
+        Subquery(
+            Message.objects.filter(room=room, id__gt=last_read)
+            .exclude(sender=user)
+            .order_by()
+            .values('room')
+            .annotate(count=Count('id'))
+            .values('count')
+        ),
+        0
+    )
+
+
+def record_messages(room_id, messages):
+    """
+    Update the conversation summary and unread counter of every member for newly inserted messages of one room.
+    A single UPDATE per room whatever the number of members or messages; senders skip their own messages.
+    """
+    total = len(messages)
+    if not total:
+        return
+
+    sent_by = Counter(message.sender_id for message in messages)
+    last = max(messages, key=lambda message: message.id)
+
+    ChatRoomMember.objects.filter(room_id=room_id).update(
+        unread_count=Case(
+            *[When(user_id=sender_id, then=F('unread_count') + (total - sent)) for sender_id, sent in sent_by.items()],
+            default=F('unread_count') + total
+        ),
+        last_message_id=last.id,
+        last_message_preview=last.message[:PREVIEW_LENGTH],
+        last_activity_at=last.created_at,
+    )
+
+
+def mark_room_read(room_id, user_id):
+    """
+    Move the user's read watermark to the newest message of the room and reset the unread counter.
+    One indexed MAX lookup and at most one UPDATE, regardless of how many messages are unread.
+    """
+    last_message_id = Message.objects.filter(room_id=room_id).aggregate(last=Max('id'))['last'] or 0
+
+    ChatRoomMember.objects.filter(
+        Q(last_read_message_id__lt=last_message_id) | Q(unread_count__gt=0),
+        room_id=room_id,
+        user_id=user_id
+    ).update(
+        last_read_message_id=last_message_id,
+        unread_count=unread_after(room_id, last_message_id, user_id)   # messages that landed after the MAX lookup stay unread
+    )
+
+
+def rebuild_unread_counts(members=None):
+    """
+    Recompute unread counters from the read watermarks, returns the number of rows updated
+    """
+    if members is None:
+        members = ChatRoomMember.objects.all()
+
+    return members.update(
+        unread_count=unread_after(OuterRef('room'), OuterRef('last_read_message_id'), OuterRef('user'))
+    )
+
+
+def assign_other_users(members):
+    """
+    Point the private-room rows of `members` at the other participant and clear it on group rows.
+    Read in Python and written with bulk_update: MySQL rejects an UPDATE of chatroommember whose
+    subquery reads chatroommember (error 1093).
+    """
+    members.filter(room__is_group=True).exclude(other_user=None).update(other_user=None)
+
+    private = members.filter(room__is_group=False).only('id', 'room_id', 'user_id', 'other_user_id').iterator(chunk_size=OTHER_USER_BATCH)
+    while batch := list(islice(private, OTHER_USER_BATCH)):
+        participants = defaultdict(list)
+        for room_id, user_id in ChatRoomMember.objects.filter(room_id__in={member.room_id for member in batch}).values_list('room_id', 'user_id'):
+            participants[room_id].append(user_id)
+
+        changed = []
+        for member in batch:
+            other_user_id = next((user_id for user_id in participants[member.room_id] if user_id != member.user_id), None)
+            if member.other_user_id != other_user_id:
+                member.other_user_id = other_user_id
+                changed.append(member)
+        ChatRoomMember.objects.bulk_update(changed, ['other_user'])
+
+
+def rebuild_conversations(members=None):
+    """
+    Recompute the conversation summary (last message, preview, activity time, other participant)
+    from the messages and memberships, returns the number of rows updated
+    """
+    if members is None:
+        members = ChatRoomMember.objects.all()
+
+    last_message = Message.objects.filter(room=OuterRef('room')).order_by('-id')
+
+    updated = members.update(
+        last_message=Subquery(last_message.values('id')[:1]),
+        last_message_preview=Coalesce(
+            Subquery(last_message.annotate(preview=Substr('message', 1, PREVIEW_LENGTH)).values('preview')[:1]),
+            Value('')
+        ),
+        last_activity_at=Subquery(last_message.values('created_at')[:1]),
+    )
+    assign_other_users(members)
+    return updated
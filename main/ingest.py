@@ -0,0 +1,263 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .delivery import record_event
+from .inbox import record_messages
+from .layers import group_send_from_thread
+from .message_search import index_messages
+from .models import Message
+from .signals import room_group_name
+
+logger = logging.getLogger(__name__)
+
+INGEST_MODE = getattr(settings, "CHAT_INGEST_MODE", "sync")    # "sync" or "write_behind"
+BATCH_SIZE = getattr(settings, "CHAT_INGEST_BATCH_SIZE", 200)
+FLUSH_INTERVAL = getattr(settings, "CHAT_INGEST_FLUSH_INTERVAL", 0.05)   # seconds a message may wait in the queue
+QUEUE_SIZE = getattr(settings, "CHAT_INGEST_QUEUE_SIZE", 5000)
+RECENT_SIZE = getattr(settings, "CHAT_INGEST_RECENT_SIZE", 10000)   # flushed keys kept to answer retries without a query
+
+
+class MessageIngestQueue:
+    """
+    Write-behind queue for text messages.
+
+    submit() returns an unsaved Message (pk None) that the caller broadcasts right away; a
+    background thread inserts queued messages with one bulk_create per batch, resolves their
+    ids through the (sender, client_id) unique index, updates the members' inbox rows and
+    sends a "message_stored" event with the ids to each room group.
+
+    Durability: a queued message is acknowledged but not stored. It is stored once its
+    batch commits, which normally takes at most `interval` seconds. The queue is drained at
+    interpreter exit, so a graceful shutdown loses nothing; a crash or SIGKILL loses what is
+    still queued. When the queue is full the submitting thread flushes it itself, which keeps
+    insert order and slows producers down instead of growing memory.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, interval=FLUSH_INTERVAL, max_size=QUEUE_SIZE, recent_size=RECENT_SIZE):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_size = max_size
+        self.recent_size = recent_size
+
+        self.pending = OrderedDict()    # (sender_id, client_id) -> Message, in submit order
+        self.recent = OrderedDict()     # (sender_id, client_id) -> Message flushed lately
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.flush_lock = threading.Lock()   # one batch in flight at a time so ids follow submit order
+        self.thread = None
+        self.stopping = False
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="message-ingest", daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def submit(self, room_id, sender_id, text, client_id=None):
+        """
+        Queue a message, returns (message, created); a known client_id returns the earlier message
+        """
+        key = (sender_id, client_id or uuid.uuid4().hex)
+        with self.lock:
+            message = self.pending.get(key) or self.recent.get(key)
+            if message is not None:
+                return message, False
+
+            message = Message(room_id=room_id, sender_id=sender_id, message=text, client_id=key[1], created_at=timezone.now())
+            self.pending[key] = message
+            full = len(self.pending) >= self.max_size
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.wakeup.notify()    # the first message starts the interval, a full batch ends it
+
+        if full:
+            self.flush()
+        return message, True
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.pending and not self.stopping:
+                    self.wakeup.wait()
+                if self.stopping:
+                    break
+            # let a batch build up unless it is already full
+            deadline = time.monotonic() + self.interval
+            with self.lock:
+                while len(self.pending) < self.batch_size and not self.stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.wakeup.wait(remaining)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Message ingest flush failed, retrying")
+                connection.close()   # reconnect on the next attempt
+                time.sleep(self.interval)
+        connection.close()
+
+    def stop(self):
+        """
+        Stop the flusher thread and store everything still queued
+        """
+        with self.lock:
+            self.stopping = True
+            self.wakeup.notify()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Message ingest drain failed, %d messages were not stored", len(self.pending))
+
+    def take(self):
+        with self.lock:
+            batch = []
+            while self.pending and len(batch) < self.batch_size:
+                batch.append(self.pending.popitem(last=False))
+            return batch
+
+    def flush(self):
+        """
+        Store queued messages batch by batch, returns the number of messages stored
+        """
+        stored = 0
+        with self.flush_lock:
+            while True:
+                batch = self.take()
+                if not batch:
+                    return stored
+                messages = [message for key, message in batch]
+                try:
+                    try:
+                        rejected = self.store(messages)
+                    except (IntegrityError, DataError):
+                        rejected = self.store_each(messages)
+                except Exception:
+                    with self.lock:   # put the batch back in front so nothing is lost or reordered
+                        for key, message in reversed(batch):
+                            self.pending[key] = message
+                            self.pending.move_to_end(key, last=False)
+                    raise
+
+                for message in rejected:
+                    logger.warning(
+                        "Dropped queued message %s of user %s to room %s: it cannot be stored",
+                        message.client_id, message.sender_id, message.room_id,
+                    )
+                rejected = {id(message) for message in rejected}
+                stored += len(batch) - len(rejected)
+
+                with self.lock:
+                    for key, message in batch:
+                        if id(message) not in rejected:
+                            self.recent[key] = message
+                    while len(self.recent) > self.recent_size:
+                        self.recent.popitem(last=False)
+
+    def store_each(self, messages):
+        """
+        Store the messages of a batch the database refused one by one, so the rows that cannot be
+        inserted (room or sender deleted since submit) do not hold up the others. Returns those rows.
+        """
+        rejected = []
+        for message in messages:
+            try:
+                rejected += self.store([message])
+            except (IntegrityError, DataError):
+                message.id = None   # its insert was rolled back
+                rejected.append(message)
+        return rejected
+
+    def store(self, messages):
+        """
+        Insert a batch and send its "message_stored" events, returns the messages the database
+        skipped (MySQL's INSERT IGNORE drops rows with a missing room or sender instead of failing)
+        """
+        keys = {(message.sender_id, message.client_id) for message in messages}
+        for message in messages:
+            message.id = None   # set by an earlier attempt whose commit failed
+            message._state.adding = True
+
+        def stored_rows():
+            rows = Message.objects.filter(
+                sender_id__in={sender_id for sender_id, client_id in keys},
+                client_id__in={client_id for sender_id, client_id in keys},
+            ).values_list("id", "sender_id", "client_id", "created_at")
+            return {(sender_id, client_id): (id, created_at) for id, sender_id, client_id, created_at in rows if (sender_id, client_id) in keys}
+
+        by_room = defaultdict(list)
+        with transaction.atomic():
+            existing = stored_rows()   # retries of messages flushed before the recent keys were forgotten
+            new = [message for message in messages if (message.sender_id, message.client_id) not in existing]
+            Message.objects.bulk_create(new, ignore_conflicts=True)
+
+            stored = stored_rows()
+            rejected = [message for message in messages if (message.sender_id, message.client_id) not in stored]
+            for message in messages:
+                if (message.sender_id, message.client_id) in stored:
+                    message.id, message.created_at = stored[(message.sender_id, message.client_id)]
+                    message._state.adding = False
+            new = [message for message in new if (message.sender_id, message.client_id) in stored]
+            for message in new:
+                by_room[message.room_id].append(message)
+
+            for room_id, room_messages in by_room.items():
+                record_messages(room_id, room_messages)
+            index_messages(new)   # bulk_create sends no post_save
+
+        for room_id, room_messages in by_room.items():
+            group_name = room_group_name(room_id)
+            group_send_from_thread(group_name, record_event(group_name, {
+                "type": "message_stored",
+                "room_id": room_id,
+                "messages": [
+                    {
+                        "client_id": message.client_id,
+                        "sender_id": message.sender_id,
+                        "id": message.id,
+                        "created_at": message.created_at.isoformat(),
+                    }
+                    for message in room_messages
+                ],
+            }))
+        return rejected
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_ingest_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = MessageIngestQueue()
+            _queue.start()
+    return _queue
+
+
+def ingest_message(room_id, sender_id, text, client_id=None):
+    """
+    Store a text message, or queue it in write_behind mode; returns (message, created).
+    A queued message has no id yet, it follows in the room's "message_stored" event.
+    """
+    if INGEST_MODE == "write_behind":
+        return get_ingest_queue().submit(room_id, sender_id, text, client_id)
+
+    if client_id:
+        return Message.objects.get_or_create(
+            sender_id=sender_id,
+            client_id=client_id,
+            defaults={"room_id": room_id, "message": text}
+        )
+    return Message.objects.create(room_id=room_id, sender_id=sender_id, message=text), True
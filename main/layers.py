@@ -0,0 +1,246 @@
+import asyncio
+import atexit
+import errno
+import logging
+import os
+import random
+import socket
+import string
+import tempfile
+import time
+
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+_server_loop = None     # event loop serving this process's sockets
+
+
+class LocalSocketChannelLayer(InMemoryChannelLayer):
+    """
+    Channel layer for several worker processes on one host, without an external service.
+
+    Every process binds a Unix datagram socket in a shared directory. Channels and group
+    memberships stay in the process that owns the socket (as with the in-memory layer);
+    send() delivers to the owning process and group_send() is broadcast once to every
+    process, each of which fans out to its local members of the group.
+
+    All deliveries, local ones included, go through the socket, so sending from another
+    thread (async_to_sync in a view or signal) is safe. Delivery is best effort like the
+    in-memory layer: a full receive buffer or channel queue drops the message, and messages
+    to processes that are gone are discarded. A message larger than a datagram (the socket
+    buffer size) is dropped with a warning.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, path=None, receive_buffer=4 * 1024 * 1024, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path or os.path.join(tempfile.gettempdir(), "chat-app-layer")
+        self.receive_buffer = receive_buffer
+        self.process_name = "%d-%s" % (os.getpid(), "".join(random.choice(string.ascii_letters) for _ in range(6)))
+
+        self._socket = None
+        self._sender = None
+        self._reader_loop = None
+        self._peer_names = None     # cached listing of the directory, see _peers
+        self._peers_changed = None
+
+    # Sockets
+
+    def socket_path(self, process_name):
+        return os.path.join(self.path, f"{process_name}.sock")
+
+    def _bind(self):
+        if self._socket is not None:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        address = self.socket_path(self.process_name)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        sock.bind(address)
+
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+
+        self._socket, self._sender = sock, sender
+        atexit.register(self._unlink, address)
+
+    def _unlink(self, address):
+        try:
+            os.unlink(address)
+        except FileNotFoundError:
+            pass
+
+    def _ensure_reader(self):
+        """
+        Read datagrams on the running event loop; re-registers when the loop changes
+        """
+        self._bind()
+        loop = asyncio.get_running_loop()
+        if self._reader_loop is loop:
+            return
+
+        if self._reader_loop is not None and not self._reader_loop.is_closed():
+            self._reader_loop.remove_reader(self._socket.fileno())
+        loop.add_reader(self._socket.fileno(), self._on_readable)
+        self._reader_loop = loop
+
+    def _peers(self):
+        """
+        Socket names of every process sharing the directory, this one included. The directory is
+        listed again only when its modification time moved (a process bound or removed its
+        socket) or a send found a peer gone, otherwise it costs one stat
+        """
+        changed = os.stat(self.path).st_mtime_ns
+        if self._peer_names is None or changed != self._peers_changed:
+            with os.scandir(self.path) as entries:
+                self._peer_names = [entry.name[:-len(".sock")] for entry in entries if entry.name.endswith(".sock")]
+            self._peers_changed = changed
+        return self._peer_names
+
+    def _transmit(self, process_name, packet):
+        """
+        Send one datagram: True when sent, False when dropped, None when dropped because it is
+        too large for any socket
+        """
+        address = self.socket_path(process_name)
+        try:
+            self._sender.sendto(packet, address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if process_name != self.process_name:
+                self._unlink(address)   # owner exited without cleaning up
+                self._peer_names = None
+            return False
+        except BlockingIOError:
+            return False   # receiver is not keeping up
+        except OSError as e:
+            if e.errno != errno.EMSGSIZE:
+                raise
+            logger.warning("Dropped a message of %d bytes, too large for the local socket layer", len(packet))
+            return None
+        return True
+
+    def _pack(self, kind, target, message):
+        return msgpack.packb([kind, target, time.time() + self.expiry, message], use_bin_type=True)
+
+    def _on_readable(self):
+        while True:
+            try:
+                packet = self._socket.recv(self.receive_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            kind, target, expires, message = msgpack.unpackb(packet, raw=False)
+            if expires < time.time():
+                continue
+
+            if kind == "send":
+                self._deliver(target, expires, message)
+            else:
+                # each channel gets its own copy, as from the in-memory layer; decoding the packet
+                # again is cheaper than a deepcopy
+                for index, channel in enumerate(list(self.groups.get(target, {}))):
+                    self._deliver(channel, expires, message if not index else msgpack.unpackb(packet, raw=False)[3])
+
+    def _deliver(self, channel, expires, message):
+        queue = self.channels.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+        try:
+            queue.put_nowait((expires, message))
+        except asyncio.QueueFull:
+            pass   # same as ChannelFull being swallowed by group_send
+
+    def _owner(self, channel):
+        """
+        Process that created a specific channel ("specific.<process>!<id>")
+        """
+        if "!" not in channel:
+            return self.process_name
+        return channel.split("!", 1)[0].rsplit(".", 1)[-1]
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+        self._bind()
+
+        if self._transmit(self._owner(channel), self._pack("send", channel, message)) is False:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self._ensure_reader()
+        return await super().receive(channel)
+
+    async def new_channel(self, prefix="specific."):
+        self._ensure_reader()
+        return "%s%s!%s" % (
+            prefix,
+            self.process_name,
+            "".join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    async def group_add(self, group, channel):
+        self._ensure_reader()
+        await super().group_add(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        self._bind()
+
+        packet = self._pack("group", group, message)   # encoded once, one datagram per process
+        for process_name in self._peers():
+            if self._transmit(process_name, packet) is None:
+                break   # too large for every process
+
+    async def close(self):
+        if self._socket is None:
+            return
+        if self._reader_loop is not None and not self._reader_loop.is_closed():
+            self._reader_loop.remove_reader(self._socket.fileno())
+        self._socket.close()
+        self._sender.close()
+        self._unlink(self.socket_path(self.process_name))
+        self._socket = self._sender = self._reader_loop = None
+
+
+def remember_server_loop():
+    """
+    Record the running event loop as the one serving sockets, so background threads send their
+    events through it (see group_send_from_thread)
+    """
+    global _server_loop
+    _server_loop = asyncio.get_running_loop()
+
+
+def group_send_from_thread(group, message):
+    """
+    group_send from a plain thread (ingest queue, thumbnail workers). The in-memory layers hand
+    events to the receiving sockets through asyncio queues that belong to the server loop, so the
+    send is scheduled on that loop; async_to_sync would run it on a loop of its own, which leaves
+    a waiting socket asleep. Without a serving loop (management commands) it is sent directly.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    loop = _server_loop
+    if loop is None or loop.is_closed() or not loop.is_running():
+        async_to_sync(channel_layer.group_send)(group, message)
+        return
+
+    future = asyncio.run_coroutine_threadsafe(channel_layer.group_send(group, message), loop)
+    future.add_done_callback(log_send_failure)   # not waited for, the loop may be busy or shutting down
+
+
+def log_send_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Background group_send failed", exc_info=future.exception())
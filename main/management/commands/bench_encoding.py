@@ -0,0 +1,77 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main.consumers import UserConsumer
+from main.room_cache import RoomInfo
+from main.signals import chat_message_event, encode_chat_frames
+
+
+class Command(BaseCommand):
+    help = "Benchmark CPU per message of a room broadcast: every socket encoding the frames vs frames encoded once"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=1000)
+        parser.add_argument("--messages", type=int, default=200)
+        parser.add_argument("--text-size", type=int, default=200, help="Characters per message")
+        parser.add_argument("--batch", action="store_true", help="Sockets negotiated ?batch=1")
+
+    def handle(self, *args, **options):
+        members = options["members"]
+        sockets = [self.socket(user_id, options["batch"]) for user_id in range(1, members + 1)]
+        room = RoomInfo("bench", True, tuple(range(1, members + 1)))
+        payload = {
+            "id": 1,
+            "client_id": "bench",
+            "room_id": 1,
+            "sender_id": 1,
+            "sender_username": "bench",
+            "message": "x" * options["text_size"],
+            "image_url": None,
+            "document_url": None,
+            "thumbnails": {},
+            "created_at": timezone.now().isoformat(),
+        }
+        event = {**chat_message_event(room, payload), "seq": "bench-1"}
+
+        per_socket = self.run(sockets, lambda: event, options["messages"])
+        encoded_once = self.run(sockets, lambda: encode_chat_frames(event), options["messages"])
+
+        self.stdout.write(f"{members} members, {options['messages']} messages, batch={options['batch']}")
+        self.stdout.write(f"{'mode':<14} {'CPU ms/message':>15}")
+        self.stdout.write(f"{'per socket':<14} {per_socket:>15.2f}")
+        self.stdout.write(f"{'encoded once':<14} {encoded_once:>15.2f}")
+        self.stdout.write(f"speedup {per_socket / encoded_once:.1f}x")
+
+    def socket(self, user_id, batch):
+        """
+        UserConsumer as after connect, sending into the void
+        """
+        consumer = UserConsumer()
+        consumer.user = SimpleNamespace(id=user_id)
+        consumer.setup_outbound({"batch": ["1"]} if batch else {})
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            pass
+        consumer.send = send
+        return consumer
+
+    def run(self, sockets, make_event, messages):
+        """
+        CPU milliseconds per message: the sender's encoding, every socket's handler and send
+        """
+        async def broadcast():
+            for consumer in sockets:
+                consumer.setup_outbound({"batch": ["1"]} if consumer.batch_frames else {})   # fresh queue on this loop
+            for _ in range(messages):
+                event = make_event()    # done once by the sender
+                for consumer in sockets:
+                    await consumer.chat_message(event)
+                await asyncio.gather(*(consumer.flusher for consumer in sockets if consumer.flusher))   # batch ticks
+
+        start = time.process_time()
+        asyncio.run(broadcast())
+        return (time.process_time() - start) * 1000 / messages
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Benchmark message fan-out on the in-memory channel layer: per-member group_send loop vs one room dispatch"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="2,50,500,5000", help="Comma separated group sizes")
+        parser.add_argument("--events", type=int, default=100000, help="Approximate deliveries per run, split into messages")
+        parser.add_argument("--budget", type=float, default=10.0, help="Seconds after which a run stops early")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",")]
+
+        self.stdout.write(f"{'members':>8} {'messages':>9} {'per-member msg/s':>17} {'room msg/s':>11} {'speedup':>8}")
+        for size in sizes:
+            messages = max(5, options["events"] // size)
+            legacy, room = asyncio.run(self.run_size(size, messages, options["budget"]))
+            self.stdout.write(f"{size:>8} {messages:>9} {legacy:>17.2f} {room:>11.2f} {room / legacy:>7.1f}x")
+
+    async def run_size(self, size, messages, budget):
+        # capacity is large enough that no delivery is dropped as ChannelFull during a run
+        layer = InMemoryChannelLayer(capacity=messages * 2 + 1)
+
+        for member_id in range(size):
+            channel = await layer.new_channel()
+            await layer.group_add(f"user_{member_id}", channel)
+            await layer.group_add("room_1", channel)
+
+        payload = {
+            "id": 1,
+            "room_id": 1,
+            "sender_id": 0,
+            "sender_username": "bench",
+            "message": "hello" * 10,
+            "image_url": None,
+            "document_url": None,
+            "created_at": "2025-01-01T00:00:00+00:00",
+        }
+
+        # previous behaviour: chat_message + notification per member
+        start = time.perf_counter()
+        sent = 0
+        while sent < messages and time.perf_counter() - start < budget:
+            sent += 1
+            for member_id in range(size):
+                await layer.group_send(f"user_{member_id}", {
+                    "type": "chat_message",
+                    "payload": payload,
+                    "room_id": 1,
+                    "room_name": "bench",
+                    "is_group": size > 2,
+                })
+                if member_id != payload["sender_id"]:
+                    await layer.group_send(f"user_{member_id}", {
+                        "type": "notification",
+                        "room_id": 1,
+                        "room_name": "bench",
+                        "sender_username": payload["sender_username"],
+                        "message": payload["message"],
+                    })
+        legacy = sent / (time.perf_counter() - start)
+        self.drain(layer)
+
+        # room fan-out: one dispatch, notification folded into the event
+        start = time.perf_counter()
+        sent = 0
+        while sent < messages and time.perf_counter() - start < budget:
+            sent += 1
+            await layer.group_send("room_1", {
+                "type": "chat_message",
+                "payload": payload,
+                "room_id": 1,
+                "room_name": "bench",
+                "is_group": size > 2,
+            })
+        room = sent / (time.perf_counter() - start)
+        self.drain(layer)
+
+        return legacy, room
+
+    def drain(self, layer):
+        for queue in layer.channels.values():
+            while not queue.empty():
+                queue.get_nowait()
@@ -0,0 +1,93 @@
+import asyncio
+import contextlib
+import io
+import time
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+
+from main.middleware import JWTAuthMiddleware
+from main.models import User
+from main.views import get_tokens_for_user
+
+
+class LegacyJWTAuthMiddleware:
+    """
+    The handshake before claim-based authentication: prints the scope, imports inside
+    the call and loads the user from the database on every connection
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        print("JWTAuthMiddleware scope before auth:", scope)
+
+        from django.contrib.auth.models import AnonymousUser
+        from rest_framework_simplejwt.tokens import AccessToken
+
+        @database_sync_to_async
+        def get_user(user_id):
+            from django.contrib.auth import get_user_model
+            User = get_user_model()
+            try:
+                return User.objects.get(id=user_id)
+            except User.DoesNotExist:
+                return AnonymousUser()
+
+        token = parse_qs(scope['query_string'].decode()).get('token')
+        if token:
+            try:
+                scope["user"] = await get_user(AccessToken(token[0])["user_id"])
+            except Exception:
+                scope["user"] = AnonymousUser()
+        else:
+            scope["user"] = AnonymousUser()
+
+        return await self.inner(scope, receive, send)
+
+
+async def inner_app(scope, receive, send):
+    return scope["user"]
+
+
+class Command(BaseCommand):
+    help = "Benchmark WebSocket handshakes per second through JWTAuthMiddleware, before and after claim-based auth"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--handshakes", type=int, default=5000)
+        parser.add_argument("--concurrency", type=int, default=100, help="Handshakes in flight at once, like a reconnect storm")
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(email="bench-handshake@example.com", defaults={"username": "bench-handshake"})
+        try:
+            claims_token = get_tokens_for_user(user)["access"]
+            plain_token = str(AccessToken.for_user(user))   # token without the username claim: cached lookup path
+
+            runs = [
+                ("before (db lookup per handshake)", LegacyJWTAuthMiddleware(inner_app), plain_token),
+                ("after, token claims", JWTAuthMiddleware(inner_app), claims_token),
+                ("after, cached user lookup", JWTAuthMiddleware(inner_app), plain_token),
+            ]
+            for label, middleware, token in runs:
+                rate = asyncio.run(self.run(middleware, token, user.id, options["handshakes"], options["concurrency"]))
+                self.stdout.write(f"{label:<36} {rate:>10.0f} handshakes/s")
+        finally:
+            user.delete()
+
+    async def run(self, middleware, token, user_id, handshakes, concurrency):
+        scope = {"type": "websocket", "path": "/ws/user/", "query_string": f"token={token}".encode(), "headers": []}
+
+        async def handshake():
+            user = await middleware(dict(scope), None, None)
+            assert user.is_authenticated and user.id == user_id
+
+        with contextlib.redirect_stdout(io.StringIO()):   # the legacy middleware prints every scope
+            await handshake()   # warm up imports, caches and the blacklist snapshot
+            start = time.perf_counter()
+            for offset in range(0, handshakes, concurrency):
+                await asyncio.gather(*(handshake() for _ in range(min(concurrency, handshakes - offset))))
+            return handshakes / (time.perf_counter() - start)
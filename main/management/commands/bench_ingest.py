@@ -0,0 +1,67 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from main.ingest import MessageIngestQueue
+from main.models import ChatRoom, ChatRoomMember, Message, User
+
+
+class Command(BaseCommand):
+    help = "Benchmark message ingestion: one INSERT per message vs the write-behind queue with batched bulk_create"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=5000, help="Messages per mode")
+        parser.add_argument("--senders", type=int, default=4, help="Concurrent sending threads")
+        parser.add_argument("--members", type=int, default=20, help="Members of the benchmark group")
+        parser.add_argument("--batch-size", type=int, default=200)
+
+    def handle(self, *args, **options):
+        tag = uuid.uuid4().hex[:8]
+        users = [
+            User.objects.create_user(f"bench-{tag}-{i}@example.com", f"bench-{tag}-{i}", None)
+            for i in range(max(options["members"], options["senders"]))
+        ]
+        room = ChatRoom.objects.create(group_name=f"bench-{tag}", is_group=True, created_by=users[0])
+        ChatRoomMember.objects.bulk_create([ChatRoomMember(room=room, user=user) for user in users])
+        senders = users[:options["senders"]]
+
+        try:
+            sync = self.run(options["messages"], senders, lambda sender, i: Message.objects.create(
+                room=room, sender=sender, message=f"message {i}", client_id=f"{tag}-sync-{i}"
+            ))
+
+            queue = MessageIngestQueue(batch_size=options["batch_size"])
+            queue.start()
+            start = time.perf_counter()
+            accepted = self.run(options["messages"], senders, lambda sender, i: queue.submit(
+                room.id, sender.id, f"message {i}", f"{tag}-queued-{i}"
+            ))
+            queue.stop()   # drain so the figure covers storing every message, not only accepting it
+            stored = options["messages"] / (time.perf_counter() - start)
+
+            self.stdout.write(f"{'mode':<14} {'msg/s':>10}")
+            self.stdout.write(f"{'sync':<14} {sync:>10.0f}")
+            self.stdout.write(f"{'write_behind':<14} {stored:>10.0f}   (accepted at {accepted:.0f} msg/s)")
+            self.stdout.write(f"speedup {stored / sync:.1f}x")
+        finally:
+            room.delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+    def run(self, messages, senders, send):
+        """
+        Send `messages` messages round robin from the sender threads, returns messages per second
+        """
+        def work(index):
+            try:
+                for i in range(index, messages, len(senders)):
+                    send(senders[index], i)
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(len(senders)) as pool:
+            list(pool.map(work, range(len(senders))))
+        return messages / (time.perf_counter() - start)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Message
+from main.thumbnails import generate_thumbnails
+
+
+class Command(BaseCommand):
+    help = "Create missing thumbnails for image messages (or all of them with --force)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Regenerate thumbnails that already exist")
+
+    def handle(self, *args, **options):
+        messages = Message.objects.exclude(image="").exclude(image=None)
+        if not options["force"]:
+            messages = messages.filter(thumbnails={})
+
+        count = 0
+        for message in messages.iterator():
+            if generate_thumbnails(message):
+                count += 1
+        self.stdout.write(self.style.SUCCESS(f"Created thumbnails for {count} messages"))
@@ -0,0 +1,63 @@
+import os
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main.models import Message, StoredBlob
+from main.storage import BLOB_DIR, is_blob
+
+
+class Command(BaseCommand):
+    help = "Delete content-addressed media blobs that no message references any more"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace", type=int, default=24 * 3600,
+                            help="Seconds a blob must stay unreferenced before it is deleted, covers uploads in flight")
+
+    def handle(self, *args, **options):
+        storage = Message._meta.get_field("document").storage
+        if not hasattr(storage, "store_file"):
+            self.stdout.write("Media deduplication is disabled, nothing to do")
+            return
+        cutoff = timezone.now() - timedelta(seconds=options["grace"])
+        unused_since = time.time() - options["grace"]     # file times: uploads reusing a blob touch it
+        referenced = self.referenced_blobs()
+
+        deleted = 0
+        for blob in StoredBlob.objects.filter(refcount__lte=0, updated_at__lt=cutoff).iterator():
+            # the count is only a cache of the references, check them before deleting the file
+            if blob.name in referenced:
+                continue
+            if StoredBlob.objects.filter(pk=blob.pk, refcount__lte=0, updated_at__lt=cutoff).delete()[0]:
+                if storage.purge_blob(blob.name, unused_since):
+                    deleted += 1
+
+        # files written by an upload whose message was never created have no row
+        known = set(StoredBlob.objects.values_list("name", flat=True))
+        root = storage.path(BLOB_DIR)
+        for directory, _, files in os.walk(root):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, storage.location).replace(os.sep, "/")
+                if name in known or name in referenced or not is_blob(name) or os.path.getmtime(path) > unused_since:
+                    continue
+                if storage.purge_blob(name, unused_since):
+                    deleted += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} unreferenced blobs"))
+
+    def referenced_blobs(self):
+        """
+        Blob names attached to a message, read once: the attachment columns are not indexed and
+        one lookup per candidate would scan the message table each time. A message created
+        afterwards counts its blob in (refcount and updated_at) and touches the file, which the
+        conditional delete and purge_blob check.
+        """
+        referenced = set()
+        for field in ("image", "document"):
+            referenced.update(
+                Message.objects.filter(**{f"{field}__startswith": f"{BLOB_DIR}/"}).values_list(field, flat=True).iterator()
+            )
+        return referenced
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main.models import UploadSession
+from main.uploads import SESSION_TTL, discard_part
+
+
+class Command(BaseCommand):
+    help = "Delete chunked uploads that were not finalized within CHAT_UPLOAD_SESSION_TTL, with their partial files"
+
+    def handle(self, *args, **options):
+        stale = UploadSession.objects.filter(updated_at__lt=timezone.now() - timedelta(seconds=SESSION_TTL))
+
+        count = 0
+        for session in stale.iterator():
+            discard_part(session)
+            session.delete()
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Deleted {count} abandoned uploads"))
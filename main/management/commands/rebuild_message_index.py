@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.message_search import index_messages
+from main.models import Message, MessageToken
+
+
+class Command(BaseCommand):
+    help = "Rebuild the message full-text index, e.g. after bulk writes that bypass model signals"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--room", type=int, help="Only reindex this room")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        messages = Message.objects.exclude(message="").only("id", "room_id", "message").order_by("id")
+        tokens = MessageToken.objects.all()
+        if options["room"]:
+            messages = messages.filter(room_id=options["room"])
+            tokens = tokens.filter(room_id=options["room"])
+
+        count, last_id = 0, 0
+        with transaction.atomic():
+            tokens.delete()
+            while True:
+                batch = list(messages.filter(id__gt=last_id)[:options["batch_size"]])
+                if not batch:
+                    break
+                index_messages(batch)
+                count += len(batch)
+                last_id = batch[-1].id
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} messages"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Profile
+from main.search import index_user
+
+
+class Command(BaseCommand):
+    help = "Rebuild the user search terms, e.g. after bulk updates that bypass model signals"
+
+    def handle(self, *args, **options):
+        count = 0
+        for profile in Profile.objects.select_related("user").iterator():
+            index_user(profile.user, profile.full_name)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} users"))
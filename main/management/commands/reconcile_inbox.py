@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from main.inbox import rebuild_conversations, rebuild_unread_counts
+from main.models import ChatRoomMember
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-member unread counters and conversation summaries from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--room", type=int, action="append", help="Only rebuild the given room id (repeatable)")
+
+    def handle(self, *args, **options):
+        members = ChatRoomMember.objects.all()
+        if options["room"]:
+            members = members.filter(room_id__in=options["room"])
+
+        updated = rebuild_unread_counts(members)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt unread counters for {updated} memberships"))
+
+        updated = rebuild_conversations(members)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt conversation summaries for {updated} memberships"))
@@ -0,0 +1,252 @@
+import asyncio
+import mimetypes
+import os
+import re
+import time
+from email.utils import formatdate
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden
+from django.utils._os import safe_join
+from django.utils.crypto import constant_time_compare
+
+from .storage import URL_TTL, blob_digest, is_blob, is_protected, media_signature
+
+READ_SIZE = getattr(settings, "CHAT_MEDIA_READ_SIZE", 256 * 1024)     # bytes per chunk when the server has no zero-copy send
+RANGE_RE = re.compile(r"bytes=\s*(\d*)-(\d*)\s*", re.ASCII)
+
+
+def check_access(name, query):
+    """
+    True when the media file may be served: public media, or a valid unexpired signature
+    """
+    if not is_protected(name):
+        return True
+    try:
+        expires = int(query.get("exp", [""])[0])
+    except ValueError:
+        return False
+    signature = query.get("sig", [""])[0]
+    return expires >= time.time() and constant_time_compare(signature, media_signature(name, expires))
+
+
+def resolve(name):
+    """
+    Absolute path of a media file, None when it is outside MEDIA_ROOT, hidden (upload parts) or missing
+    """
+    if any(part.startswith(".") for part in name.split("/")):
+        return None
+    try:
+        path = safe_join(settings.MEDIA_ROOT, name)
+    except SuspiciousFileOperation:
+        return None
+    return path if os.path.isfile(path) else None
+
+
+def file_etag(name, stat):
+    if is_blob(name):
+        return f'"{blob_digest(name)}"'   # content addressed: the name is the hash
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """
+    (start, end) inclusive for a single "bytes=" range, None to send the whole file,
+    ValueError when the range cannot be satisfied
+    """
+    match = RANGE_RE.fullmatch(header or "")
+    if not match or not any(match.groups()):
+        return None     # malformed, or multiple ranges, answered with the full file as RFC 9110 allows
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1    # the last N bytes; none for "-0"
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+class SendBufferGate:
+    """
+    Streaming producer registered on Daphne's request (its send is partial(server.handle_reply,
+    request)), whose send never waits for the client: Twisted pauses the producer while the
+    connection's send buffer is full and resumes it once the client has read everything
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.stopped = False
+
+    def pauseProducing(self):
+        self.writable.clear()
+
+    def resumeProducing(self):
+        self.writable.set()
+
+    def stopProducing(self):   # connection lost
+        self.stopped = True
+        self.writable.set()
+
+
+def watch_send_buffer(send):
+    """
+    SendBufferGate registered on the request behind `send`, None when the server is not Daphne
+    """
+    send_args = getattr(send, "args", ())
+    request = send_args[0] if send_args else None
+    if not hasattr(request, "registerProducer"):
+        return None
+    gate = SendBufferGate(request)
+    try:
+        request.registerProducer(gate, True)
+    except (ValueError, RuntimeError):
+        return None     # the request already has a producer
+    return gate
+
+
+def cache_control(name):
+    if is_blob(name):
+        return "private, max-age=31536000, immutable"
+    if is_protected(name):
+        return f"private, max-age={URL_TTL}"
+    return "public, max-age=3600"
+
+
+class MediaApplication:
+    """
+    ASGI application serving MEDIA_URL without going through Django.
+
+    Files are sent with the zero-copy extensions when the server offers them
+    ("http.response.zerocopysend", or "http.response.pathsend" for whole files); otherwise
+    they are read in READ_SIZE chunks in a thread and streamed from the event loop, so no
+    worker is held for the duration of a download, at the pace the client reads them. Supports single byte ranges (If-Range
+    included), ETag / If-None-Match and HEAD. Room attachments need a signed URL
+    (signed_media_url); other paths are passed to the inner application.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.prefix = settings.MEDIA_URL
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            return await self.inner(scope, receive, send)
+
+        if scope["method"] not in ("GET", "HEAD"):
+            return await self.respond(send, 405, [(b"allow", b"GET, HEAD")])
+
+        name = scope["path"][len(self.prefix):]
+        if not check_access(name, parse_qs(scope.get("query_string", b"").decode())):
+            return await self.respond(send, 403)
+
+        path = resolve(name)
+        if path is None:
+            return await self.respond(send, 404)
+
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        await self.serve_file(scope, send, name, path, headers)
+
+    async def respond(self, send, status, headers=()):
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-length", b"0"), *headers]})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def serve_file(self, scope, send, name, path, headers):
+        with open(path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            size = stat.st_size
+            etag = file_etag(name, stat)
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+            response_headers = [
+                (b"accept-ranges", b"bytes"),
+                (b"etag", etag.encode()),
+                (b"last-modified", formatdate(stat.st_mtime, usegmt=True).encode()),
+                (b"cache-control", cache_control(name).encode()),
+                (b"x-content-type-options", b"nosniff"),
+            ]
+
+            if etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+                return await self.respond(send, 304, response_headers)
+
+            byte_range = None
+            if headers.get("if-range", etag) == etag:   # a changed file is sent whole
+                try:
+                    byte_range = parse_range(headers.get("range"), size)
+                except ValueError:
+                    return await self.respond(send, 416, [(b"content-range", f"bytes */{size}".encode())])
+
+            status, start, end = 200, 0, size - 1
+            if byte_range is not None:
+                status, (start, end) = 206, byte_range
+                response_headers.append((b"content-range", f"bytes {start}-{end}/{size}".encode()))
+            length = end - start + 1 if size else 0
+
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", content_type.encode()),
+                    (b"content-length", str(length).encode()),
+                    *response_headers,
+                ],
+            })
+
+            if scope["method"] == "HEAD" or not length:
+                return await send({"type": "http.response.body", "body": b""})
+
+            extensions = scope.get("extensions") or {}
+            if "http.response.zerocopysend" in extensions:
+                return await send({"type": "http.response.zerocopysend", "file": file, "offset": start, "count": length})
+            if "http.response.pathsend" in extensions and status == 200:
+                return await send({"type": "http.response.pathsend", "path": os.path.abspath(path)})
+
+            # under Daphne the next chunk is read once the client has taken the previous ones, a
+            # slow download holds one send buffer and one chunk instead of the whole file
+            gate = watch_send_buffer(send)
+            try:
+                await self.stream(send, file, start, length, gate)
+            finally:
+                if gate is not None:
+                    gate.request.unregisterProducer()
+
+    async def stream(self, send, file, offset, remaining, gate):
+        loop = asyncio.get_running_loop()
+        while remaining:
+            if gate is not None:
+                await gate.writable.wait()
+                if gate.stopped:
+                    return
+            chunk = await loop.run_in_executor(None, os.pread, file.fileno(), min(READ_SIZE, remaining), offset)
+            if not chunk:
+                break   # truncated while sending
+            offset += len(chunk)
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": bool(remaining)})
+        if remaining:
+            await send({"type": "http.response.body", "body": b""})
+
+def media_view(request, path):
+    """
+    Same access rules for MEDIA_URL when the site is served through WSGI or the Django test client
+    """
+    if not check_access(path, {key: request.GET.getlist(key) for key in request.GET}):
+        return HttpResponseForbidden()
+    file_path = resolve(path)
+    if file_path is None:
+        raise Http404()
+
+    stat = os.stat(file_path)
+    etag = file_etag(path, stat)
+    if etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+        response = HttpResponse(status=304)
+    else:
+        response = FileResponse(open(file_path, "rb"), content_type=mimetypes.guess_type(path)[0])
+    response["ETag"] = etag
+    response["Cache-Control"] = cache_control(path)
+    return response
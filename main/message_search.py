@@ -0,0 +1,88 @@
+import re
+
+from django.db.models import Exists, OuterRef
+from django.utils.html import escape
+
+from .models import ChatRoomMember, MessageToken
+
+TOKEN_LENGTH = MessageToken._meta.get_field('token').max_length
+MAX_TOKENS = 200        # distinct words indexed per message
+MAX_QUERY_TOKENS = 5
+SNIPPET_CONTEXT = 60    # characters kept on each side of the first match
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """
+    Distinct lower case words of at least two characters, in order of appearance
+    """
+    tokens = {}
+    for word in WORD_RE.findall((text or "").lower()):
+        word = word[:TOKEN_LENGTH]
+        if len(word) >= 2 and word not in tokens:
+            tokens[word] = None
+            if len(tokens) >= MAX_TOKENS:
+                break
+    return list(tokens)
+
+
+def index_messages(messages):
+    """
+    Add the words of newly stored messages to the index, one INSERT for the whole batch
+    """
+    MessageToken.objects.bulk_create([
+        MessageToken(token=token, room_id=message.room_id, message_id=message.id)
+        for message in messages
+        for token in tokenize(message.message)
+    ])
+
+
+def search_postings(query, user, room_id=None):
+    """
+    Postings of messages containing every word of the query, in the given room or in any room of
+    the user. The longest word drives the index range scan (long words tend to be rare), the
+    other words are index lookups on (token, room, message). Order by -message_id to page.
+    """
+    tokens = sorted(tokenize(query)[:MAX_QUERY_TOKENS], key=len, reverse=True)
+    if not tokens:
+        return MessageToken.objects.none(), []
+
+    postings = MessageToken.objects.filter(token=tokens[0])
+    if room_id is not None:
+        postings = postings.filter(room_id=room_id)
+    else:
+        postings = postings.filter(room_id__in=ChatRoomMember.objects.filter(user=user).values('room_id'))
+
+    for token in tokens[1:]:
+        postings = postings.filter(Exists(MessageToken.objects.filter(
+            token=token,
+            room_id=OuterRef('room_id'),
+            message_id=OuterRef('message_id')
+        )))
+    return postings, tokens
+
+
+def highlight(text, tokens):
+    """
+    HTML-escaped excerpt around the first match with every matching word wrapped in <mark>
+    """
+    text = text or ""
+    words = set(tokens)
+    matches = [match for match in WORD_RE.finditer(text) if match.group().lower()[:TOKEN_LENGTH] in words]
+    if not matches:
+        return escape(text[:2 * SNIPPET_CONTEXT])
+
+    start = max(matches[0].start() - SNIPPET_CONTEXT, 0)
+    end = min(matches[0].end() + SNIPPET_CONTEXT, len(text))
+
+    parts, position = [], start
+    for match in matches:
+        if match.start() < start or match.end() > end:
+            continue
+        parts.append(escape(text[position:match.start()]))
+        parts.append(f"<mark>{escape(match.group())}</mark>")
+        position = match.end()
+    parts.append(escape(text[position:end]))
+
+    return ("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(text) else "")
@@ -1,11 +1,29 @@
+import asyncio
+import time
+from collections import OrderedDict
 from urllib.parse import parse_qs
+
 from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.utils import timezone
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from rest_framework_simplejwt.tokens import AccessToken
+
+REFRESH_JTI_CLAIM = "refresh_jti"   # set on access tokens at login so revoking the refresh token revokes them too
+
+USER_CACHE_SIZE = getattr(settings, "WS_AUTH_USER_CACHE_SIZE", 10000)
+USER_CACHE_TTL = getattr(settings, "WS_AUTH_USER_CACHE_TTL", 60)      # seconds
+REVOCATION_TTL = getattr(settings, "WS_AUTH_REVOCATION_TTL", 30)      # seconds between blacklist snapshots
+
 
 @database_sync_to_async
 def get_user(user_id):
-    from django.contrib.auth import get_user_model
-    from django.contrib.auth.models import AnonymousUser
-
     User = get_user_model()
     try:
         return User.objects.get(id=user_id)
@@ -13,32 +31,121 @@ def get_user(user_id):
         return AnonymousUser()
 
 
+class ClaimsUser(TokenUser):
+    """
+    User built from verified token claims; ids are ints like on the User model
+    """
+
+    @cached_property
+    def id(self):
+        return int(self.token[api_settings.USER_ID_CLAIM])
+
+    @cached_property
+    def pk(self):
+        return self.id
+
+
+class UserCache:
+    """
+    Bounded LRU of user id -> user with a time to live, for tokens that do not carry the user's claims
+    """
+
+    def __init__(self, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    async def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(user_id)
+            return entry[1]
+
+        user = await get_user(user_id)
+        self.entries[user_id] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return user
+
+
+class RevocationSnapshot:
+    """
+    In-memory copy of the blacklisted token ids and of the deactivated user ids, reloaded at most
+    once every `ttl` seconds; tokens authenticated from their claims never load the user row, so
+    deactivation is checked here
+    """
+
+    def __init__(self, ttl=REVOCATION_TTL):
+        self.ttl = ttl
+        self.jtis = frozenset()
+        self.inactive_users = frozenset()   # ids as strings, like the user id claim
+        self.expires = 0
+        self.lock = None
+
+    @database_sync_to_async
+    def load(self):
+        jtis = frozenset(
+            BlacklistedToken.objects.filter(token__expires_at__gt=timezone.now()).values_list("token__jti", flat=True)
+        )
+        inactive_users = frozenset(
+            str(user_id) for user_id in get_user_model().objects.filter(is_active=False).values_list("id", flat=True)
+        )
+        return jtis, inactive_users
+
+    async def refresh(self):
+        if self.expires > time.monotonic():
+            return
+
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:   # a reconnect storm triggers a single reload
+            if self.expires > time.monotonic():
+                return
+            self.jtis, self.inactive_users = await self.load()
+            self.expires = time.monotonic() + self.ttl
+
+    async def is_revoked(self, token):
+        await self.refresh()
+        return (
+            token.get("jti") in self.jtis
+            or token.get(REFRESH_JTI_CLAIM) in self.jtis
+            or str(token.get(api_settings.USER_ID_CLAIM)) in self.inactive_users
+        )
+
+
 class JWTAuthMiddleware:
     """
-    Custom middleware that takes JWT token from query string and authenticates via SimpleJWT
+    Custom middleware that takes JWT token from query string and authenticates via SimpleJWT.
+    Tokens issued at login carry the username, so the handshake builds the user from the
+    verified claims without touching the database; older tokens go through a TTL user cache.
     """
 
     def __init__(self, inner):
         self.inner = inner  #tells to call next application
+        self.users = UserCache()
+        self.revocations = RevocationSnapshot()
 
     async def __call__(self, scope, receive, send):  #ASGI application callable interface
-        print("JWTAuthMiddleware scope before auth:", scope)
-
-        from django.contrib.auth.models import AnonymousUser 
-        from rest_framework_simplejwt.tokens import AccessToken  
-
         query_string = parse_qs(scope['query_string'].decode()) #scope['query_string'] is byte string then converted to normal string
         token = query_string.get('token') #get token from query string
 
-        if token:   
-            try:
-                access_token = AccessToken(token[0]) 
-                user_id = access_token["user_id"]
-                scope["user"] = await get_user(user_id)
-            except Exception as e:
-                print("JWTAuthMiddleware error:", e)
-                scope["user"] = AnonymousUser()
-        else:
-            scope["user"] = AnonymousUser()
-
+        scope = dict(scope, user=await self.authenticate(token[0]) if token else AnonymousUser())
         return await self.inner(scope, receive, send)
+
+    async def authenticate(self, raw_token):
+        try:
+            token = AccessToken(raw_token)   # signature and expiry, no database
+        except TokenError:
+            return AnonymousUser()
+
+        if await self.revocations.is_revoked(token):
+            return AnonymousUser()
+
+        if "username" in token:
+            return ClaimsUser(token)
+
+        user = await self.users.get(token[api_settings.USER_ID_CLAIM])
+        if not user.is_active:
+            return AnonymousUser()
+        return user
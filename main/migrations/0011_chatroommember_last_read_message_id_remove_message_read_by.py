@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+
+def backfill_read_watermarks(apps, schema_editor):
+    # the highest message each member has in its read_by list becomes the member's watermark
+    Message = apps.get_model('main', 'Message')
+    ChatRoomMember = apps.get_model('main', 'ChatRoomMember')
+
+    watermarks = {}
+    for message_id, room_id, read_by in Message.objects.values_list('id', 'room_id', 'read_by').iterator():
+        for user_id in read_by or []:
+            key = (room_id, user_id)
+            if message_id > watermarks.get(key, 0):
+                watermarks[key] = message_id
+
+    members = []
+    for member in ChatRoomMember.objects.only('id', 'room_id', 'user_id').iterator():
+        watermark = watermarks.get((member.room_id, member.user_id))
+        if watermark:
+            member.last_read_message_id = watermark
+            members.append(member)
+
+    ChatRoomMember.objects.bulk_update(members, ['last_read_message_id'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_chatroom_private_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroommember',
+            name='last_read_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_read_watermarks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='read_by',
+        ),
+    ]
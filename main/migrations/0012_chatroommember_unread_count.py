@@ -0,0 +1,34 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_unread_counts(apps, schema_editor):
+    Message = apps.get_model('main', 'Message')
+    ChatRoomMember = apps.get_model('main', 'ChatRoomMember')
+
+    unread = (
+        Message.objects.filter(room=OuterRef('room'), id__gt=OuterRef('last_read_message_id'))
+        .exclude(sender=OuterRef('user'))
+        .order_by()
+        .values('room')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    ChatRoomMember.objects.update(unread_count=Coalesce(Subquery(unread), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_chatroommember_last_read_message_id_remove_message_read_by'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroommember',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_unread_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:09
+
+from collections import defaultdict
+from itertools import islice
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+
+
+def assign_other_users(ChatRoomMember):
+    # a copy of main.inbox.assign_other_users as of this migration, on the historical model;
+    # read in Python and written with bulk_update, MySQL rejects an UPDATE of chatroommember
+    # whose subquery reads chatroommember (error 1093)
+    private = ChatRoomMember.objects.filter(room__is_group=False).only('id', 'room_id', 'user_id').iterator(chunk_size=1000)
+    while batch := list(islice(private, 1000)):
+        participants = defaultdict(list)
+        for room_id, user_id in ChatRoomMember.objects.filter(room_id__in={member.room_id for member in batch}).values_list('room_id', 'user_id'):
+            participants[room_id].append(user_id)
+
+        for member in batch:
+            member.other_user_id = next((user_id for user_id in participants[member.room_id] if user_id != member.user_id), None)
+        ChatRoomMember.objects.bulk_update(batch, ['other_user'])
+
+
+def backfill_conversations(apps, schema_editor):
+    Message = apps.get_model('main', 'Message')
+    ChatRoomMember = apps.get_model('main', 'ChatRoomMember')
+
+    last_message = Message.objects.filter(room=OuterRef('room')).order_by('-id')
+
+    ChatRoomMember.objects.update(
+        last_message=Subquery(last_message.values('id')[:1]),
+        last_message_preview=Coalesce(
+            Subquery(last_message.annotate(preview=Substr('message', 1, 100)).values('preview')[:1]),
+            Value('')
+        ),
+        last_activity_at=Subquery(last_message.values('created_at')[:1]),
+    )
+    assign_other_users(ChatRoomMember)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_chatroommember_unread_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroommember',
+            name='last_activity_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroommember',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main.message'),
+        ),
+        migrations.AddField(
+            model_name='chatroommember',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chatroommember',
+            name='other_user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='chatroommember',
+            index=models.Index(fields=['user', '-last_activity_at'], name='member_inbox_idx'),
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
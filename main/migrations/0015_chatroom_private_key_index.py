@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_message_room_history_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatroom',
+            name='private_key',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+    ]
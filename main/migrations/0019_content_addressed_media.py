@@ -0,0 +1,45 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:25
+
+import main.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_message_thumbnails'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('sha256', models.CharField(db_index=True, max_length=64)),
+                ('size', models.BigIntegerField()),
+                ('refcount', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='blob',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='document',
+            field=models.FileField(blank=True, null=True, storage=main.storage.media_storage, upload_to='documents/'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='image',
+            field=models.FileField(blank=True, null=True, storage=main.storage.media_storage, upload_to='images/'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:28
+
+import re
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+WORD_RE = re.compile(r"[^\W_]+")
+
+
+def normalize(value):
+    return " ".join((value or "").lower().split())
+
+
+def search_terms(username, full_name, email):
+    # a copy of main.search.search_terms as of this migration: each field whole and each of its
+    # words, lower case, weighted username 3, full name 2, email 1
+    email = normalize(email)
+    fields = (
+        (normalize(username), normalize(username), 3),
+        (normalize(full_name), normalize(full_name), 2),
+        (email, email.split("@")[0], 1),
+    )
+
+    terms = {}
+    for value, text, weight in fields:
+        for term in [value, *WORD_RE.findall(text)]:
+            term = term[:100]
+            if term and terms.get(term, 0) < weight:
+                terms[term] = weight
+    return terms.items()
+
+
+def backfill_search_terms(apps, schema_editor):
+    Profile = apps.get_model('main', 'Profile')
+    UserSearchTerm = apps.get_model('main', 'UserSearchTerm')
+
+    batch = []
+    for profile in Profile.objects.select_related('user').iterator():
+        user = profile.user
+        batch.extend(
+            UserSearchTerm(user_id=user.id, term=term, weight=weight)
+            for term, weight in search_terms(user.username, profile.full_name, user.email)
+        )
+        if len(batch) >= 1000:
+            UserSearchTerm.objects.bulk_create(batch)
+            batch = []
+    UserSearchTerm.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0019_content_addressed_media'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=100)),
+                ('weight', models.PositiveSmallIntegerField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'user'], name='user_search_term_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_search_terms, migrations.RunPython.noop),
+    ]
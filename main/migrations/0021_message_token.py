@@ -0,0 +1,58 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:31
+
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    # a copy of main.message_search.tokenize as of this migration: distinct lower case words of
+    # at least two characters, at most 40 long, 200 per message
+    tokens = {}
+    for word in WORD_RE.findall((text or "").lower()):
+        word = word[:40]
+        if len(word) >= 2 and word not in tokens:
+            tokens[word] = None
+            if len(tokens) >= 200:
+                break
+    return list(tokens)
+
+
+def backfill_message_tokens(apps, schema_editor):
+    Message = apps.get_model('main', 'Message')
+    MessageToken = apps.get_model('main', 'MessageToken')
+
+    batch = []
+    for message_id, room_id, text in Message.objects.exclude(message='').values_list('id', 'room_id', 'message').iterator():
+        batch.extend(MessageToken(token=token, room_id=room_id, message_id=message_id) for token in tokenize(text))
+        if len(batch) >= 5000:
+            MessageToken.objects.bulk_create(batch)
+            batch = []
+    MessageToken.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0020_user_search_term'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=40)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='main.message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main.chatroom')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['token', 'room', 'message'], name='message_token_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_message_tokens, migrations.RunPython.noop),
+    ]
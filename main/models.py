@@ -1,6 +1,10 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.db.models.signals import post_save
+
+from .storage import media_storage
 # Create your models here.
 
 class MyUserManager(BaseUserManager):
@@ -69,7 +73,7 @@ class ChatRoom(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='created_rooms', null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
-    private_key = models.CharField(max_length=255, blank=True, null=True)  # For private rooms, can be used for encryption keys
+    private_key = models.CharField(max_length=255, blank=True, null=True, db_index=True)  # For private rooms, can be used for encryption keys; looked up by GetOrCreatePrivateRoomView
 
     def __str__(self):
         return self.group_name if self.is_group else f"Private Room {self.id}"
@@ -80,22 +84,100 @@ class ChatRoomMember(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='members')   # which room the user belongs to
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     joined_at = models.DateTimeField(auto_now_add=True)
+    last_read_message_id = models.BigIntegerField(default=0)   # read watermark: every message in the room up to this id is read by the user
+    unread_count = models.PositiveIntegerField(default=0)   # messages from others after the watermark, kept up to date on send and read
+
+    # conversation summary shown in the user's inbox, maintained on send
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, related_name='+', null=True, blank=True)
+    last_message_preview = models.CharField(max_length=100, blank=True)
+    last_activity_at = models.DateTimeField(null=True, blank=True)
+    other_user = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='+', null=True, blank=True)  # the other participant of a private room
 
     class Meta:
         unique_together = ('room', 'user')
+        indexes = [
+            models.Index(fields=['user', '-last_activity_at'], name='member_inbox_idx'),   # inbox ordered by last activity
+        ]
 
 
 class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')  # which room the message belongs to
     sender = models.ForeignKey(User, on_delete=models.CASCADE)      # who sent the message 
     message = models.TextField()
-    image = models.FileField(upload_to='images/', null=True, blank=True)
-    document = models.FileField(upload_to='documents/', null=True, blank=True)
-    read_by = models.JSONField(default=list)  
+    image = models.FileField(upload_to='images/', storage=media_storage, null=True, blank=True)
+    document = models.FileField(upload_to='documents/', storage=media_storage, null=True, blank=True)
+    thumbnails = models.JSONField(default=dict, blank=True)     # size label -> storage name, filled in the background
+    client_id = models.CharField(max_length=64, null=True, blank=True)   # idempotency key chosen by the sending client
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['room', 'created_at', 'id'], name='message_room_history_idx'),  # keyset pagination of room history
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'client_id'], name='message_sender_client_id_uniq'),  # a retried send is stored once
+        ]
+
+    def __str__(self):
+        return f"Message from {self.sender.username} in {self.room.group_name}"     # show sender and room info
+
+class UploadSession(models.Model):
+    KIND_CHOICES = [('image', 'Image'), ('document', 'Document')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)   # upload token handed to the client
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='uploads')
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploads')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)    # Message field the file ends up in
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()                 # total bytes announced at initiate
+    offset = models.BigIntegerField(default=0)      # bytes received so far
+    sha256 = models.CharField(max_length=64, blank=True)    # optional, announced by the client and checked at finalize
+    blob = models.CharField(max_length=255, blank=True)     # existing blob with the same content, nothing to upload
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload {self.filename} by {self.uploader.username} ({self.offset}/{self.size})"
+
+
+class StoredBlob(models.Model):
+    name = models.CharField(max_length=255, unique=True)    # storage name under blobs/
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField()
+    refcount = models.IntegerField(default=0)       # messages whose image or document is this blob
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} references)"
+
+
+class UserSearchTerm(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=100)     # lower case word or whole value, matched by prefix
+    weight = models.PositiveSmallIntegerField()     # which field the term comes from, higher ranks first
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'user'], name='user_search_term_idx'),  # prefix range scans
+        ]
+
+    def __str__(self):
+        return f"{self.term} -> {self.user_id}"
+
+
+class MessageToken(models.Model):
+    """
+    Inverted index of message text: one row per distinct word of a message
+    """
+    token = models.CharField(max_length=40)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='+')   # copied from the message so a room's postings are contiguous
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='tokens')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['token', 'room', 'message'], name='message_token_idx'),  # postings per room, newest last
+        ]
 
     def __str__(self):
-        return f"Message from {self.sender.username} in {self.room.group_name}"     # show sender and room info
\ No newline at end of file
+        return f"{self.token} -> {self.message_id}"
@@ -0,0 +1,172 @@
+import asyncio
+import time
+import weakref
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import ChatRoomMember
+from .room_cache import get_room_info
+
+PRESENCE_TTL = getattr(settings, "CHAT_PRESENCE_TTL", 75)                  # seconds without heartbeat before a user counts as gone
+HEARTBEAT_INTERVAL = getattr(settings, "CHAT_PRESENCE_HEARTBEAT", 25)     # seconds between client heartbeats
+PRESENCE_DEBOUNCE = getattr(settings, "CHAT_PRESENCE_DEBOUNCE", 2.0)      # seconds changes are collected before fan-out
+LAST_SEEN_TIMEOUT = getattr(settings, "CHAT_PRESENCE_LAST_SEEN_TIMEOUT", 30 * 24 * 3600)
+
+MAX_PRESENCE_IDS = 500
+
+
+def seen_key(user_id):
+    return f"presence:seen:{user_id}"
+
+
+def connections_key(user_id):
+    return f"presence:conns:{user_id}"
+
+
+def announced_key(user_id):
+    return f"presence:announced:{user_id}"
+
+
+def is_fresh(seen, now=None):
+    return seen is not None and (now or time.time()) - seen <= PRESENCE_TTL
+
+
+def user_connected(user_id):
+    """
+    Count a new socket of the user, True when the user was offline before it
+    """
+    now = time.time()
+    seen = cache.get(seen_key(user_id))
+    if not is_fresh(seen, now):
+        cache.set(connections_key(user_id), 0, LAST_SEEN_TIMEOUT)   # connections left behind by a crashed server
+    else:
+        cache.add(connections_key(user_id), 0, LAST_SEEN_TIMEOUT)
+
+    count = cache.incr(connections_key(user_id))
+    cache.set(seen_key(user_id), now, LAST_SEEN_TIMEOUT)
+    return count == 1
+
+
+def user_heartbeat(user_id):
+    """
+    Keep the user online, True when the user was counted offline (count lost to a concurrent reset)
+    """
+    cache.set(seen_key(user_id), time.time(), LAST_SEEN_TIMEOUT)
+    if not cache.get(connections_key(user_id)):
+        cache.set(connections_key(user_id), 1, LAST_SEEN_TIMEOUT)
+        return True
+    return False
+
+
+def user_disconnected(user_id):
+    """
+    Drop a socket of the user, True when it was the last one
+    """
+    try:
+        count = cache.decr(connections_key(user_id))
+    except ValueError:  # expired or never counted
+        count = 0
+    if count <= 0:
+        cache.set(connections_key(user_id), 0, LAST_SEEN_TIMEOUT)
+    cache.set(seen_key(user_id), time.time(), LAST_SEEN_TIMEOUT)
+    return count <= 0
+
+
+def get_presence(user_ids):
+    """
+    {user_id: {"id", "online", "last_seen"}} from one multi-key cache read, no database work.
+    A user is online while one of their sockets is counted and heartbeats are fresh;
+    last_seen is the last heartbeat or disconnect, None when unknown.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    keys = [seen_key(user_id) for user_id in user_ids] + [connections_key(user_id) for user_id in user_ids]
+    values = cache.get_many(keys)
+    now = time.time()
+
+    presence = {}
+    for user_id in user_ids:
+        seen = values.get(seen_key(user_id))
+        presence[user_id] = {
+            "id": user_id,
+            "online": bool(values.get(connections_key(user_id))) and is_fresh(seen, now),
+            "last_seen": datetime.fromtimestamp(seen, dt_timezone.utc).isoformat() if seen else None,
+        }
+    return presence
+
+
+def contacts_of(user_ids):
+    """
+    {contact_id: [user ids]}: members of the rooms of each user, from the room cache
+    """
+    contacts = defaultdict(set)
+    for room_id, user_id in ChatRoomMember.objects.filter(user_id__in=user_ids).values_list("room_id", "user_id"):
+        room = get_room_info(room_id)
+        for member_id in room.member_ids if room else ():
+            if member_id != user_id:
+                contacts[member_id].add(user_id)
+    return {contact_id: sorted(ids) for contact_id, ids in contacts.items()}
+
+
+class PresenceFanout:
+    """
+    Presence changes of the sockets served by one event loop. Changed users are collected for
+    PRESENCE_DEBOUNCE seconds, compared with the state last announced (shared through the cache,
+    so a user who reconnects within the window is not announced at all), and every contact gets
+    one "presence" event listing all changes that concern them.
+    """
+
+    def __init__(self):
+        self.changed = set()
+        self.task = None
+
+    def mark(self, user_id):
+        self.changed.add(user_id)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(PRESENCE_DEBOUNCE)
+        await self.flush()
+
+    async def flush(self):
+        user_ids, self.changed = self.changed, set()
+        if not user_ids:
+            return
+
+        presence = get_presence(user_ids)
+        announced = cache.get_many([announced_key(user_id) for user_id in user_ids])
+        changes = {
+            user_id: state for user_id, state in presence.items()
+            if announced.get(announced_key(user_id), False) != state["online"]
+        }
+        if not changes:
+            return
+        cache.set_many({announced_key(user_id): state["online"] for user_id, state in changes.items()}, LAST_SEEN_TIMEOUT)
+
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        for contact_id, ids in (await database_sync_to_async(contacts_of)(list(changes))).items():
+            await channel_layer.group_send(f"user_{contact_id}", {
+                "type": "presence",
+                "users": [changes[user_id] for user_id in ids],
+            })
+
+
+_fanouts = weakref.WeakKeyDictionary()
+
+
+def get_presence_fanout():
+    """
+    Fan-out of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    fanout = _fanouts.get(loop)
+    if fanout is None:
+        fanout = _fanouts[loop] = PresenceFanout()
+    return fanout
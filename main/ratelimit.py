@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+from .cache_io import cache_io
+from .room_cache import get_room_info
+
+# (burst, tokens per second) of each bucket
+SEND_BUDGETS = getattr(settings, "CHAT_SEND_BUDGETS", {
+    "private": (20, 1.0),   # messages a user sends to 1:1 rooms
+    "group": (10, 0.5),     # messages a user sends to group rooms, each one fans out to every member
+    "room": (30, 2.0),      # messages all members together send to one group room
+})
+SOCKET_FRAME_BUDGET = getattr(settings, "CHAT_SOCKET_FRAME_BUDGET", (60, 20.0))    # inbound frames of one socket, any type
+RATE_LIMIT_BACKEND = getattr(settings, "CHAT_RATE_LIMIT_BACKEND", "local")          # or "cache", shared by all processes
+LOCAL_MAX_BUCKETS = 10000     # in-process buckets kept, least recently used ones are dropped first
+EVICT_EXPIRED = 2             # expired buckets dropped per write beyond the ones it adds
+
+
+class TokenBucket:
+    """
+    `burst` tokens refilled at `rate` per second. The state is (tokens, timestamp) and is only
+    brought up to date when the bucket is used, so checking a bucket is O(1) whatever the traffic.
+    """
+
+    def __init__(self, burst, rate):
+        self.burst = burst
+        self.rate = rate
+
+    def refill(self, state, now):
+        if state is None:
+            return float(self.burst)
+        tokens, stamp = state
+        return min(self.burst, tokens + (now - stamp) * self.rate)
+
+    def wait(self, tokens):
+        """
+        Seconds until one token is available
+        """
+        return max(0.0, (1 - tokens) / self.rate)
+
+    def idle_timeout(self):
+        """
+        Seconds after which an unused bucket is full again and can be forgotten
+        """
+        return self.burst / self.rate + 1
+
+
+class LocalBuckets:
+    """
+    Bucket states of this process. Limits hold per worker: with N workers a user gets N budgets.
+    Kept least recently used first; each write drops a few buckets from that end, the expired
+    ones (full again, they limit nothing) and any over LOCAL_MAX_BUCKETS.
+    """
+
+    def __init__(self):
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        return {key: self.states[key][0] for key in keys if key in self.states}
+
+    def set_many(self, states, timeout):
+        now = time.monotonic()
+        for key, state in states.items():
+            self.states[key] = (state, now + timeout)
+            self.states.move_to_end(key)
+
+        for _ in range(len(states) + EVICT_EXPIRED):
+            if not self.states:
+                break
+            key, (_, expires) = next(iter(self.states.items()))
+            if expires > now and len(self.states) <= LOCAL_MAX_BUCKETS:
+                break
+            del self.states[key]
+
+
+class CacheBuckets:
+    """
+    Bucket states in the Django cache, shared by every process using it. Read and write are
+    not atomic, concurrent sends of one user can get a few more messages through than the burst.
+    They are not locked either: a lock would only serialize this process's cache round trips.
+    """
+
+    lock = nullcontext()
+
+    def get_many(self, keys):
+        return cache.get_many(keys)
+
+    def set_many(self, states, timeout):
+        cache.set_many(states, timeout)
+
+
+_backends = {"local": LocalBuckets, "cache": CacheBuckets}
+_buckets = None
+
+
+def get_buckets():
+    global _buckets
+    if _buckets is None:
+        _buckets = _backends[RATE_LIMIT_BACKEND]()
+    return _buckets
+
+
+def take(budgets):
+    """
+    Take one token from every (key, TokenBucket) or from none of them; returns 0 when allowed,
+    otherwise the seconds until all of them have a token again.
+    """
+    buckets = get_buckets()
+    now = time.time()
+    with buckets.lock:
+        states = buckets.get_many([key for key, _ in budgets])
+        tokens = {key: bucket.refill(states.get(key), now) for key, bucket in budgets}
+
+        wait = max(bucket.wait(tokens[key]) for key, bucket in budgets)
+        if wait > 0:
+            return wait
+
+        timeout = max(bucket.idle_timeout() for _, bucket in budgets)
+        buckets.set_many({key: (tokens[key] - 1, now) for key, _ in budgets}, timeout)
+    return 0
+
+
+def send_budgets(user_id, room_id, is_group):
+    """
+    Buckets a message of the user to the room is taken from: the user's private or group budget,
+    and for group rooms the budget of the room shared by all its members.
+    """
+    if not is_group:
+        return [(f"ratelimit:private:{user_id}", TokenBucket(*SEND_BUDGETS["private"]))]
+    return [
+        (f"ratelimit:group:{user_id}", TokenBucket(*SEND_BUDGETS["group"])),
+        (f"ratelimit:room:{room_id}", TokenBucket(*SEND_BUDGETS["room"])),
+    ]
+
+
+def check_send(user_id, room_id, is_group):
+    """
+    Seconds the user has to wait before sending to the room, 0 when the message may go out
+    """
+    return take(send_budgets(user_id, room_id, is_group))
+
+
+async def acheck_send(user_id, room_id, is_group):
+    """
+    check_send for the socket consumer: in-process buckets are checked inline, the cache
+    backend's round trips are made off the event loop
+    """
+    if isinstance(get_buckets(), LocalBuckets):
+        return check_send(user_id, room_id, is_group)
+    return await cache_io(check_send, user_id, room_id, is_group)
+
+
+class MessageSendThrottle(BaseThrottle):
+    """
+    Send budgets for the HTTP message and upload views, keyed by the room_id URL argument.
+    Runs before the view, unknown rooms are left to the membership check.
+    """
+
+    def allow_request(self, request, view):
+        self.retry_after = 0
+        room = get_room_info(view.kwargs.get("room_id"))
+        if room is None or request.user.id not in room.member_ids:
+            return True     # rejected by the view, without spending the room's budget
+        self.retry_after = check_send(request.user.id, view.kwargs["room_id"], room.is_group)
+        return self.retry_after == 0
+
+    def wait(self):
+        return self.retry_after
@@ -0,0 +1,86 @@
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import ChatRoom, ChatRoomMember
+
+
+RoomInfo = namedtuple("RoomInfo", ["name", "is_group", "member_ids"])   # member_ids is a tuple of user ids
+
+ROOM_CACHE_TIMEOUT = getattr(settings, "ROOM_CACHE_TIMEOUT", 60 * 60)
+
+
+def room_cache_key(room_id):
+    return f"room_info:{room_id}"
+
+
+def room_version_key(room_id):
+    return f"room_info_version:{room_id}"
+
+
+def new_version():
+    return uuid.uuid4().hex[:8]
+
+
+def load_room_info(room_id):
+    """
+    Build room metadata from the database (two queries), or None if the room does not exist
+    """
+    room = ChatRoom.objects.filter(id=room_id).only("group_name", "is_group").first()
+    if room is None:
+        return None
+
+    members = list(
+        ChatRoomMember.objects.filter(room_id=room_id)
+        .order_by("id")
+        .values_list("user_id", "user__username")
+    )
+    member_ids = tuple(user_id for user_id, _ in members)
+    room_name = room.group_name if room.is_group else " & ".join(username for _, username in members)
+    return RoomInfo(room_name, room.is_group, member_ids)
+
+
+def read_cached(room_id):
+    """
+    (room info or None when missing or outdated, current version of the room)
+    """
+    values = cache.get_many([room_cache_key(room_id), room_version_key(room_id)])
+    entry, version = values.get(room_cache_key(room_id)), values.get(room_version_key(room_id))
+    if entry is not None and version is not None and entry[0] == version:
+        return entry[1], version
+    return None, version
+
+
+def get_room_info(room_id):
+    """
+    Cached room name and member ids; only the first lookup after an invalidation hits the database.
+    Entries carry the room version read before loading them: a membership change committed
+    while a lookup was loading changes the version, so the stale entry it writes is never served.
+    """
+    info, version = read_cached(room_id)
+    if info is not None:
+        return info
+
+    if version is None:
+        cache.add(room_version_key(room_id), new_version(), ROOM_CACHE_TIMEOUT)
+        version = cache.get(room_version_key(room_id))
+
+    info = load_room_info(room_id)
+    if info is not None:
+        cache.set(room_cache_key(room_id), (version, info), ROOM_CACHE_TIMEOUT)
+    return info
+
+
+def cached_room_info(room_id):
+    """
+    Cache-only lookup, returns None on a miss instead of querying. Does cache I/O: async code
+    calls it through cache_io.
+    """
+    return read_cached(room_id)[0]
+
+
+def invalidate_room(room_id):
+    cache.set(room_version_key(room_id), new_version(), ROOM_CACHE_TIMEOUT)
+    cache.delete(room_cache_key(room_id))
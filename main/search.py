@@ -0,0 +1,81 @@
+import re
+
+from django.db.models import Case, F, IntegerField, Max, When
+
+from .models import Profile, UserSearchTerm
+
+TERM_LENGTH = UserSearchTerm._meta.get_field('term').max_length
+
+USERNAME_WEIGHT = 3
+FULL_NAME_WEIGHT = 2
+EMAIL_WEIGHT = 1
+EXACT_BONUS = 10    # a term equal to the query ranks above every prefix match
+
+WORD_RE = re.compile(r"[^\W_]+")
+
+
+def normalize(value):
+    return " ".join((value or "").lower().split())
+
+
+def search_terms(username, full_name, email):
+    """
+    (term, weight) pairs for a user: each field whole and each of its words, lower case
+    """
+    email = normalize(email)
+    fields = (
+        (normalize(username), normalize(username), USERNAME_WEIGHT),
+        (normalize(full_name), normalize(full_name), FULL_NAME_WEIGHT),
+        (email, email.split("@")[0], EMAIL_WEIGHT),     # the domain is shared by too many users to be a useful word
+    )
+
+    terms = {}
+    for value, text, weight in fields:
+        for term in [value, *WORD_RE.findall(text)]:
+            term = term[:TERM_LENGTH]
+            if term and terms.get(term, 0) < weight:
+                terms[term] = weight
+    return terms.items()
+
+
+def index_user(user, full_name):
+    """
+    Replace the search terms of a user; a save that changes none of the fields (login) is one read
+    """
+    terms = set(search_terms(user.username, full_name, user.email))
+    if set(UserSearchTerm.objects.filter(user=user).values_list('term', 'weight')) == terms:
+        return
+
+    UserSearchTerm.objects.filter(user=user).delete()
+    UserSearchTerm.objects.bulk_create([UserSearchTerm(user=user, term=term, weight=weight) for term, weight in terms])
+
+
+def prefix_range(prefix):
+    """
+    [prefix, upper) such that every string starting with prefix is inside; an index range scan
+    on any backend, where LIKE 'prefix%' is not with case insensitive SQLite LIKE
+    """
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def search_users(query, exclude_user=None):
+    """
+    Profiles whose username, full name or email (or a word of them) starts with the query,
+    best match first: exact before prefix, username before full name before email
+    """
+    query = normalize(query)[:TERM_LENGTH]
+    if not query:
+        return Profile.objects.none()
+
+    low, high = prefix_range(query)
+    profiles = Profile.objects.filter(user__search_terms__term__gte=low, user__search_terms__term__lt=high)
+    if exclude_user is not None:
+        profiles = profiles.exclude(user=exclude_user)
+
+    return profiles.annotate(
+        score=Max(Case(
+            When(user__search_terms__term=query, then=F('user__search_terms__weight') + EXACT_BONUS),
+            default=F('user__search_terms__weight'),
+            output_field=IntegerField()
+        ))
+    ).select_related('user').order_by('-score', 'user__username', 'id')
@@ -1,7 +1,9 @@
-from .models import ChatRoom, Message, User, Profile
+from .models import ChatRoom, ChatRoomMember, Message, User, Profile
 from django.contrib.auth.password_validation import validate_password
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework import serializers
+from .thumbnails import thumbnail_urls
+from .message_search import highlight
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -55,20 +57,30 @@ class GroupSerializer(serializers.ModelSerializer):
         fields = ['id', 'group_name', 'is_group', 'created_at']
 
 
+class MessageListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        messages = list(data.all() if hasattr(data, 'all') else data)
+        self.child.prefetch_rooms({message.room_id for message in messages})   # room lookups for the whole page at once
+        return super().to_representation(messages)
+
+
 class MessageSerializer(serializers.ModelSerializer):
     sender_username = serializers.CharField(
     source="sender.username",
     read_only=True
     )
-    room_id = serializers.IntegerField(source="room.id", read_only=True)
+    room_id = serializers.IntegerField(read_only=True)
     message = serializers.CharField(required=False, allow_blank=True)
 
     other_user = serializers.SerializerMethodField()
     image_url = serializers.SerializerMethodField()
     document_url = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
+    read_by = serializers.SerializerMethodField()
     unread_count = serializers.SerializerMethodField()
     class Meta:
         model = Message
+        list_serializer_class = MessageListSerializer
         fields = [
             'id',
             'room',
@@ -79,6 +91,7 @@ class MessageSerializer(serializers.ModelSerializer):
             'document',
             'image_url',
             'document_url',
+            'thumbnails',
             'sender_username',
             'message',
             'read_by',
@@ -91,7 +104,9 @@ class MessageSerializer(serializers.ModelSerializer):
             'created_at',
             'room_id',
             'sender_username',
-            'other_user'
+            'other_user',
+            'thumbnails',
+            'read_by'
         ]
         extra_kwargs = {
             "image": {"required": False, "allow_null": True},
@@ -99,40 +114,64 @@ class MessageSerializer(serializers.ModelSerializer):
         }
        
 
-    def get_other_user(self, obj):
+    def prefetch_rooms(self, room_ids):
+        """
+        Load the caller's membership row (other participant, unread counter) and every member's
+        read watermark for the given rooms, two queries whatever the number of rooms
+        """
+        memberships = self.context.setdefault('_memberships', {})
+        watermarks = self.context.setdefault('_read_watermarks', {})
+        room_ids = [room_id for room_id in room_ids if room_id not in memberships]
+        if not room_ids:
+            return
+
+        for room_id in room_ids:
+            memberships[room_id] = None
+            watermarks[room_id] = {}
+
         request = self.context.get('request')
-        if not request:
-            return None
-        
-        current_user = request.user
-        room = obj.room   # Get the chat room of the message
+        if request and request.user.is_authenticated:
+            for member in (ChatRoomMember.objects.filter(room_id__in=room_ids, user=request.user)
+                           .select_related('other_user')
+                           .only('room_id', 'unread_count', 'other_user__id', 'other_user__username')):
+                memberships[member.room_id] = member
 
-        if room.is_group:
+        for room_id, user_id, last_read in ChatRoomMember.objects.filter(room_id__in=room_ids).values_list(
+                'room_id', 'user_id', 'last_read_message_id'):
+            watermarks[room_id][user_id] = last_read
+
+    def get_membership(self, room_id):
+        self.prefetch_rooms([room_id])
+        return self.context['_memberships'][room_id]
+
+    def get_read_watermarks(self, room_id):
+        """
+        {user_id: last_read_message_id} for every member of the room
+        """
+        self.prefetch_rooms([room_id])
+        return self.context['_read_watermarks'][room_id]
+
+    def get_other_user(self, obj):
+        membership = self.get_membership(obj.room_id)
+
+        if membership is None or membership.other_user is None:   # group rooms have no other participant
             return None
-        
-        member = room.members.exclude(user=current_user).select_related('user').first()   # get the other member of the room 
 
-        if member:
-            return {
-                'id': member.user.id,
-                'username': member.user.username
-            }
-        return None
-    
+        return {
+            'id': membership.other_user.id,
+            'username': membership.other_user.username
+        }
+
+    def get_read_by(self, obj):
+        watermarks = self.get_read_watermarks(obj.room_id)
+        return sorted(
+            user_id for user_id, last_read in watermarks.items()
+            if last_read >= obj.id and user_id != obj.sender_id
+        )    # users whose watermark has passed this message
 
     def get_unread_count(self, obj):
-        request = self.context.get('request')
-        
-        user = request.user
-        if not request or not user.is_authenticated:
-            return 0
-        
-        return (Message.objects.filter(
-            room=obj.room,
-        ).exclude(sender=user
-        ).exclude(read_by__contains=[user.id]
-        ).count()
-        )     # count of unread messages for the user in the room
+        membership = self.get_membership(obj.room_id)
+        return membership.unread_count if membership else 0     # precomputed counter on the user's membership row
 
     def get_image_url(self, obj):
         
@@ -148,6 +187,12 @@ class MessageSerializer(serializers.ModelSerializer):
         if obj.document and request:
             return request.build_absolute_uri(obj.document.url)
         return None
+
+    def get_thumbnails(self, obj):
+        request = self.context.get('request')
+        if not request:
+            return {}
+        return {label: request.build_absolute_uri(url) for label, url in thumbnail_urls(obj).items()}
         
     def validate(self, attrs):
         message = attrs.get('message', '').strip()
@@ -159,6 +204,85 @@ class MessageSerializer(serializers.ModelSerializer):
         attrs["message"] = message
         return attrs
 
+
+class MessageSearchSerializer(MessageSerializer):
+    snippet = serializers.SerializerMethodField()
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['snippet']
+
+    def get_snippet(self, obj):
+        return highlight(obj.message, self.context.get('search_terms', []))   # escaped HTML, matches in <mark>
+
+
+
+class InboxSerializer(serializers.ModelSerializer):
+    """
+    One inbox row per conversation, read from the summary kept on the user's ChatRoomMember row
+    """
+    id = serializers.IntegerField(source="last_message_id", read_only=True)
+    room_id = serializers.IntegerField(read_only=True)
+    sender = serializers.IntegerField(source="last_message.sender_id", read_only=True)
+    sender_username = serializers.CharField(source="last_message.sender.username", read_only=True)
+    other_user = serializers.SerializerMethodField()
+    image = serializers.FileField(source="last_message.image", read_only=True)
+    document = serializers.FileField(source="last_message.document", read_only=True)
+    image_url = serializers.SerializerMethodField()
+    document_url = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
+    message = serializers.CharField(source="last_message_preview", read_only=True)
+    created_at = serializers.DateTimeField(source="last_activity_at", read_only=True)
+    is_group = serializers.BooleanField(source="room.is_group", read_only=True)
+    group_name = serializers.CharField(source="room.group_name", read_only=True)
+
+    class Meta:
+        model = ChatRoomMember
+        fields = [
+            'id',
+            'room',
+            'room_id',
+            'sender',
+            'other_user',
+            'image',
+            'document',
+            'image_url',
+            'document_url',
+            'thumbnails',
+            'sender_username',
+            'message',
+            'created_at',
+            'unread_count',
+            'is_group',
+            'group_name'
+        ]
+        read_only_fields = fields
+
+    def get_other_user(self, obj):
+        if obj.other_user is None:
+            return None
+        return {
+            'id': obj.other_user.id,
+            'username': obj.other_user.username
+        }
+
+    def get_image_url(self, obj):
+        request = self.context.get('request')
+        if obj.last_message.image and request:
+            return request.build_absolute_uri(obj.last_message.image.url)
+        return None
+
+    def get_document_url(self, obj):
+        request = self.context.get('request')
+        if obj.last_message.document and request:
+            return request.build_absolute_uri(obj.last_message.document.url)
+        return None
+
+    def get_thumbnails(self, obj):
+        request = self.context.get('request')
+        if not request:
+            return {}
+        return {label: request.build_absolute_uri(url) for label, url in thumbnail_urls(obj.last_message).items()}
+
     
 class GroupAddMemberSerializer(serializers.ModelSerializer):
     is_creator = serializers.SerializerMethodField()
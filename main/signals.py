@@ -0,0 +1,174 @@
+import functools
+
+import ujson
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.db.models import F, Q
+from django.utils import timezone
+from django.dispatch import receiver
+
+from .delivery import record_event
+from .inbox import mark_room_read, rebuild_conversations, record_messages
+from .message_search import index_messages
+from .models import ChatRoom, ChatRoomMember, Message, Profile, StoredBlob
+from .storage import blob_digest, is_blob, signed_media_url
+from .room_cache import invalidate_room
+from .search import index_user
+
+
+def room_group_name(room_id):
+    return f"room_{room_id}"
+
+
+def message_payload(message, sender_username):
+    return {
+        "id": message.id,
+        "client_id": message.client_id,
+        "room_id": message.room_id,
+        "sender_id": message.sender_id,
+        "sender_username": sender_username,
+        "message": message.message,
+        "image_url": message.image.url if message.image else None,
+        "document_url": message.document.url if message.document else None,
+        "thumbnails": {label: signed_media_url(name) for label, name in (message.thumbnails or {}).items()},
+        "created_at": message.created_at.isoformat(),
+    }    #Return message payload as a dictionary
+
+
+def chat_message_event(room, payload):
+    """
+    Room group event for a new message; the notification for other members is folded into it
+    """
+    return {
+        "type": "chat_message",
+        "payload": payload,
+        "room_id": payload["room_id"],
+        "room_name": room.name,
+        "is_group": len(room.member_ids) > 2,
+    }
+
+
+dump_frame = functools.partial(ujson.dumps, ensure_ascii=False, escape_forward_slashes=False)
+
+
+def message_frame(event):
+    """
+    Socket frame of a chat_message event
+    """
+    return {
+        **event["payload"],
+        "room_id": event["room_id"],
+        "room_name": event["room_name"],
+        "is_group": event["is_group"],
+    }
+
+
+def notification_frame(event):
+    """
+    Socket frame sent with a chat_message event to every member except the sender
+    """
+    payload = event["payload"]
+    return {
+        "type": "notification",
+        "room_id": event["room_id"],
+        "room_name": event["room_name"],
+        "sender_username": payload["sender_username"],
+        "message": payload["message"],
+    }
+
+
+def encode_chat_frames(event):
+    """
+    Add both frames of a chat_message event as JSON text, encoded once by the sender instead of
+    once per member; JSON sockets forward the text as it is
+    """
+    seq = {"seq": event["seq"]} if "seq" in event else {}
+    return {
+        **event,
+        "frame": dump_frame({**message_frame(event), **seq}),
+        "notification_frame": dump_frame({**notification_frame(event), **seq}),
+    }
+
+
+def notify_user(user_id, event):
+    """
+    Send an event to every open socket of a user once the current transaction commits
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    group_name = f"user_{user_id}"
+    transaction.on_commit(
+        lambda: async_to_sync(channel_layer.group_send)(group_name, record_event(group_name, event))
+    )
+
+
+def invalidate_room_on_commit(room_id):
+    transaction.on_commit(lambda: invalidate_room(room_id))
+
+
+@receiver(post_save, sender=ChatRoomMember)
+def member_joined(sender, instance, created, **kwargs):
+    if created:
+        invalidate_room_on_commit(instance.room_id)
+        if not instance.last_read_message_id:
+            # history from before joining is not unread: the watermark starts at the latest message
+            mark_room_read(instance.room_id, instance.user_id)
+        # the new member's inbox entry starts from the room's latest message; in a private room
+        # both rows are refreshed so each side points at the other participant
+        rebuild_conversations(ChatRoomMember.objects.filter(
+            Q(pk=instance.pk) | Q(room_id=instance.room_id, room__is_group=False)
+        ))
+        # connected sockets of the new member start listening to the room group
+        notify_user(instance.user_id, {"type": "room_join", "room_id": instance.room_id})
+
+
+@receiver(post_delete, sender=ChatRoomMember)
+def member_left(sender, instance, **kwargs):
+    invalidate_room_on_commit(instance.room_id)
+    notify_user(instance.user_id, {"type": "room_leave", "room_id": instance.room_id})
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def room_changed(sender, instance, **kwargs):   # rename or delete
+    invalidate_room_on_commit(instance.id)
+
+
+@receiver(post_save, sender=Message)
+def message_created(sender, instance, created, **kwargs):
+    if created:
+        record_messages(instance.room_id, [instance])
+        index_messages([instance])
+        reference_blobs(instance, 1)
+        if instance.image:
+            from .thumbnails import schedule_thumbnails   # thumbnails imports this module
+            schedule_thumbnails(instance)
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    reference_blobs(instance, -1)
+
+
+def reference_blobs(message, delta):
+    """
+    Count the message's attachments in or out of the shared blobs they point to
+    """
+    for file in (message.image, message.document):
+        if not is_blob(file.name):
+            continue
+        blob = StoredBlob.objects.filter(name=file.name)
+        if not blob.update(refcount=F("refcount") + delta, updated_at=timezone.now()) and delta > 0:
+            # first reference: create the row, then count it like the concurrent creators do
+            StoredBlob.objects.get_or_create(name=file.name, defaults={"sha256": blob_digest(file.name), "size": file.size})
+            blob.update(refcount=F("refcount") + delta, updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Profile)
+def profile_saved(sender, instance, **kwargs):
+    # every User save also saves the profile, so username and email changes land here too
+    index_user(instance.user, instance.full_name)
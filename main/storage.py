@@ -0,0 +1,169 @@
+import hashlib
+import os
+import tempfile
+import time
+from urllib.parse import quote
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from django.utils.deconstruct import deconstructible
+
+DEDUP_MEDIA = getattr(settings, "CHAT_MEDIA_DEDUP", True)   # store attachments by content hash
+BLOB_DIR = "blobs"
+HASH_READ_SIZE = 1024 * 1024
+
+URL_TTL = getattr(settings, "CHAT_MEDIA_URL_TTL", 3600)    # seconds; signed URLs live between one and two of these
+PROTECTED_PREFIXES = getattr(settings, "CHAT_MEDIA_PROTECTED_PREFIXES", ("images/", "documents/", "blobs/", "thumbs/"))
+
+
+def media_signature(name, expires):
+    return salted_hmac("main.media", f"{name}:{expires}").hexdigest()[:32]
+
+
+def is_protected(name):
+    return name.startswith(tuple(PROTECTED_PREFIXES))
+
+
+def signed_media_url(name):
+    """
+    URL of a room attachment. Attachment URLs are only handed out in API responses and socket
+    events that go to room members, so the signature carries the membership check to the media
+    server. Expiry is rounded to the TTL so the URL stays the same for a while and browsers can
+    cache the file.
+    """
+    expires = (int(time.time()) // URL_TTL + 2) * URL_TTL
+    return f"{settings.MEDIA_URL}{quote(name)}?exp={expires}&sig={media_signature(name, expires)}"
+
+
+def blob_name(digest, filename):
+    """
+    blobs/ab/cd/abcd...ef.pdf: the extension is kept so the file is served with the right type
+    """
+    extension = os.path.splitext(filename)[1].lower()[:16]
+    return f"{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(f"{BLOB_DIR}/")
+
+
+def blob_digest(name):
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+@deconstructible
+class AttachmentStorage(FileSystemStorage):
+    """
+    File system storage whose URLs are signed for the media server
+    """
+
+    def url(self, name):
+        if is_protected(name):
+            return signed_media_url(name)
+        return super().url(name)
+
+
+@deconstructible
+class ContentAddressedStorage(AttachmentStorage):
+    """
+    File system storage under MEDIA_ROOT that names files after the SHA-256 of their content,
+    so an attachment uploaded many times is stored once. The hash is computed while the upload
+    is copied to a temporary file next to the blobs; when the blob already exists the copy is
+    dropped. Files are never overwritten or deleted here: Message signals keep a reference count
+    in StoredBlob and `purge_blobs` removes unreferenced blobs after a grace period; an upload
+    reusing a blob touches it so the grace period starts again.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        return name     # the final name depends on the content, see _save
+
+    def _save(self, name, content):
+        temp_dir = self.path(BLOB_DIR)
+        os.makedirs(temp_dir, exist_ok=True)
+
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temp:
+                if hasattr(content, "seek"):
+                    content.seek(0)
+                for chunk in content.chunks(HASH_READ_SIZE):
+                    digest.update(chunk)
+                    temp.write(chunk)
+            return self.store_file(temp_path, name, digest.hexdigest())
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def store_file(self, path, filename, digest=None):
+        """
+        Move a complete local file into the blob tree, returns the blob name.
+        `path` is consumed: renamed into place, or removed when the blob already exists.
+        """
+        if digest is None:
+            digest = file_digest(path)
+
+        name = blob_name(digest, filename)
+        target = self.path(name)
+        if os.path.exists(target) and self.touch_blob(name):
+            os.unlink(path)     # duplicate: nothing written
+            return name
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(path, self.file_permissions_mode)
+        os.replace(path, target)    # same content under the same name, a concurrent writer is harmless
+        return name
+
+    def touch_blob(self, name):
+        """
+        Mark an existing blob as just used so purge_blobs keeps it until the new message
+        references it; False when a purge removed it meanwhile and the copy has to be stored
+        """
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            return False
+        apps.get_model("main", "StoredBlob").objects.filter(name=name).update(updated_at=timezone.now())
+        return True
+
+    def purge_blob(self, name, unused_since):
+        """
+        Delete a blob whose file was not touched after `unused_since` (a timestamp), True when
+        deleted. The file is moved aside before its time is checked: an upload reusing the blob
+        at the same moment either touched it before (kept) or finds it gone and stores its copy.
+        """
+        path = self.path(name)
+        aside = f"{path}.purge"
+        try:
+            os.replace(path, aside)
+        except FileNotFoundError:
+            return False
+        if os.path.getmtime(aside) > unused_since:
+            os.replace(aside, path)     # reused while the purge ran
+            return False
+        os.unlink(aside)
+        return True
+
+    def delete(self, name):
+        if not is_blob(name):
+            super().delete(name)
+        # blobs are shared, they are removed by purge_blobs once nothing references them
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(HASH_READ_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def media_storage():
+    """
+    Storage of Message attachments
+    """
+    return ContentAddressedStorage() if DEDUP_MEDIA else AttachmentStorage()
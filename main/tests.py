@@ -1,3 +1,1706 @@
-from django.test import TestCase
+import asyncio
+import functools
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+import msgpack
+from PIL import Image
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import urlsafe_base64_encode
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from . import consumers
+from .consumers import UserConsumer
+from .ingest import MessageIngestQueue
+from .media import MediaApplication
+from . import delivery
+from . import inbox
+from . import middleware
+from . import presence
+from . import ratelimit
+from .thumbnails import generate_thumbnails
+from .filecache import LocalFileCache
+from .layers import LocalSocketChannelLayer
+from .inbox import mark_room_read, rebuild_conversations
+from .message_search import highlight
+from .middleware import JWTAuthMiddleware
+from .models import ChatRoom, ChatRoomMember, Message, MessageToken, StoredBlob, User
+from .storage import blob_name, signed_media_url
+from . import room_cache
+from .room_cache import get_room_info, load_room_info
+from .views import MessageCursorPagination, get_tokens_for_user
+
+
+FAST_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class InboxQueryCountTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("owner@example.com", "owner", "pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_rooms(self, count):
+        for _ in range(count):
+            index = User.objects.count()
+            other = User.objects.create_user(f"user{index}@example.com", f"user{index}", "pass")
+            room = ChatRoom.objects.create(is_group=False, private_key=f"private_{self.user.id}_{other.id}")
+            ChatRoomMember.objects.create(room=room, user=self.user)
+            ChatRoomMember.objects.create(room=room, user=other)
+            Message.objects.create(room=room, sender=other, message="hello")
+
+        group = ChatRoom.objects.create(group_name="group", is_group=True, created_by=self.user)
+        ChatRoomMember.objects.create(room=group, user=self.user)
+        Message.objects.create(room=group, sender=self.user, message="hi all")
+
+    def count_inbox_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f"/api/messages/{self.user.id}/")
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def test_inbox_query_count_is_constant(self):
+        self.add_rooms(2)
+        few, _ = self.count_inbox_queries()
+
+        self.add_rooms(10)
+        many, data = self.count_inbox_queries()
+
+        self.assertEqual(few, many)
+        self.assertEqual(data["count"], 14)
+        private = [row for row in data["results"] if not row["is_group"]]
+        self.assertTrue(all(row["other_user"] and row["unread_count"] == 1 for row in private))
+
+    def test_unread_counter_counts_messages_after_joining(self):
+        self.add_rooms(1)
+        group = ChatRoom.objects.get(is_group=True)
+        other = User.objects.get(username="user1")
+        ChatRoomMember.objects.create(room=group, user=other)     # joins after "hi all"
+        member = ChatRoomMember.objects.get(room=group, user=other)
+        self.assertEqual(member.unread_count, 0)
+        self.assertEqual(member.last_read_message_id, Message.objects.get(room=group).id)
+
+        Message.objects.create(room=group, sender=self.user, message="welcome")
+        Message.objects.create(room=group, sender=other, message="thanks")   # own messages are not counted
+        member.refresh_from_db()
+        self.assertEqual(member.unread_count, 1)
+
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(f"/api/rooms/{group.id}/messages/").status_code, 200)
+        member.refresh_from_db()
+        self.assertEqual((member.unread_count, member.last_read_message_id), (0, Message.objects.filter(room=group).latest("id").id))
+
+    def test_reconcile_inbox_agrees_with_the_live_counters(self):
+        self.add_rooms(2)
+        group = ChatRoom.objects.get(is_group=True)
+        other = User.objects.get(username="user1")
+        ChatRoomMember.objects.create(room=group, user=other)
+        Message.objects.create(room=group, sender=self.user, message="welcome")
+        expected = dict(ChatRoomMember.objects.values_list("id", "unread_count"))
+        self.assertEqual(expected[ChatRoomMember.objects.get(room=group, user=other).id], 1)
+
+        ChatRoomMember.objects.update(unread_count=7)   # drifted
+        call_command("reconcile_inbox", stdout=StringIO())
+        self.assertEqual(dict(ChatRoomMember.objects.values_list("id", "unread_count")), expected)
+
+        ChatRoomMember.objects.update(unread_count=7)
+        call_command("reconcile_inbox", room=[group.id], stdout=StringIO())
+        counts = dict(ChatRoomMember.objects.filter(room=group).values_list("id", "unread_count"))
+        self.assertEqual(counts, {id: expected[id] for id in counts})
+        self.assertEqual(ChatRoomMember.objects.exclude(room=group).filter(unread_count=7).count(), 4)   # other rooms untouched
+
+    def test_membership_updates_do_not_read_the_updated_table(self):
+        # MySQL rejects an UPDATE whose SET subqueries read the table being updated (error 1093)
+        with CaptureQueriesContext(connection) as queries:
+            self.add_rooms(2)
+            ChatRoomMember.objects.update(other_user=None)
+            updated = rebuild_conversations()
+        for query in queries.captured_queries:
+            sql = query["sql"].replace('"', "").replace("`", "")
+            if sql.startswith("UPDATE main_chatroommember"):
+                self.assertNotIn("FROM main_chatroommember", sql.split(" WHERE ")[0], sql)
+
+        self.assertEqual(updated, 5)
+        for member in ChatRoomMember.objects.select_related("room"):
+            others = ChatRoomMember.objects.filter(room=member.room).exclude(user=member.user_id).values_list("user", flat=True)
+            self.assertEqual(member.other_user_id, None if member.room.is_group else others.get())
+
+    def test_room_history_query_count_is_constant(self):
+        self.add_rooms(1)
+        room_id = ChatRoomMember.objects.filter(user=self.user, room__is_group=False).values_list("room_id", flat=True).first()
+
+        def history_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(f"/api/rooms/{room_id}/messages/")
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        few = history_queries()
+        sender = ChatRoomMember.objects.exclude(user=self.user).get(room_id=room_id).user
+        for _ in range(10):
+            Message.objects.create(room_id=room_id, sender=sender, message="more")
+        self.assertEqual(few, history_queries())
+
+
+def explain(sql):
+    """
+    Plan rows for a captured statement: detail strings on SQLite, column dicts on MySQL
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            return [row[-1] for row in cursor.fetchall()]
+
+        cursor.execute(f"EXPLAIN {sql}")
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, values)) for values in cursor.fetchall()]
+
+
+def full_table_scans(sql, allow_sort=False):
+    """
+    Plan steps that read a whole table of this app, or sort every matching row before the LIMIT
+    (unless allow_sort, for ranked results where the rows come from an index range)
+    """
+    scans = []
+    for row in explain(sql):
+        if connection.vendor == "sqlite":
+            # "SCAN main_message [USING INDEX ...]" walks every row, "SEARCH ..." is an index lookup
+            words = row.split()
+            if len(words) >= 2 and words[0] == "SCAN" and words[1].startswith("main_"):
+                scans.append(row)
+            elif row.startswith("USE TEMP B-TREE FOR ORDER BY") and not allow_sort:
+                scans.append(row)
+        elif (row.get("table") or "").startswith("main_"):
+            if row.get("type") in ("ALL", "index") or ("filesort" in (row.get("Extra") or "") and not allow_sort):
+                scans.append(f"{row['table']}: {row.get('type')} {row.get('Extra') or ''}".strip())
+    return scans
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class ReadWatermarkTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("reader@example.com", "reader", "pass")
+        self.other = User.objects.create_user("writer@example.com", "writer", "pass")
+        self.room = ChatRoom.objects.create(is_group=False, private_key=f"private_{self.user.id}_{self.other.id}")
+        ChatRoomMember.objects.create(room=self.room, user=self.user)
+        ChatRoomMember.objects.create(room=self.room, user=self.other)
+        self.messages = [
+            Message.objects.create(room=self.room, sender=sender, message=text)
+            for sender, text in [(self.other, "one"), (self.user, "two"), (self.other, "three")]
+        ]
+
+    def member(self, user):
+        return ChatRoomMember.objects.get(room=self.room, user=user)
+
+    def test_mark_room_read_moves_the_watermark_and_resets_the_counter(self):
+        self.assertEqual(self.member(self.user).unread_count, 2)
+
+        mark_room_read(self.room.id, self.user.id)
+        member = self.member(self.user)
+        self.assertEqual((member.last_read_message_id, member.unread_count), (self.messages[-1].id, 0))
+        self.assertEqual(self.member(self.other).last_read_message_id, 0)     # other members keep theirs
+
+
+    def test_mark_room_read_counts_messages_stored_after_its_lookup(self):
+        count_unread = inbox.unread_after
+
+        def unread_after(*args):
+            Message.objects.create(room=self.room, sender=self.other, message="four")   # lands after the MAX lookup
+            return count_unread(*args)
+        with mock.patch("main.inbox.unread_after", unread_after):
+            mark_room_read(self.room.id, self.user.id)
+        member = self.member(self.user)
+        self.assertEqual((member.last_read_message_id, member.unread_count), (self.messages[-1].id, 1))
+
+    def test_read_by_is_derived_from_the_watermarks(self):
+        ChatRoomMember.objects.filter(room=self.room, user=self.other).update(last_read_message_id=self.messages[1].id)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(f"/api/rooms/{self.room.id}/messages/")
+        self.assertEqual(response.status_code, 200)
+
+        read_by = {row["id"]: row["read_by"] for row in response.json()["results"]}
+        self.assertEqual(read_by, {
+            self.messages[0].id: [self.user.id],    # the sender is never listed
+            self.messages[1].id: [self.other.id],
+            self.messages[2].id: [self.user.id],    # listing the room read it up to the newest message
+        })
+
+
+class ReadWatermarkMigrationTests(TransactionTestCase):
+    before = [("main", "0010_chatroom_private_key")]
+    after = [("main", "0011_chatroommember_last_read_message_id_remove_message_read_by")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_watermarks_are_backfilled_from_read_by(self):
+        apps = self.migrate(self.before)
+        User, ChatRoom = apps.get_model("main", "User"), apps.get_model("main", "ChatRoom")
+        ChatRoomMember, Message = apps.get_model("main", "ChatRoomMember"), apps.get_model("main", "Message")
+        reader = User.objects.create(email="reader@example.com", username="reader")
+        writer = User.objects.create(email="writer@example.com", username="writer")
+        room = ChatRoom.objects.create(is_group=False)
+        for user in (reader, writer):
+            ChatRoomMember.objects.create(room=room, user=user)
+        messages = [
+            Message.objects.create(room=room, sender=writer, message="one", read_by=[reader.id]),
+            Message.objects.create(room=room, sender=writer, message="two", read_by=[reader.id]),
+            Message.objects.create(room=room, sender=reader, message="three", read_by=[]),
+        ]
+
+        apps = self.migrate(self.after)
+        watermarks = dict(apps.get_model("main", "ChatRoomMember").objects.values_list("user_id", "last_read_message_id"))
+        self.assertEqual(watermarks, {reader.id: messages[1].id, writer.id: 0})
+        self.assertNotIn("read_by", {field.name for field in apps.get_model("main", "Message")._meta.get_fields()})
+
+
+class QueryPlanTests(TestCase):
+    """
+    Runs each view against a seeded dataset, EXPLAINs every statement it issued
+    and fails when one of them reads a whole table instead of using an index
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f"plan{i}@example.com", f"plan{i}", "pass") for i in range(30)]
+        cls.user = cls.users[0]
+
+        cls.rooms = []
+        for other in cls.users[1:]:
+            low, high = sorted([cls.user.id, other.id])
+            room = ChatRoom.objects.create(is_group=False, private_key=f"private_{low}_{high}")
+            ChatRoomMember.objects.create(room=room, user=cls.user)
+            ChatRoomMember.objects.create(room=room, user=other)
+            cls.rooms.append(room)
+
+        cls.group = ChatRoom.objects.create(group_name="plan group", is_group=True, created_by=cls.user)
+        for member in cls.users[:10]:
+            ChatRoomMember.objects.create(room=cls.group, user=member)
+
+        for room in cls.rooms[:5] + [cls.group]:
+            for i in range(30):
+                Message.objects.create(room=room, sender=cls.users[i % 2] if room.is_group else cls.user, message=f"seed {i}")
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertQueriesIndexed(self, queries, label, allow_sort=False):
+        for query in queries.captured_queries:
+            sql = query["sql"]
+            if not sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                continue
+            self.assertEqual(full_table_scans(sql, allow_sort), [], f"{label} scans a table:\n{sql}")
+
+    def assertIndexed(self, method, url, data=None, allow_sort=False):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data, format="json")
+        self.assertLess(response.status_code, 400, response.content)
+
+        self.assertQueriesIndexed(queries, f"{method.upper()} {url}", allow_sort)
+        return response
+
+    def test_inbox(self):
+        self.assertIndexed("get", f"/api/messages/{self.user.id}/")
+
+    def test_room_history(self):
+        response = self.assertIndexed("get", f"/api/rooms/{self.rooms[0].id}/messages/?page_size=5")
+        self.assertIndexed("get", response.json()["next"])
+
+    def test_send_message(self):
+        self.assertIndexed("post", f"/api/rooms/{self.group.id}/send/", {"message": "indexed"})
+
+    def test_get_or_create_private_room(self):
+        other = self.users[5]
+        self.assertIndexed("post", f"/api/rooms/private/{other.id}/", {"user_id": other.id})
+
+    def test_group_list(self):
+        self.assertIndexed("get", "/api/groups/")
+
+    def test_group_membership(self):
+        member = self.users[20]
+        self.assertIndexed("post", f"/api/groups/{self.group.id}/add-member/", {"user_id": member.id})
+        self.assertIndexed("delete", f"/api/groups/{self.group.id}/remove-member/{member.id}/")
+
+    def test_room_cache_load(self):
+        with CaptureQueriesContext(connection) as queries:
+            load_room_info(self.group.id)
+        self.assertQueriesIndexed(queries, "load_room_info")
+
+    def test_user_search(self):
+        # ranking sorts the matches, which come from a range of the term index
+        self.assertIndexed("get", "/api/users/?q=plan1&limit=5", allow_sort=True)
+
+    def test_message_search(self):
+        # across rooms the per-room postings ranges are merged by a sort
+        response = self.assertIndexed("get", "/api/messages/search/?q=seed&page_size=5", allow_sort=True)
+        self.assertIndexed("get", response.json()["next"], allow_sort=True)
+        self.assertIndexed("get", f"/api/rooms/{self.group.id}/messages/search/?q=seed+12")
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class MessageCursorPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("me@example.com", "me", "pass")
+        self.other = User.objects.create_user("other@example.com", "other", "pass")
+        self.room = ChatRoom.objects.create(is_group=False, private_key=f"private_{self.user.id}_{self.other.id}")
+        ChatRoomMember.objects.create(room=self.room, user=self.user)
+        ChatRoomMember.objects.create(room=self.room, user=self.other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        # messages 2, 3 and 4 share a timestamp and are ordered by id
+        start = timezone.now() - timedelta(hours=1)
+        self.messages = [Message.objects.create(room=self.room, sender=self.other, message=f"m{i}") for i in range(7)]
+        for i, message in enumerate(self.messages):
+            Message.objects.filter(id=message.id).update(created_at=start + timedelta(seconds=min(i, 2) + max(i - 4, 0)))
+            message.refresh_from_db()
+
+    def history(self, url=None, **params):
+        response = self.client.get(url or f"/api/rooms/{self.room.id}/messages/", params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def ids(self, page):
+        return [message["id"] for message in page["results"]]
+
+    def cursor(self, index):
+        return MessageCursorPagination().encode_cursor(self.messages[index])
+
+    def expected(self, *indexes):
+        return [self.messages[i].id for i in indexes]
+
+    def test_pages_walk_the_history_both_ways(self):
+        newest = self.history(page_size=3)
+        self.assertEqual(self.ids(newest), self.expected(4, 5, 6))
+        self.assertIsNone(newest["previous"])
+
+        middle = self.history(newest["next"])
+        self.assertEqual(self.ids(middle), self.expected(1, 2, 3))
+
+        oldest = self.history(middle["next"])
+        self.assertEqual(self.ids(oldest), self.expected(0))
+        self.assertIsNone(oldest["next"])
+
+        middle = self.history(oldest["previous"])
+        self.assertEqual(self.ids(middle), self.expected(1, 2, 3))
+        self.assertIsNotNone(middle["next"])
+        newest = self.history(middle["previous"])
+        self.assertEqual(self.ids(newest), self.expected(4, 5, 6))
+        self.assertIsNone(newest["previous"])
+        self.assertIsNotNone(newest["next"])
+
+    def test_after_returns_the_next_newer_window(self):
+        page = self.history(after=self.cursor(2), page_size=2)
+        self.assertEqual(self.ids(page), self.expected(3, 4))
+        self.assertEqual(self.ids(self.history(page["previous"])), self.expected(5, 6))
+        self.assertEqual(self.ids(self.history(page["next"])), self.expected(1, 2))
+
+        page = self.history(before=self.cursor(4), page_size=2)
+        self.assertEqual(self.ids(page), self.expected(2, 3))
+
+    def test_after_the_newest_message_is_an_empty_page(self):
+        page = self.history(after=self.cursor(6))
+        self.assertEqual(page["results"], [])
+        self.assertIsNone(page["previous"])
+        self.assertEqual(self.ids(self.history(page["next"])), self.expected(*range(6)))
+
+        Message.objects.all().delete()
+        self.assertEqual(self.history(), {"next": None, "previous": None, "results": []})
+
+    def test_invalid_cursor_is_not_found(self):
+        bad = ["garbage", urlsafe_base64_encode(b"not a date|1"), urlsafe_base64_encode(b"2024-01-01T00:00:00|x")]
+        for cursor in bad:
+            for param in ("before", "after"):
+                response = self.client.get(f"/api/rooms/{self.room.id}/messages/", {param: cursor})
+                self.assertEqual(response.status_code, 404, (param, cursor))
+
+
+def layer_worker(path, channels, received):
+    """
+    Worker process: joins room_1 with a fresh channel, reports the channel name,
+    then reports the next two messages it receives on it
+    """
+    async def run():
+        layer = LocalSocketChannelLayer(path=path)
+        channel = await layer.new_channel()
+        await layer.group_add("room_1", channel)
+        channels.put(channel)
+        for _ in range(2):
+            received.put((channel, await asyncio.wait_for(layer.receive(channel), 10)))
+        await layer.close()
+
+    asyncio.run(run())
+
+
+@skipUnless(hasattr(os, "fork"), "needs fork")
+class LocalSocketChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, True)
+
+    def test_delivery_across_worker_processes(self):
+        context = multiprocessing.get_context("fork")
+        channels, received = context.Queue(), context.Queue()
+        workers = [context.Process(target=layer_worker, args=(self.path, channels, received)) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        worker_channels = [channels.get(timeout=10) for _ in workers]
+
+        # a third process sends one group message and one message to each worker's own channel
+        layer = LocalSocketChannelLayer(path=self.path)
+        async_to_sync(layer.group_send)("room_1", {"type": "chat_message", "text": "to the room"})
+        for channel in worker_channels:
+            async_to_sync(layer.send)(channel, {"type": "chat_message", "text": f"to {channel}"})
+
+        messages = [received.get(timeout=10) for _ in range(4)]
+        for worker in workers:
+            worker.join(10)
+            self.assertEqual(worker.exitcode, 0)
+        async_to_sync(layer.close)()
+
+        for channel in worker_channels:
+            self.assertEqual(
+                sorted(message["text"] for receiver, message in messages if receiver == channel),
+                sorted(["to the room", f"to {channel}"])
+            )
+
+    def test_send_to_exited_process_is_dropped(self):
+        layer = LocalSocketChannelLayer(path=self.path)
+        open(os.path.join(self.path, "gone.sock"), "w").close()   # socket file left behind by a dead worker
+
+        async_to_sync(layer.group_send)("room_1", {"type": "chat_message"})
+
+        self.assertFalse(os.path.exists(os.path.join(self.path, "gone.sock")))
+        async_to_sync(layer.close)()
+
+    def test_peers_are_listed_again_only_when_the_directory_changes(self):
+        layer = LocalSocketChannelLayer(path=self.path)
+        with mock.patch("main.layers.os.scandir", wraps=os.scandir) as scandir:
+            for _ in range(3):
+                async_to_sync(layer.group_send)("room_1", {"type": "chat_message"})
+            self.assertEqual(scandir.call_count, 1)
+
+            other = LocalSocketChannelLayer(path=self.path)
+            other._bind()   # a worker starting
+            self.assertIn(other.process_name, layer._peers())
+            self.assertEqual(scandir.call_count, 2)
+        async_to_sync(other.close)()
+        async_to_sync(layer.close)()
+
+    def test_group_members_receive_their_own_copy(self):
+        layer = LocalSocketChannelLayer(path=self.path)
+
+        async def run():
+            channels = [await layer.new_channel() for _ in range(2)]
+            for channel in channels:
+                await layer.group_add("room_1", channel)
+            await layer.group_send("room_1", {"type": "chat_message", "payload": {"id": 1}})
+            first, second = [await asyncio.wait_for(layer.receive(channel), 5) for channel in channels]
+            first["payload"]["id"] = 2
+            self.assertEqual(second["payload"], {"id": 1})
+            await layer.close()
+        async_to_sync(run)()
+
+    def test_oversized_message_is_dropped_with_a_warning(self):
+        layer = LocalSocketChannelLayer(path=self.path)
+
+        async def run():
+            channel = await layer.new_channel()
+            await layer.group_add("room_1", channel)
+            with self.assertLogs("main.layers", "WARNING"):
+                await layer.group_send("room_1", {"type": "chat_message", "text": "x" * (8 * 1024 * 1024)})
+                await layer.send(channel, {"type": "chat_message", "text": "x" * (8 * 1024 * 1024)})
+            await layer.send(channel, {"type": "chat_message", "text": "small"})
+            self.assertEqual((await asyncio.wait_for(layer.receive(channel), 5))["text"], "small")
+            await layer.close()
+        async_to_sync(run)()
+
+
+def file_cache_worker(path, count, added):
+    """
+    Worker process: increments the shared counter `count` times and tries to add the same key
+    """
+    cache = LocalFileCache(path, {})
+    added.put(cache.add("claimed", os.getpid(), None))
+    for _ in range(count):
+        cache.incr("counter")
+
+
+@skipUnless(hasattr(os, "fork"), "needs fork")
+class LocalFileCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, True)
+
+    def test_concurrent_workers_do_not_lose_increments(self):
+        cache = LocalFileCache(self.path, {})
+        cache.set("counter", 0, None)
+
+        context = multiprocessing.get_context("fork")
+        added = context.Queue()
+        workers = [context.Process(target=file_cache_worker, args=(self.path, 50, added)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+            self.assertEqual(worker.exitcode, 0)
+
+        self.assertEqual(cache.get("counter"), 200)
+        self.assertEqual(sorted(added.get(timeout=5) for _ in workers), [False, False, False, True])
+
+    def test_incr_keeps_the_expiry(self):
+        cache = LocalFileCache(self.path, {"TIMEOUT": 1})
+        cache.set("forever", 1, None)
+        cache.set("brief", 1, 60)
+        with mock.patch("time.time", return_value=time.time() + 30):
+            self.assertEqual((cache.incr("forever"), cache.incr("brief")), (2, 2))
+        with mock.patch("time.time", return_value=time.time() + 61):
+            self.assertEqual((cache.get("forever"), cache.get("brief")), (2, None))
+            with self.assertRaises(ValueError):
+                cache.incr("brief")
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class SocketSendTests(TransactionTestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user("sender@example.com", "sender", "pass")
+        self.receiver = User.objects.create_user("receiver@example.com", "receiver", "pass")
+        self.room = ChatRoom.objects.create(is_group=False, private_key=f"private_{self.sender.id}_{self.receiver.id}")
+        ChatRoomMember.objects.create(room=self.room, user=self.sender)
+        ChatRoomMember.objects.create(room=self.room, user=self.receiver)
+
+    async def connect(self, user, path="/ws/user/"):
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), path)
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    @async_to_sync
+    async def test_live_socket_follows_room_membership(self):
+        group = await ChatRoom.objects.acreate(group_name="group", is_group=True, created_by=self.sender)
+        await ChatRoomMember.objects.acreate(room=group, user=self.sender)
+        sender, receiver = await self.connect(self.sender), await self.connect(self.receiver)
+        frame = {"type": "send", "room_id": group.id}
+
+        async def send(message):  # returns once the sender has its ack and own copy
+            await sender.send_json_to({**frame, "message": message, "client_id": message})
+            replies = [await sender.receive_json_from() for _ in range(2)]
+            self.assertEqual(sorted(str(reply.get("type")) for reply in replies), ["None", "ack"])
+
+        await send("before")
+        self.assertTrue(await receiver.receive_nothing())   # not a member yet
+
+        await database_sync_to_async(ChatRoomMember.objects.create)(room=group, user=self.receiver)   # room_join
+        self.assertTrue(await receiver.receive_nothing())     # lets the socket join the room group
+        await send("joined")
+        received = [await receiver.receive_json_from() for _ in range(2)]
+        self.assertEqual([(message.get("type"), message["message"]) for message in received], [(None, "joined"), ("notification", "joined")])
+
+        await database_sync_to_async(ChatRoomMember.objects.filter(room=group, user=self.receiver).delete)()    # room_leave
+        self.assertTrue(await receiver.receive_nothing())
+        await send("left")
+        self.assertTrue(await receiver.receive_nothing())
+
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    @async_to_sync
+    async def test_batched_msgpack_frames(self):
+        sender = await self.connect(self.sender)
+        receiver = await self.connect(self.receiver, "/ws/user/?format=msgpack&batch=1")
+
+        await sender.send_json_to({"type": "send", "room_id": self.room.id, "message": "packed", "client_id": "p"})
+        output = await receiver.receive_output()
+        self.assertNotIn("text", output)
+        batch = msgpack.unpackb(output["bytes"])
+        # the message and its notification leave in one frame
+        self.assertEqual(batch["type"], "batch")
+        self.assertEqual([frame.get("type") for frame in batch["frames"]], [None, "notification"])
+        self.assertEqual(batch["frames"][0]["message"], "packed")
+
+        await receiver.send_to(bytes_data=msgpack.packb({"type": "send", "room_id": self.room.id, "message": "back", "client_id": "b"}))
+        frames = msgpack.unpackb((await receiver.receive_output())["bytes"])["frames"]   # ack and own copy
+        self.assertEqual([frames[0]["type"], frames[1]["message"]], ["ack", "back"])
+
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    @async_to_sync
+    async def test_send_frame_is_stored_acked_and_broadcast_once(self):
+        sender, receiver = await self.connect(self.sender), await self.connect(self.receiver)
+        frame = {"type": "send", "room_id": self.room.id, "message": "hello", "client_id": "retry-1"}
+
+        await sender.send_json_to(frame)
+        ack = await sender.receive_json_from()
+        self.assertEqual(ack["type"], "ack")
+        self.assertEqual(ack["client_id"], "retry-1")
+        self.assertEqual((await sender.receive_json_from())["id"], ack["id"])   # own copy of the broadcast
+
+        message = await receiver.receive_json_from()
+        self.assertEqual((message["id"], message["message"], message["sender_id"]), (ack["id"], "hello", self.sender.id))
+        self.assertEqual((await receiver.receive_json_from())["type"], "notification")
+
+        # a retry is acknowledged with the stored message and not broadcast again
+        await sender.send_json_to(frame)
+        self.assertEqual((await sender.receive_json_from())["id"], ack["id"])
+        self.assertTrue(await receiver.receive_nothing())
+        self.assertEqual(await Message.objects.filter(sender=self.sender).acount(), 1)
+
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    @async_to_sync
+    async def test_typing_is_coalesced_and_relayed_to_other_members(self):
+        sender, receiver = await self.connect(self.sender), await self.connect(self.receiver)
+
+        for _ in range(5):
+            await sender.send_json_to({"type": "typing", "room_id": self.room.id, "typing": True})
+        frame = await receiver.receive_json_from()
+        self.assertEqual((frame["type"], frame["user_id"], frame["typing"]), ("typing", self.sender.id, True))
+        self.assertTrue(await receiver.receive_nothing())     # repeats within the refresh window are dropped
+        self.assertTrue(await sender.receive_nothing())       # never echoed to the typist
+
+        await sender.send_json_to({"type": "typing", "room_id": self.room.id + 1, "typing": True})   # not a member
+        await sender.send_json_to({"type": "typing", "room_id": self.room.id, "typing": False})
+        self.assertFalse((await receiver.receive_json_from())["typing"])
+        self.assertTrue(await receiver.receive_nothing())
+
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    @async_to_sync
+    async def test_send_frame_from_non_member_is_rejected(self):
+        outsider = await User.objects.acreate(email="outsider@example.com", username="outsider")
+        communicator = await self.connect(outsider)
+
+        await communicator.send_json_to({"type": "send", "room_id": self.room.id, "message": "hi", "client_id": "x"})
+        self.assertEqual((await communicator.receive_json_from())["type"], "error")
+        self.assertFalse(await Message.objects.filter(room=self.room).aexists())
+
+        await communicator.disconnect()
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class MessageIngestQueueTests(TransactionTestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user("sender@example.com", "sender", "pass")
+        self.receiver = User.objects.create_user("receiver@example.com", "receiver", "pass")
+        self.room = ChatRoom.objects.create(is_group=False, private_key=f"private_{self.sender.id}_{self.receiver.id}")
+        ChatRoomMember.objects.create(room=self.room, user=self.sender)
+        ChatRoomMember.objects.create(room=self.room, user=self.receiver)
+        self.queue = MessageIngestQueue(batch_size=2, recent_size=0)
+
+    def test_flush_stores_batches_in_order_and_updates_inbox(self):
+        queued = [self.queue.submit(self.room.id, self.sender.id, f"message {i}", f"c{i}")[0] for i in range(5)]
+        self.assertEqual(self.queue.submit(self.room.id, self.sender.id, "message 0", "c0"), (queued[0], False))
+        self.assertIsNone(queued[0].id)
+
+        self.assertEqual(self.queue.flush(), 5)
+
+        stored = list(Message.objects.filter(room=self.room).order_by("id").values_list("id", "client_id"))
+        self.assertEqual(stored, [(message.id, f"c{i}") for i, message in enumerate(queued)])
+        member = ChatRoomMember.objects.get(room=self.room, user=self.receiver)
+        self.assertEqual((member.unread_count, member.last_message_id), (5, queued[-1].id))
+        self.assertEqual(MessageToken.objects.filter(token="message", room=self.room).count(), 5)
+
+    def test_retry_after_flush_resolves_to_stored_message(self):
+        first, created = self.queue.submit(self.room.id, self.sender.id, "hello", "retry")
+        self.queue.flush()
+
+        retry, created = self.queue.submit(self.room.id, self.sender.id, "hello", "retry")   # recent keys are not kept
+        self.assertTrue(created)
+        self.queue.flush()
+
+        self.assertEqual(retry.id, first.id)
+        self.assertEqual(Message.objects.filter(sender=self.sender).count(), 1)
+        self.assertEqual(ChatRoomMember.objects.get(room=self.room, user=self.receiver).unread_count, 1)
+
+    def test_message_that_cannot_be_stored_does_not_block_the_queue(self):
+        missing_room = ChatRoom.objects.create(is_group=True, group_name="deleted")
+        missing_room_id = missing_room.id
+        missing_room.delete()   # between submit and flush
+
+        bad, _ = self.queue.submit(missing_room_id, self.sender.id, "lost", "bad")
+        good, _ = self.queue.submit(self.room.id, self.sender.id, "kept", "good")
+        with self.assertLogs("main.ingest", "WARNING"):
+            self.assertEqual(self.queue.flush(), 1)
+
+        self.assertIsNone(bad.id)
+        self.assertEqual(list(Message.objects.values_list("id", "client_id")), [(good.id, "good")])
+        self.assertFalse(self.queue.pending)
+        self.assertEqual(self.queue.flush(), 0)
+
+    def test_stop_drains_the_queue(self):
+        self.queue = MessageIngestQueue(batch_size=100, interval=60)
+        self.queue.start()
+        queued = [self.queue.submit(self.room.id, self.sender.id, f"message {i}", f"c{i}")[0] for i in range(3)]
+        self.queue.stop()
+
+        self.assertFalse(self.queue.thread.is_alive())
+        self.assertEqual(list(Message.objects.order_by("id").values_list("id", flat=True)), [message.id for message in queued])
+
+    @async_to_sync
+    async def test_stored_event_reaches_a_waiting_socket(self):
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), "/ws/user/")
+        communicator.scope["user"] = self.receiver
+        self.assertTrue((await communicator.connect())[0])
+        self.queue.start()
+        self.addCleanup(self.queue.stop)
+
+        message, _ = self.queue.submit(self.room.id, self.sender.id, "behind", "wb")
+        started = time.monotonic()
+        frame = await communicator.receive_json_from(timeout=2)   # sent by the ingest thread
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(frame["type"], "message_stored")
+        self.assertEqual([stored["id"] for stored in frame["messages"]], [message.id])
+
+        await communicator.disconnect()
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+
+        self.user = User.objects.create_user("owner@example.com", "owner", "pass")
+        self.room = ChatRoom.objects.create(group_name="group", is_group=True, created_by=self.user)
+        ChatRoomMember.objects.create(room=self.room, user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def patch(self, url, data, offset):
+        return self.client.patch(url, data, content_type="application/offset+octet-stream", HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_resume_and_finalize(self):
+        data = os.urandom(5000)
+        upload = self.client.post(f"/api/rooms/{self.room.id}/uploads/", {"filename": "report.pdf", "size": len(data)}, format="json").data
+
+        self.assertEqual(self.patch(upload["upload_url"], data[:2000], 0).data["offset"], 2000)
+        retried = self.patch(upload["upload_url"], data[:2000], 0)   # chunk resent after a lost response
+        self.assertEqual((retried.status_code, retried.data["offset"]), (409, 2000))
+        self.assertEqual(self.client.post(f"{upload['upload_url']}finalize/").status_code, 409)
+        self.assertEqual(self.patch(upload["upload_url"], data[2000:], 2000).data["offset"], len(data))
+
+        response = self.client.post(f"{upload['upload_url']}finalize/", {"message": "report"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        message = Message.objects.get(id=response.data["id"])
+        self.assertEqual(message.document.name, blob_name(hashlib.sha256(data).hexdigest(), "report.pdf"))
+        with message.document.open("rb") as stored:
+            self.assertEqual(stored.read(), data)
+
+        self.assertEqual(self.client.post(f"{upload['upload_url']}finalize/").status_code, 404)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 1)
+
+    def upload(self, data, **fields):
+        upload = self.client.post(f"/api/rooms/{self.room.id}/uploads/", {"filename": "report.pdf", "size": len(data), **fields}, format="json").data
+        if not upload["duplicate"]:
+            self.patch(upload["upload_url"], data, 0)
+        return upload, self.client.post(f"{upload['upload_url']}finalize/")
+
+    def test_duplicate_content_is_stored_once(self):
+        data = os.urandom(5000)
+        digest = hashlib.sha256(data).hexdigest()
+        first = self.upload(data)[1].data
+
+        upload, response = self.upload(data, sha256=digest)   # forwarded: known blob, nothing sent
+        self.assertTrue(upload["duplicate"])
+        forwarded = Message.objects.get(id=response.data["id"])
+        self.assertEqual(forwarded.document.name, Message.objects.get(id=first["id"]).document.name)
+        self.assertEqual(StoredBlob.objects.get(sha256=digest).refcount, 2)
+
+        forwarded.delete()
+        self.assertEqual(StoredBlob.objects.get(sha256=digest).refcount, 1)
+        self.assertTrue(os.path.exists(forwarded.document.path))
+
+    def test_blob_of_another_room_is_not_reused(self):
+        data = os.urandom(5000)
+        self.upload(data)
+        outsider = User.objects.create_user("outsider@example.com", "outsider", "pass")
+        room = ChatRoom.objects.create(group_name="other", is_group=True, created_by=outsider)
+        ChatRoomMember.objects.create(room=room, user=outsider)
+        self.client.force_authenticate(outsider)
+
+        upload = self.client.post(f"/api/rooms/{room.id}/uploads/", {
+            "filename": "report.pdf", "size": len(data), "sha256": hashlib.sha256(data).hexdigest()
+        }, format="json").data
+        self.assertFalse(upload["duplicate"])
+
+    def test_purge_keeps_a_blob_reused_by_an_upload_in_flight(self):
+        data = os.urandom(5000)
+        message = Message.objects.get(id=self.upload(data)[1].data["id"])
+        path = message.document.path
+        message.delete()
+
+        def age(name, seconds):
+            then = time.time() - seconds
+            os.utime(path, (then, then))
+            StoredBlob.objects.filter(name=name).update(updated_at=timezone.now() - timedelta(seconds=seconds))
+
+        # unreferenced for hours, then the same content is uploaded again; its message is not created yet
+        age(message.document.name, 7200)
+        fd, copy = tempfile.mkstemp(dir=settings.MEDIA_ROOT)
+        with os.fdopen(fd, "wb") as temp:
+            temp.write(data)
+        storage = Message._meta.get_field("document").storage
+        self.assertEqual(storage.store_file(copy, "report.pdf"), message.document.name)
+
+        call_command("purge_blobs", grace=3600, stdout=StringIO())
+        self.assertTrue(os.path.exists(path))
+
+        age(message.document.name, 7200)
+        call_command("purge_blobs", grace=3600, stdout=StringIO())
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(StoredBlob.objects.exists())
+
+    def test_purge_reads_the_references_once(self):
+        messages = [Message.objects.get(id=self.upload(os.urandom(5000))[1].data["id"]) for _ in range(3)]
+        messages[0].delete()    # the others are still referenced
+        then = time.time() - 7200
+        for message in messages:
+            os.utime(message.document.path, (then, then))
+        StoredBlob.objects.update(refcount=0, updated_at=timezone.now() - timedelta(hours=2))  # drifted counts
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command("purge_blobs", grace=3600, stdout=StringIO())
+        self.assertEqual([os.path.exists(message.document.path) for message in messages], [False, True, True])
+        message_reads = [query for query in queries.captured_queries
+                         if "FROM main_message " in query["sql"].replace('"', "").replace("`", "")]
+        self.assertEqual(len(message_reads), 2)     # image and document names, whatever the number of blobs
+
+    def test_content_not_matching_sha256_is_rejected(self):
+        response = self.upload(os.urandom(5000), sha256="0" * 64)[1]
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.exists())
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+
+        self.user = User.objects.create_user("owner@example.com", "owner", "pass")
+        self.room = ChatRoom.objects.create(group_name="group", is_group=True, created_by=self.user)
+        ChatRoomMember.objects.create(room=self.room, user=self.user)
+
+    def image_message(self, size):
+        output = tempfile.SpooledTemporaryFile()
+        Image.new("RGBA", size, (200, 10, 10, 255)).save(output, "PNG")
+        output.seek(0)
+        message = Message(room=self.room, sender=self.user, message="")
+        message.image.save("photo.png", ContentFile(output.read()), save=False)
+        message.save()
+        return message
+
+    def test_thumbnails_are_bounded_and_exposed(self):
+        message = self.image_message((2000, 1000))
+        thumbnails = generate_thumbnails(message)
+
+        self.assertEqual(set(thumbnails), {"small", "medium", "large"})
+        with Image.open(message.image.storage.path(thumbnails["small"])) as small:
+            self.assertEqual((small.format, small.size), ("JPEG", (160, 80)))
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        data = client.get(f"/api/rooms/{self.room.id}/messages/").data["results"][0]
+        self.assertIn(f"/media/thumbs/medium/{message.image.name}.jpg?exp=", data["thumbnails"]["medium"])
+
+    def test_small_image_keeps_only_smaller_sizes(self):
+        message = self.image_message((300, 200))
+        self.assertEqual(set(generate_thumbnails(message)), {"small"})
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class ThumbnailDeliveryTests(TransactionTestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+
+        self.user = User.objects.create_user("owner@example.com", "owner", "pass")
+        self.room = ChatRoom.objects.create(group_name="group", is_group=True, created_by=self.user)
+        ChatRoomMember.objects.create(room=self.room, user=self.user)
+
+    def image_message(self):
+        output = tempfile.SpooledTemporaryFile()
+        Image.new("RGB", (1000, 500), (10, 200, 10)).save(output, "PNG")
+        output.seek(0)
+        message = Message(room=self.room, sender=self.user, message="")
+        message.image.save("photo.png", ContentFile(output.read()), save=False)
+        message.save()   # committed at once, the thumbnails are made by the worker pool
+        return message
+
+    @async_to_sync
+    async def test_thumbnails_event_reaches_a_waiting_socket(self):
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), "/ws/user/")
+        communicator.scope["user"] = self.user
+        self.assertTrue((await communicator.connect())[0])
+
+        message = await database_sync_to_async(self.image_message)()
+        started = time.monotonic()
+        frame = await communicator.receive_json_from(timeout=5)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual((frame["type"], frame["message_id"]), ("message_thumbnails", message.id))
+        self.assertEqual(set(frame["thumbnails"]), {"small", "medium"})
+
+        await communicator.disconnect()
+
+
+class MediaApplicationTests(SimpleTestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+
+        os.makedirs(os.path.join(media_root, "documents"))
+        self.data = os.urandom(1000)
+        with open(os.path.join(media_root, "documents", "report.pdf"), "wb") as file:
+            file.write(self.data)
+        open(os.path.join(media_root, "documents", ".upload.part"), "wb").close()
+
+    def get(self, url, headers=()):
+        path, _, query = url.partition("?")
+        scope = {
+            "type": "http", "method": "GET", "path": path, "query_string": query.encode(),
+            "headers": [(key.encode(), value.encode()) for key, value in headers],
+        }
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        async def inner(scope, receive, send):
+            raise AssertionError("media request reached Django")
+
+        async_to_sync(MediaApplication(inner))(scope, None, send)
+        headers = dict(messages[0]["headers"])
+        return messages[0]["status"], headers, b"".join(message.get("body", b"") for message in messages[1:])
+
+    def test_range_and_etag(self):
+        url = signed_media_url("documents/report.pdf")
+
+        status, headers, body = self.get(url)
+        self.assertEqual((status, body), (200, self.data))
+
+        status, headers, body = self.get(url, [("range", "bytes=100-199")])
+        self.assertEqual((status, headers[b"content-range"], body), (206, b"bytes 100-199/1000", self.data[100:200]))
+        self.assertEqual(self.get(url, [("range", "bytes=-10")])[2], self.data[-10:])
+        self.assertEqual(self.get(url, [("range", "bytes=1000-")])[0], 416)
+        self.assertEqual(self.get(url, [("range", "bytes=-0")])[0], 416)
+        self.assertEqual(self.get(url, [("range", "bytes=-5000")])[2], self.data)
+        self.assertEqual(self.get(url, [("range", "bytes=--5")])[0], 200)    # malformed: ignored
+        self.assertEqual(self.get(url, [("range", "bytes=0-1,5-6")])[0], 200)
+
+        self.assertEqual(self.get(url, [("if-none-match", headers[b"etag"].decode())])[0], 304)
+        self.assertEqual(self.get(url, [("range", "bytes=0-9"), ("if-range", '"stale"')])[0], 200)
+
+    @mock.patch("main.media.READ_SIZE", 100)
+    def test_stream_waits_for_the_daphne_send_buffer(self):
+        class Request:  # the producer API of the Twisted request behind Daphne's send
+            producer = None
+
+            def registerProducer(self, producer, streaming):
+                self.producer = producer
+
+            def unregisterProducer(self):
+                self.producer = None
+
+        request = Request()
+        sent = []
+
+        async def handle_reply(request, message):
+            sent.append(message)
+            if len(sent) == 3:
+                request.producer.pauseProducing()     # the client stopped reading
+
+        async def run():
+            path, _, query = signed_media_url("documents/report.pdf").partition("?")
+            scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(), "headers": []}
+            download = asyncio.create_task(MediaApplication(None)(scope, None, functools.partial(handle_reply, request)))
+            while len(sent) < 3:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.2)
+            self.assertEqual(len(sent), 3)  # headers and two chunks, then no read until the buffer drains
+            self.assertFalse(download.done())
+
+            request.producer.resumeProducing()
+            await download
+            self.assertEqual(b"".join(message.get("body", b"") for message in sent[1:]), self.data)
+            self.assertIsNone(request.producer)
+        asyncio.run(run())
+
+    def test_attachments_need_a_valid_signature(self):
+        self.assertEqual(self.get("/media/documents/report.pdf")[0], 403)
+        url = signed_media_url("documents/report.pdf").replace("sig=", "sig=0")
+        self.assertEqual(self.get(url)[0], 403)
+        self.assertEqual(self.get(signed_media_url("documents/.upload.part"))[0], 404)
+        self.assertEqual(self.get(signed_media_url("documents/../../etc/passwd"))[0], 404)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class UserSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("me@example.com", "me", "pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create(self, email, username, full_name=""):
+        user = User.objects.create_user(email, username, "pass")
+        user.profile.full_name = full_name
+        user.profile.save()
+        return user
+
+    def search(self, query, **params):
+        return self.client.get("/api/users/", {"q": query, **params}).json()
+
+    def test_ranked_prefix_matches(self):
+        self.create("ann.smith@example.com", "annabel")
+        self.create("zed@example.com", "zed", "Ann Lee")
+        self.create("ann@example.com", "ann")
+        self.create("bob@example.com", "bob", "Joanna Banner")    # "ann" inside a word is not a prefix
+
+        page = self.search("Ann")
+        # exact username, then exact word of a full name, then username prefix
+        self.assertEqual([profile["user"]["username"] for profile in page["results"]], ["ann", "zed", "annabel"])
+        self.assertEqual(self.search("lee")["results"][0]["user"]["username"], "zed")
+        self.assertEqual(self.search("me")["count"], 0)    # never the caller
+
+    def test_index_follows_renames_and_pages(self):
+        for i in range(12):
+            self.create(f"user{i}@example.com", f"tester{i:02}")
+        page = self.search("test", limit=5, offset=10)
+        self.assertEqual((page["count"], len(page["results"])), (12, 2))
+
+        user = User.objects.get(username="tester00")
+        user.username = "renamed"
+        user.save()
+        self.assertEqual(self.search("test")["count"], 11)
+        self.assertEqual(self.search("renam")["results"][0]["user"]["id"], user.id)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("me@example.com", "me", "pass")
+        self.other = User.objects.create_user("other@example.com", "other", "pass")
+        self.room = ChatRoom.objects.create(group_name="mine", is_group=True, created_by=self.user)
+        self.foreign = ChatRoom.objects.create(group_name="foreign", is_group=True, created_by=self.other)
+        ChatRoomMember.objects.create(room=self.room, user=self.user)
+        ChatRoomMember.objects.create(room=self.foreign, user=self.other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, url, query, **params):
+        return self.client.get(url, {"q": query, **params}).json()
+
+    def test_every_word_matches_in_the_callers_rooms_only(self):
+        lunch = Message.objects.create(room=self.room, sender=self.user, message="Lunch at the Pizza place?")
+        Message.objects.create(room=self.room, sender=self.user, message="pizza tonight")
+        Message.objects.create(room=self.foreign, sender=self.other, message="pizza lunch")
+
+        page = self.search("/api/messages/search/", "pizza LUNCH")
+        self.assertEqual([message["id"] for message in page["results"]], [lunch.id])
+        self.assertEqual(page["results"][0]["snippet"], "<mark>Lunch</mark> at the <mark>Pizza</mark> place?")
+        self.assertEqual(len(self.search(f"/api/rooms/{self.room.id}/messages/search/", "pizza")["results"]), 2)
+        self.assertEqual(self.search(f"/api/rooms/{self.foreign.id}/messages/search/", "pizza")["results"], [])
+        self.assertEqual(self.search("/api/messages/search/", "?!")["results"], [])
+
+    def test_pages_newest_first(self):
+        messages = [Message.objects.create(room=self.room, sender=self.user, message=f"note {i}") for i in range(5)]
+        page = self.search("/api/messages/search/", "note", page_size=2)
+        seen = [message["id"] for message in page["results"]]
+        while page["next"]:
+            page = self.client.get(page["next"]).json()
+            seen += [message["id"] for message in page["results"]]
+        self.assertEqual(seen, [message.id for message in reversed(messages)])
+
+    def test_deleted_messages_leave_the_index(self):
+        message = Message.objects.create(room=self.room, sender=self.user, message="secret plan")
+        self.assertEqual(MessageToken.objects.filter(message=message).count(), 2)
+        message.delete()
+        self.assertEqual(self.search("/api/messages/search/", "secret")["results"], [])
+
+    def test_snippet_is_escaped_and_trimmed(self):
+        text = "x" * 100 + " <b>needle</b> " + "y" * 100
+        snippet = highlight(text, ["needle"])
+        self.assertIn("&lt;b&gt;<mark>needle</mark>&lt;/b&gt;", snippet)
+        self.assertTrue(snippet.startswith("…") and snippet.endswith("…"))
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class PresenceTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice@example.com", "alice", "pass")
+        self.bob = User.objects.create_user("bob@example.com", "bob", "pass")
+        self.room = ChatRoom.objects.create(is_group=False, private_key=f"private_{self.alice.id}_{self.bob.id}")
+        ChatRoomMember.objects.create(room=self.room, user=self.alice)
+        ChatRoomMember.objects.create(room=self.room, user=self.bob)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), "/ws/user/")
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_connections_are_counted_and_expire_without_heartbeat(self):
+        self.assertTrue(presence.user_connected(self.alice.id))
+        self.assertFalse(presence.user_connected(self.alice.id))     # second tab
+        self.assertFalse(presence.user_disconnected(self.alice.id))
+        self.assertTrue(presence.get_presence([self.alice.id])[self.alice.id]["online"])
+
+        later = time.time() + presence.PRESENCE_TTL + 1
+        with mock.patch("main.presence.time.time", return_value=later):
+            state = presence.get_presence([self.alice.id, self.bob.id])
+            self.assertFalse(state[self.alice.id]["online"])   # the remaining socket stopped beating
+            self.assertEqual(state[self.bob.id], {"id": self.bob.id, "online": False, "last_seen": None})
+            self.assertTrue(presence.user_connected(self.alice.id))  # stale count of a crashed server is reset
+
+        self.assertTrue(presence.user_disconnected(self.alice.id))
+
+    def test_presence_view(self):
+        presence.user_connected(self.bob.id)
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        results = client.get("/api/presence/", {"ids": f"{self.bob.id},{self.alice.id}"}).json()["results"]
+        self.assertEqual([(user["id"], user["online"]) for user in results], [(self.bob.id, True), (self.alice.id, False)])
+        self.assertEqual(client.get("/api/presence/", {"ids": "1,x"}).status_code, 400)
+
+    @async_to_sync
+    async def test_changes_are_debounced_and_sent_to_contacts(self):
+        with mock.patch("main.presence.PRESENCE_DEBOUNCE", 0.2):
+            alice = await self.connect(self.alice)
+            bob = await self.connect(self.bob)
+            frame = await alice.receive_json_from(timeout=2)
+            self.assertEqual(frame["type"], "presence")
+            self.assertEqual([(user["id"], user["online"]) for user in frame["users"]], [(self.bob.id, True)])
+
+            # a reconnect within the debounce window is not announced
+            await bob.disconnect()
+            bob = await self.connect(self.bob)
+            self.assertTrue(await alice.receive_nothing(timeout=0.5))
+
+            await bob.disconnect()
+            frame = await alice.receive_json_from(timeout=2)
+            self.assertEqual([(user["id"], user["online"]) for user in frame["users"]], [(self.bob.id, False)])
+            await alice.disconnect()
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class DeliveryReplayTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create_user("sender@example.com", "sender", "pass")
+        self.receiver = User.objects.create_user("receiver@example.com", "receiver", "pass")
+        self.room = ChatRoom.objects.create(is_group=False, private_key=f"private_{self.sender.id}_{self.receiver.id}")
+        ChatRoomMember.objects.create(room=self.room, user=self.sender)
+        ChatRoomMember.objects.create(room=self.room, user=self.receiver)
+
+    async def connect(self, user, since=None):
+        path = "/ws/user/" + (f"?since={since}" if since else "")
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), path)
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def record(self, group, n, at=None):
+        with mock.patch("main.delivery.time.time", return_value=at or time.time()):
+            return delivery.record_event(group, {"type": "message_stored", "n": n})
+
+    def test_log_replays_only_missed_events_of_the_given_groups(self):
+        delivery.start_log(["room_1", "user_1"])    # joined by a socket
+        first = self.record("room_1", 1, at=100)
+        self.record("room_2", 2, at=200)
+        self.record("room_1", 3, at=300)
+
+        self.assertEqual([event["n"] for event in delivery.missed_events(["room_1", "user_1"], first["seq"])], [3])
+        self.assertEqual(delivery.missed_events(["room_1"], delivery.current_cursor()), [])    # older than the overlap
+        self.assertIsNone(delivery.missed_events(["room_1"], "other-0"))      # cursor of another epoch
+
+        with mock.patch("main.delivery.LOG_SIZE", 2):
+            cursor = delivery.current_cursor()
+            for n in range(3):
+                delivery.record_event("room_3", {"type": "message_stored", "n": n})
+            self.assertIsNone(delivery.missed_events(["room_3"], cursor))     # overwritten: resync
+
+    def test_events_delivered_out_of_order_are_replayed(self):
+        delivery.start_log(["room_1", "room_2"])
+        late = self.record("room_1", 1)     # sequence number taken, still being sent
+        cursor = self.record("room_2", 2)["seq"]    # delivered first, the client disconnects after it
+        self.assertLess(delivery.parse_cursor(late["seq"])[1], delivery.parse_cursor(cursor)[1])
+        self.assertEqual([event["n"] for event in delivery.missed_events(["room_1", "room_2"], cursor)], [1])
+
+        late = self.record("room_1", 3)     # same room
+        cursor = self.record("room_1", 4)["seq"]
+        self.assertEqual([event["n"] for event in delivery.missed_events(["room_1"], cursor)], [1, 3])
+
+        much_later = time.time() + delivery.REPLAY_OVERLAP + 1
+        cursor = self.record("room_1", 5, at=much_later)["seq"]
+        self.assertEqual(delivery.missed_events(["room_1"], cursor), [])
+
+    def test_steady_state_log_calls_are_batched(self):
+        groups = [f"room_{n}" for n in range(500)]
+        delivery.start_log(groups)
+        delivery.record_event("room_1", {"type": "message_stored", "n": 0})
+
+        with mock.patch.object(delivery, "cache", wraps=cache) as calls:
+            delivery.start_log(groups)     # a reconnect of a user in 500 rooms
+            self.assertEqual([call[0] for call in calls.method_calls], ["get_many"])
+            calls.reset_mock()
+            delivery.record_event("room_1", {"type": "message_stored", "n": 1})
+            self.assertEqual([call[0] for call in calls.method_calls], ["incr", "incr", "get", "set"])
+
+    @async_to_sync
+    async def test_socket_log_calls_leave_the_event_loop_on_a_shared_cache(self):
+        loop_thread = threading.get_ident()
+        log_threads = []
+
+        def start_log(groups):
+            log_threads.append(threading.get_ident())
+            delivery.start_log(groups)
+
+        with mock.patch("main.cache_io.cache_is_local", return_value=False), \
+                mock.patch("main.consumers.start_log", side_effect=start_log):
+            communicator = await self.connect(self.receiver)
+        self.assertEqual(len(log_threads), 1)
+        self.assertNotEqual(log_threads[0], loop_thread)
+        await communicator.disconnect()
+
+    def test_evicted_counter_forces_a_resync(self):
+        delivery.start_log(["room_1", "user_1"])
+        cursor = delivery.record_event("room_1", {"type": "message_stored", "n": 0})["seq"]
+        delivery.record_event("room_1", {"type": "message_stored", "n": 1})
+
+        cache.delete(delivery.count_key("user_1"))      # idle group, its counter evicted
+        self.assertIsNone(delivery.missed_events(["room_1", "user_1"], cursor))
+
+        cache.delete(delivery.count_key("room_1"))
+        delivery.record_event("room_1", {"type": "message_stored", "n": 2})    # counter starts again at 1
+        self.assertIsNone(delivery.missed_events(["room_1"], cursor))
+        self.assertEqual(delivery.missed_events(["room_1"], delivery.current_cursor()), [])
+
+    @override_settings(CACHES={"default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "eviction", "OPTIONS": {"MAX_ENTRIES": 300},
+    }})
+    def test_missed_events_are_never_dropped_silently_on_a_small_cache(self):
+        delivery.start_log(["room_1"])
+        cursor = delivery.current_cursor()
+        for n in range(10):
+            delivery.record_event("room_1", {"type": "message_stored", "n": n})
+        for group in ("room_2", "room_3"):
+            for n in range(150):
+                delivery.record_event(group, {"type": "message_stored", "n": n})
+
+        events = delivery.missed_events(["room_1"], cursor)
+        self.assertTrue(events is None or [event["n"] for event in events] == list(range(10)))
+
+    @async_to_sync
+    async def test_reconnect_replays_missed_messages_in_one_frame(self):
+        sender, receiver = await self.connect(self.sender), await self.connect(self.receiver)
+        await sender.send_json_to({"type": "send", "room_id": self.room.id, "message": "first", "client_id": "1"})
+        await sender.receive_json_from()   # ack
+        await sender.receive_json_from()   # own copy
+        cursor = (await receiver.receive_json_from())["seq"]
+        await receiver.receive_json_from()   # notification
+        await receiver.disconnect()
+
+        for i in (2, 3):
+            await sender.send_json_to({"type": "send", "room_id": self.room.id, "message": f"missed {i}", "client_id": str(i)})
+            await sender.receive_json_from()
+            await sender.receive_json_from()
+
+        receiver = await self.connect(self.receiver, since=cursor)
+        replay = await receiver.receive_json_from()
+        self.assertEqual(replay["type"], "replay")
+        self.assertEqual([frame["message"] for frame in replay["frames"] if "id" in frame], ["missed 2", "missed 3"])
+        self.assertEqual(replay["seq"], replay["frames"][-1]["seq"])
+
+        await receiver.disconnect()
+        receiver = await self.connect(self.receiver, since="stale-1")
+        self.assertEqual((await receiver.receive_json_from())["type"], "resync")
+
+        await sender.disconnect()
+        await receiver.disconnect()
+
+
+class SlowConsumerTests(SimpleTestCase):
+    def socket(self):
+        consumer = UserConsumer()
+        consumer.user = User(id=1)
+        consumer.setup_outbound({})
+        consumer.sending = True     # a send in flight that never completes: frames stay queued
+        return consumer
+
+    def fill(self, consumer):
+        consumer.queue_frame('{"type":"notification"}', "notification")
+        consumer.queue_frame('{"type":"typing"}', "typing")
+        consumer.queue_frame('{"id":1}')
+
+    @mock.patch("main.consumers.QUEUE_MAX_FRAMES", 3)
+    @mock.patch("main.consumers.SLOW_CONSUMER_POLICY", "drop_notifications")
+    def test_notifications_are_dropped_first(self):
+        consumer = self.socket()
+        self.fill(consumer)
+        consumer.queue_frame('{"type":"presence"}', "presence")   # dropped itself
+        consumer.queue_frame('{"id":2}')                          # room made by dropping queued notifications
+        self.assertEqual([data for data, _ in consumer.outbox], ['{"id":1}', '{"id":2}'])
+        self.assertEqual(consumer.outbox_bytes, 16)
+
+        consumer.queue_frame('{"id":3}')
+        consumer.queue_frame('{"id":4}')    # nothing left to drop: resync
+        self.assertEqual([frame_type for _, frame_type in consumer.outbox], ["resync"])
+        consumer.queue_frame('{"id":5}')
+        self.assertEqual(len(consumer.outbox), 1)     # dropped until the resync frame is sent
+
+    @mock.patch("main.consumers.QUEUE_MAX_BYTES", 30)
+    @mock.patch("main.consumers.SLOW_CONSUMER_POLICY", "disconnect")
+    def test_disconnect_policy(self):
+        consumer = self.socket()
+        with mock.patch.object(consumer, "close", mock.AsyncMock()) as close:
+            async def run():
+                self.fill(consumer)
+                consumer.queue_frame('{"id":2}')
+                await asyncio.sleep(0)
+            asyncio.run(run())
+        close.assert_called_once_with(code=consumers.SLOW_CONSUMER_CLOSE_CODE)
+        self.assertFalse(consumer.outbox)
+
+    def test_frames_queue_only_behind_a_pending_send(self):
+        consumer = UserConsumer()
+        consumer.user = User(id=1)
+        consumer.setup_outbound({})
+        sent = []
+
+        async def run():
+            release = asyncio.Event()
+
+            async def send(text_data=None, bytes_data=None):
+                sent.append(text_data)
+                if text_data == '{"id":1}':
+                    await release.wait()    # client not reading
+            consumer.send = send
+
+            first = asyncio.create_task(consumer.push_frame('{"id":1}'))
+            await asyncio.sleep(0)
+            await consumer.push_frame('{"id":2}')
+            self.assertEqual((sent, len(consumer.outbox)), (['{"id":1}'], 1))
+
+            release.set()
+            await first
+            self.assertEqual(sent, ['{"id":1}', '{"id":2}'])
+            await consumer.push_frame('{"id":3}')     # idle again: sent inline
+            self.assertEqual((len(sent), consumer.flusher), (3, None))
+        asyncio.run(run())
+
+    @mock.patch("main.consumers.QUEUE_MAX_FRAMES", 3)
+    @mock.patch("main.consumers.SLOW_CONSUMER_POLICY", "drop_notifications")
+    def test_frames_queue_while_the_daphne_send_buffer_is_full(self):
+        class Transport:    # the producer API of Twisted's transports
+            def __init__(self):
+                self.producer = mock.Mock()     # left by the upgraded HTTP request
+
+            def registerProducer(self, producer, streaming):
+                if self.producer is not None:
+                    raise RuntimeError("Cannot register producer, because producer was already registered.")
+                self.producer = producer
+
+            def unregisterProducer(self):
+                self.producer = None
+
+        def handle_reply(protocol, message):
+            pass
+        protocol = mock.Mock(transport=Transport())
+        http_channel = protocol.transport.producer
+        consumer = UserConsumer()
+        consumer.user = User(id=1)
+        consumer.setup_outbound({})
+        consumer.base_send = functools.partial(handle_reply, protocol)     # as Daphne calls the application
+        sent = []
+
+        async def send(text_data=None, bytes_data=None):
+            sent.append(text_data)
+        consumer.send = send
+
+        async def run():
+            consumer.watch_send_buffer()
+            await consumer.push_frame('{"id":1}')
+            protocol.transport.producer.pauseProducing()    # the client stopped reading
+            await consumer.push_frame('{"type":"typing"}', "typing")
+            for number in (2, 3, 4):
+                await consumer.push_frame(f'{{"id":{number}}}')
+            self.assertEqual(sent, ['{"id":1}'])
+            self.assertEqual([data for data, _ in consumer.outbox], ['{"id":2}', '{"id":3}', '{"id":4}'])
+
+            protocol.transport.producer.resumeProducing()     # the buffer drained
+            await consumer.flusher
+            self.assertEqual(sent, ['{"id":1}', '{"id":2}', '{"id":3}', '{"id":4}'])
+            http_channel.pauseProducing.assert_called_once_with()
+            http_channel.resumeProducing.assert_called_once_with()
+        asyncio.run(run())
+
+    def test_msgpack_batch_is_spliced(self):
+        frames = [msgpack.packb({"id": 1}), msgpack.packb({"id": 2})]
+        self.assertEqual(msgpack.unpackb(consumers.msgpack_batch(frames)), {"type": "batch", "frames": [{"id": 1}, {"id": 2}]})
+
+
+class RateLimitTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("sender@example.com", "sender", "pass")
+        self.other = User.objects.create_user("other@example.com", "other", "pass")
+        self.private = ChatRoom.objects.create(is_group=False, private_key=f"private_{self.user.id}_{self.other.id}")
+        self.group = ChatRoom.objects.create(group_name="group", is_group=True, created_by=self.user)
+        for room in (self.private, self.group):
+            ChatRoomMember.objects.create(room=room, user=self.user)
+            ChatRoomMember.objects.create(room=room, user=self.other)
+
+        budgets = {"private": (2, 0.01), "group": (1, 0.01), "room": (3, 0.01)}
+        for patcher in (mock.patch("main.ratelimit.SEND_BUDGETS", budgets), mock.patch("main.ratelimit._buckets", ratelimit.LocalBuckets())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_http_sends_over_budget_are_rejected(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = f"/api/rooms/{self.private.id}/send/"
+
+        for text in ("one", "two"):
+            self.assertEqual(client.post(url, {"message": text}).status_code, 201)
+        response = client.post(url, {"message": "three"})
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(1 <= int(response["Retry-After"]) <= 100)
+
+        # group sends have their own budget
+        self.assertEqual(client.post(f"/api/rooms/{self.group.id}/send/", {"message": "group"}).status_code, 201)
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_room_budget_is_shared_and_taken_all_or_nothing(self):
+        ratelimit.SEND_BUDGETS["group"] = (5, 0.01)
+        self.assertEqual(ratelimit.check_send(self.user.id, self.group.id, True), 0)
+        self.assertEqual(ratelimit.check_send(self.other.id, self.group.id, True), 0)
+        self.assertEqual(ratelimit.check_send(self.user.id, self.group.id, True), 0)
+        self.assertGreater(ratelimit.check_send(self.other.id, self.group.id, True), 0)    # room budget spent
+
+        # the refused send did not spend the user's own tokens
+        tokens, _ = ratelimit.get_buckets().get_many([f"ratelimit:group:{self.other.id}"])[f"ratelimit:group:{self.other.id}"]
+        self.assertEqual(tokens, 4)
+
+    @async_to_sync
+    async def test_socket_sends_and_frames_over_budget_are_throttled(self):
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), "/ws/user/")
+        communicator.scope["user"] = self.user
+        self.assertTrue((await communicator.connect())[0])
+
+        await communicator.send_json_to({"type": "send", "room_id": self.group.id, "message": "first", "client_id": "a"})
+        self.assertEqual((await communicator.receive_json_from())["type"], "ack")
+        await communicator.receive_json_from()      # own copy
+        await communicator.send_json_to({"type": "send", "room_id": self.group.id, "message": "second", "client_id": "b"})
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame["type"], frame["client_id"]), ("throttled", "b"))
+        self.assertGreater(frame["retry_after"], 0)
+        self.assertEqual(await Message.objects.filter(sender=self.user).acount(), 1)
+
+        with mock.patch("main.consumers.FRAME_BUCKET", ratelimit.TokenBucket(0, 0.01)):
+            for _ in range(3):
+                await communicator.send_json_to({"type": "heartbeat"})
+            self.assertEqual((await communicator.receive_json_from())["type"], "throttled")
+            self.assertTrue(await communicator.receive_nothing())   # told once, then dropped
+
+        await communicator.disconnect()
+
+    def test_local_buckets_drop_the_least_recently_used(self):
+        buckets = ratelimit.LocalBuckets()
+        with mock.patch("main.ratelimit.LOCAL_MAX_BUCKETS", 3):
+            for key in "abcd":
+                buckets.set_many({key: (1, 0)}, 60)
+            buckets.set_many({"b": (0, 0)}, 60)     # used again
+            buckets.set_many({"e": (1, 0)}, 60)
+            self.assertEqual(list(buckets.states), ["d", "b", "e"])
+
+            with mock.patch("time.monotonic", return_value=time.monotonic() + 120):    # all of them full again
+                buckets.set_many({"f": (1, 0)}, 60)
+            self.assertEqual(list(buckets.states), ["f"])     # a few expired ones are dropped per write
+
+    @async_to_sync
+    async def test_socket_checks_on_a_shared_cache_leave_the_event_loop(self):
+        buckets = ratelimit.CacheBuckets()
+        read_threads = []
+
+        def get_many(keys):
+            read_threads.append(threading.get_ident())
+            return cache.get_many(keys)
+
+        with mock.patch("main.ratelimit._buckets", buckets), mock.patch.object(buckets, "get_many", side_effect=get_many), \
+                mock.patch("main.cache_io.cache_is_local", return_value=False):
+            self.assertEqual(await ratelimit.acheck_send(self.user.id, self.private.id, False), 0)
+            self.assertEqual(await ratelimit.acheck_send(self.user.id, self.private.id, False), 0)
+            self.assertGreater(await ratelimit.acheck_send(self.user.id, self.private.id, False), 0)
+        self.assertEqual(len(read_threads), 3)
+        self.assertNotIn(threading.get_ident(), read_threads)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class SocketAuthTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("user@example.com", "user", "pass")
+        self.middleware = JWTAuthMiddleware(UserConsumer.as_asgi())
+
+    def authenticate(self, raw_token):
+        return async_to_sync(self.middleware.authenticate)(raw_token)
+
+    def test_login_token_is_authenticated_from_its_claims(self):
+        access = get_tokens_for_user(self.user)["access"]
+        with mock.patch("main.middleware.get_user") as get_user:
+            user = self.authenticate(access)
+        get_user.assert_not_called()
+        self.assertEqual((user.id, user.username, user.is_authenticated), (self.user.id, "user", True))
+
+    def test_logout_revokes_the_access_token(self):
+        tokens = get_tokens_for_user(self.user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.assertEqual(client.post("/api/logout/", {"refresh": tokens["refresh"]}).status_code, 205)
+
+        # a fresh middleware loads the blacklist at once, a running one within its snapshot TTL
+        self.assertFalse(self.authenticate(tokens["access"]).is_authenticated)
+
+        running = JWTAuthMiddleware(UserConsumer.as_asgi())
+        other = get_tokens_for_user(self.user)
+        self.assertTrue(async_to_sync(running.authenticate)(other["access"]).is_authenticated)
+        client.post("/api/logout/", {"refresh": other["refresh"]})
+        running.revocations.expires = 0     # snapshot TTL elapsed
+        self.assertFalse(async_to_sync(running.authenticate)(other["access"]).is_authenticated)
+
+    def test_expired_and_tampered_tokens_are_anonymous(self):
+        expired = AccessToken.for_user(self.user)
+        expired.set_exp(lifetime=-timedelta(seconds=1))
+        self.assertFalse(self.authenticate(str(expired)).is_authenticated)
+
+        header, payload, signature = get_tokens_for_user(self.user)["access"].split(".")
+        forged = AccessToken.for_user(User.objects.create_user("other@example.com", "other", "pass"))
+        self.assertFalse(self.authenticate(".".join([header, str(forged).split(".")[1], signature])).is_authenticated)
+        self.assertFalse(self.authenticate("not-a-token").is_authenticated)
+
+    def test_tokens_without_username_use_the_user_cache(self):
+        token = str(AccessToken.for_user(self.user))    # issued before tokens carried the username
+        with mock.patch("main.middleware.get_user", wraps=middleware.get_user) as get_user:
+            self.assertEqual(self.authenticate(token), self.user)
+            self.assertEqual(self.authenticate(token), self.user)
+        self.assertEqual(get_user.call_count, 1)     # second handshake served by the TTL cache
+
+        self.middleware.users.entries.clear()
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        self.assertFalse(self.authenticate(token).is_authenticated)
+
+    def test_deactivated_user_is_refused_on_the_claims_path(self):
+        access = get_tokens_for_user(self.user)["access"]
+        self.assertTrue(self.authenticate(access).is_authenticated)
+
+        self.user.is_active = False
+        self.user.save()
+        self.middleware.revocations.expires = 0     # snapshot TTL elapsed
+        self.assertFalse(self.authenticate(access).is_authenticated)
+
+    @async_to_sync
+    async def test_revoked_token_is_refused_at_the_handshake(self):
+        tokens = await database_sync_to_async(get_tokens_for_user)(self.user)
+        communicator = WebsocketCommunicator(self.middleware, f"/ws/user/?token={tokens['access']}")
+        self.assertTrue((await communicator.connect())[0])
+        await communicator.disconnect()
+
+        await database_sync_to_async(lambda: RefreshToken(tokens["refresh"]).blacklist())()
+        self.middleware.revocations.expires = 0
+        communicator = WebsocketCommunicator(self.middleware, f"/ws/user/?token={tokens['access']}")
+        self.assertFalse((await communicator.connect())[0])
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class RoomCacheTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user("owner@example.com", "owner", "pass")
+        self.other = User.objects.create_user("other@example.com", "other", "pass")
+        self.group = ChatRoom.objects.create(group_name="group", is_group=True, created_by=self.owner)
+        ChatRoomMember.objects.create(room=self.group, user=self.owner)
+
+    def test_membership_changes_and_renames_invalidate_the_entry(self):
+        self.assertEqual(get_room_info(self.group.id).member_ids, (self.owner.id,))
+
+        member = ChatRoomMember.objects.create(room=self.group, user=self.other)
+        self.assertEqual(get_room_info(self.group.id).member_ids, (self.owner.id, self.other.id))
+
+        member.delete()
+        self.assertEqual(get_room_info(self.group.id).member_ids, (self.owner.id,))
+
+        self.group.group_name = "renamed"
+        self.group.save()
+        self.assertEqual(get_room_info(self.group.id).name, "renamed")
+
+        self.group.delete()
+        self.assertIsNone(get_room_info(self.group.id))
+
+    def test_entry_loaded_before_a_concurrent_change_is_not_served(self):
+        def load_then_change(room_id):
+            info = load_room_info(room_id)
+            ChatRoomMember.objects.create(room=self.group, user=self.other)     # commits and invalidates meanwhile
+            return info
+
+        with mock.patch("main.room_cache.load_room_info", side_effect=load_then_change):
+            self.assertEqual(get_room_info(self.group.id).member_ids, (self.owner.id,))   # stale for this lookup only
+
+        self.assertIsNone(room_cache.cached_room_info(self.group.id))
+        self.assertEqual(get_room_info(self.group.id).member_ids, (self.owner.id, self.other.id))
+
+    @async_to_sync
+    async def test_socket_lookups_leave_the_event_loop_on_a_shared_cache(self):
+        loop_thread = threading.get_ident()
+        lookup_threads = []
+
+        def cached(room_id):
+            lookup_threads.append(threading.get_ident())
+            return room_cache.cached_room_info(room_id)
+
+        consumer = UserConsumer()
+        await database_sync_to_async(get_room_info)(self.group.id)
+        with mock.patch("main.consumers.cached_room_info", side_effect=cached):
+            self.assertEqual((await consumer.get_room_info(self.group.id)).member_ids, (self.owner.id,))
+            with mock.patch("main.cache_io.cache_is_local", return_value=False):    # Redis or files
+                self.assertEqual((await consumer.get_room_info(self.group.id)).member_ids, (self.owner.id,))
+        self.assertEqual(lookup_threads[0], loop_thread)    # in-process memory: inline
+        self.assertNotEqual(lookup_threads[1], loop_thread)
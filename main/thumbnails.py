@@ -0,0 +1,121 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from .delivery import record_event
+from .layers import group_send_from_thread
+from .models import Message
+from .signals import room_group_name
+from .storage import signed_media_url
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZES = getattr(settings, "CHAT_THUMBNAIL_SIZES", {"small": 160, "medium": 480, "large": 1080})   # label -> longest side in px
+THUMBNAIL_QUALITY = getattr(settings, "CHAT_THUMBNAIL_QUALITY", 80)
+THUMBNAIL_WORKERS = getattr(settings, "CHAT_THUMBNAIL_WORKERS", 2)   # 0 generates inline, for scripts and tests
+
+_executor = None
+
+
+def thumbnail_name(image_name, label):
+    return f"thumbs/{label}/{image_name}.jpg"
+
+
+def thumbnail_urls(message):
+    return {label: signed_media_url(name) for label, name in (message.thumbnails or {}).items()}
+
+
+def render_thumbnails(image_file):
+    """
+    Yield (label, jpeg bytes) for every size smaller than the image; the file is decoded once
+    """
+    with Image.open(image_file) as image:
+        image.draft("RGB", (max(THUMBNAIL_SIZES.values()),) * 2)   # JPEGs are decoded at a reduced scale when possible
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        # largest first so each size is resampled from the previous one instead of the original
+        for label, size in sorted(THUMBNAIL_SIZES.items(), key=lambda item: -item[1]):
+            if max(image.size) <= size:
+                continue    # clients use the original, it is no larger than this thumbnail
+            image = image.copy()
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+            output = BytesIO()
+            image.save(output, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+            yield label, output.getvalue()
+
+
+def write_thumbnails(message):
+    thumbnails = {}
+    with message.image.open("rb") as image_file:
+        for label, data in render_thumbnails(image_file):
+            name = thumbnail_name(message.image.name, label)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            thumbnails[label] = default_storage.save(name, ContentFile(data))
+    return thumbnails
+
+
+def generate_thumbnails(message):
+    """
+    Write the thumbnails of a message image, store their names and tell the room
+    """
+    # a deduplicated image shared with another message already has its thumbnails
+    thumbnails = (
+        Message.objects.filter(image=message.image.name).exclude(id=message.id).exclude(thumbnails={})
+        .values_list("thumbnails", flat=True).first()
+    )
+    if not thumbnails:
+        try:
+            thumbnails = write_thumbnails(message)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            logger.warning("Could not create thumbnails for message %s (%s)", message.id, message.image.name, exc_info=True)
+            return {}
+
+    Message.objects.filter(id=message.id).update(thumbnails=thumbnails)
+    message.thumbnails = thumbnails
+
+    if thumbnails:
+        group_name = room_group_name(message.room_id)
+        group_send_from_thread(group_name, record_event(group_name, {
+            "type": "message_thumbnails",
+            "room_id": message.room_id,
+            "message_id": message.id,
+            "thumbnails": thumbnail_urls(message),
+        }))
+    return thumbnails
+
+
+def run_generate(message_id):
+    close_old_connections()
+    try:
+        message = Message.objects.filter(id=message_id).exclude(image="").exclude(image=None).first()
+        if message is not None:
+            generate_thumbnails(message)
+    except Exception:
+        logger.exception("Thumbnail generation failed for message %s", message_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_thumbnails(message):
+    """
+    Generate the thumbnails in the background once the message is committed
+    """
+    global _executor
+
+    if THUMBNAIL_WORKERS == 0:
+        transaction.on_commit(lambda: run_generate(message.id))
+        return
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnails")
+    transaction.on_commit(lambda: _executor.submit(run_generate, message.id))
@@ -0,0 +1,106 @@
+import os
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import ChatRoomMember, Message, StoredBlob
+from .storage import file_digest
+
+READ_SIZE = getattr(settings, "CHAT_UPLOAD_READ_SIZE", 64 * 1024)             # bytes held in memory while streaming a chunk
+MAX_UPLOAD_SIZE = getattr(settings, "CHAT_UPLOAD_MAX_SIZE", 200 * 1024 * 1024)
+MAX_CHUNK_SIZE = getattr(settings, "CHAT_UPLOAD_MAX_CHUNK_SIZE", 8 * 1024 * 1024)
+SESSION_TTL = getattr(settings, "CHAT_UPLOAD_SESSION_TTL", 24 * 3600)         # seconds an unfinished upload is kept
+
+
+def upload_field(session):
+    return Message._meta.get_field(session.kind)
+
+
+def part_path(session):
+    """
+    Partial file in the destination directory under MEDIA_ROOT; finalize only renames it
+    """
+    field = upload_field(session)
+    return field.storage.path(os.path.join(field.upload_to, f".{session.id.hex}.part"))
+
+
+def shared_blob(user, sha256, size):
+    """
+    Name of a stored blob with this content that the user can already see in one of their rooms.
+    Knowing a hash is not proof of having the file, so blobs only visible to others are not reused.
+    """
+    names = list(StoredBlob.objects.filter(sha256=sha256, size=size, refcount__gt=0).values_list("name", flat=True))
+    if not names:
+        return None
+
+    rooms = ChatRoomMember.objects.filter(user=user).values("room_id")
+    message = Message.objects.filter(Q(image__in=names) | Q(document__in=names), room_id__in=rooms).values("image", "document").first()
+    if message is None:
+        return None
+    return message["image"] if message["image"] in names else message["document"]
+
+
+def create_part(session):
+    path = part_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "xb").close()
+
+
+def append_chunk(session, stream, length):
+    """
+    Write `length` bytes from `stream` at the session offset, READ_SIZE bytes at a time.
+    The data is synced to disk before returning so an acknowledged offset survives a crash.
+    Returns the number of bytes written, which is short when the client disconnected.
+    """
+    written = 0
+    with open(part_path(session), "r+b") as part:
+        part.seek(session.offset)
+        while written < length:
+            data = stream.read(min(READ_SIZE, length - written))
+            if not data:
+                break
+            part.write(data)
+            written += len(data)
+        part.truncate()     # drop bytes left by an earlier attempt past this point
+        part.flush()
+        os.fsync(part.fileno())
+    return written
+
+
+def finalize_part(session):
+    """
+    Move the complete file to its final name, returns the storage name for the Message field.
+    Raises ValueError when the content does not match the SHA-256 announced at initiate.
+    """
+    if session.blob:
+        return session.blob    # duplicate found at initiate, nothing was uploaded
+
+    field = upload_field(session)
+    source = part_path(session)
+
+    digest = None
+    if session.sha256 or hasattr(field.storage, "store_file"):
+        digest = file_digest(source)    # one sequential read of the part file
+        if session.sha256 and digest != session.sha256:
+            raise ValueError("Uploaded content does not match sha256")
+
+    if hasattr(field.storage, "store_file"):
+        return field.storage.store_file(source, session.filename, digest)   # content addressed: renamed, or dropped as a duplicate
+
+    while True:
+        name = field.storage.get_available_name(field.generate_filename(None, session.filename))
+        try:
+            os.link(source, field.storage.path(name))   # fails instead of overwriting a file that appeared meanwhile
+        except FileExistsError:
+            continue
+        os.unlink(source)
+        return name
+
+
+def discard_part(session):
+    if session.blob:
+        return
+    try:
+        os.unlink(part_path(session))
+    except FileNotFoundError:
+        pass
@@ -16,18 +16,25 @@ urlpatterns = [
     #path( "", views.login_page, name="login_page"),
 
     path("me/", views.MeView.as_view()),
+    path("messages/search/", views.MessageSearchView.as_view()),                     # search the user's rooms, before the inbox route
     path("messages/<user_id>/", views.MyInboxView.as_view()),
     path("rooms/<int:room_id>/messages/", views.GetMessageView.as_view()), # get messages in a room older 
+    path("rooms/<int:room_id>/messages/search/", views.MessageSearchView.as_view()),  # search one room
     path("rooms/<int:room_id>/send/", views.SendMessageView.as_view()),    # send message to a room
     path("rooms/private/<int:user_id>/", views.GetOrCreatePrivateRoomView.as_view()),
     path("profile/<int:pk>/", views.UpdateProfileView.as_view()),
     path("search/<str:username>/", views.SearchUserView.as_view()),
     path("users/", views.SearchUserView.as_view()),
+    path("presence/", views.PresenceView.as_view()),                               # ?ids=1,2,3
+    path("metrics/sockets/", views.SocketMetricsView.as_view()),                   # staff only, per process
     path("groups/create/", views.CreateGroupView.as_view()),
     path("groups/", views.GroupListView.as_view()),
     path("groups/<int:room_id>/add-member/", views.AddGroupMemberView.as_view()),
     path("groups/<int:room_id>/remove-member/<int:user_id>/", views.RemoveGroupMemberView.as_view()),
     path("rooms/<int:room_id>/upload/", views.FileUploadView.as_view()),
+    path("rooms/<int:room_id>/uploads/", views.UploadInitiateView.as_view()),     # chunked upload: initiate
+    path("uploads/<uuid:upload_id>/", views.UploadChunkView.as_view()),           # resume offset, append chunk, abort
+    path("uploads/<uuid:upload_id>/finalize/", views.UploadFinalizeView.as_view()),
 
     path("chat/", chat_test),
 ]   
\ No newline at end of file
@@ -1,9 +1,10 @@
+import os
 from django.db.models import Subquery, OuterRef, Q, Max, F
 from django.shortcuts import get_object_or_404, render
 from django.contrib.auth import authenticate
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.decorators import APIView, permission_classes
 from rest_framework import status
 from rest_framework import generics
@@ -12,10 +13,30 @@ from .serializer import *
 from rest_framework.parsers import MultiPartParser, FormParser
 from django.core.exceptions import PermissionDenied
 from django.db.models import Count
-from rest_framework.pagination import PageNumberPagination 
+from rest_framework.pagination import PageNumberPagination, BasePagination, LimitOffsetPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.throttling import UserRateThrottle
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 from django.db import transaction
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
+from .inbox import mark_room_read
+from .ingest import INGEST_MODE, ingest_message
+from .uploads import MAX_CHUNK_SIZE, MAX_UPLOAD_SIZE, append_chunk, create_part, discard_part, finalize_part, shared_blob
+from .room_cache import get_room_info
+from .search import search_users
+from .message_search import search_postings
+from .presence import MAX_PRESENCE_IDS, get_presence
+from .ratelimit import MessageSendThrottle
+from .delivery import record_event
+from .consumers import socket_metrics
+from .signals import chat_message_event, encode_chat_frames, message_payload, room_group_name
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from .middleware import REFRESH_JTI_CLAIM
 
 
 
@@ -24,9 +45,13 @@ from django.utils.decorators import method_decorator
 
 def get_tokens_for_user(user):
     refresh = RefreshToken.for_user(user)
+    refresh['username'] = user.username   # lets the WebSocket handshake build the user from the token alone
+
+    access = refresh.access_token
+    access[REFRESH_JTI_CLAIM] = refresh['jti']   # blacklisting the refresh token also rejects this access token on the socket
     return {
         'refresh': str(refresh),
-        'access': str(refresh.access_token),
+        'access': str(access),
     }
 
 
@@ -88,11 +113,204 @@ class LogoutView(generics.DestroyAPIView):
 
 class ChatPagination(PageNumberPagination):
     page_size = 20
-    page_query_param = 'page_size'
+    page_query_param = 'page'
+    page_size_query_param = 'page_size'
     max_page_size = 50
 
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination over (created_at, id) for room history, backed by message_room_history_idx.
+    No cursor returns the latest page, ?before=<cursor> the page of older messages and
+    ?after=<cursor> the page of newer ones. Results are oldest first; `next` points to older
+    messages and `previous` to newer ones. Every page costs one index range read however deep it is.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        before = self.decode_cursor(request.query_params.get('before'))
+        after = self.decode_cursor(request.query_params.get('after'))
+
+        if after:
+            created_at, message_id = after
+            rows = list(queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=message_id)
+            ).order_by('created_at', 'id')[:self.page_size + 1])
+
+            self.has_newer = len(rows) > self.page_size
+            rows = rows[:self.page_size]
+            self.has_older = True      # at least the cursor message itself is older
+            self.older_cursor = self.encode_cursor(rows[0]) if rows else request.query_params['after']
+        else:
+            if before:
+                created_at, message_id = before
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+                )
+            rows = list(queryset.order_by('-created_at', '-id')[:self.page_size + 1])
+
+            self.has_older = len(rows) > self.page_size
+            rows = rows[:self.page_size]
+            rows.reverse()   # oldest first within the page
+            self.has_newer = before is not None
+            self.older_cursor = self.encode_cursor(rows[0]) if rows else None
+
+        self.newer_cursor = self.encode_cursor(rows[-1]) if rows else request.query_params.get('before')
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def encode_cursor(self, message):
+        return urlsafe_base64_encode(f"{message.created_at.isoformat()}|{message.id}".encode())
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            created_at, message_id = urlsafe_base64_decode(cursor).decode().split('|')
+            created_at = parse_datetime(created_at)
+            message_id = int(message_id)
+        except (ValueError, UnicodeDecodeError):
+            raise NotFound("Invalid cursor")
+        if created_at is None:
+            raise NotFound("Invalid cursor")
+        return created_at, message_id
+
+    def get_link(self, param, cursor):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(remove_query_param(url, 'before'), 'after')
+        return replace_query_param(url, param, cursor)
+
+    def get_next_link(self):
+        if not self.has_older or not self.older_cursor:
+            return None
+        return self.get_link('before', self.older_cursor)
+
+    def get_previous_link(self):
+        if not self.has_newer or not self.newer_cursor:
+            return None
+        return self.get_link('after', self.newer_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),         # older messages
+            'previous': self.get_previous_link(), # newer messages
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+class MessageSearchPagination(BasePagination):
+    """
+    Keyset pagination over message id for search results, newest first; ?before=<cursor>
+    continues after the last result of the previous page with one more index range read
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        before = self.decode_cursor(request.query_params.get('before'))
+        if before:
+            queryset = queryset.filter(message_id__lt=before)
+        message_ids = list(queryset.order_by('-message_id').values_list('message_id', flat=True)[:self.page_size + 1])
+
+        self.has_more = len(message_ids) > self.page_size
+        message_ids = message_ids[:self.page_size]
+        messages = Message.objects.filter(id__in=message_ids).select_related('sender').in_bulk()
+        rows = [messages[message_id] for message_id in message_ids if message_id in messages]
+
+        self.cursor = urlsafe_base64_encode(str(message_ids[-1]).encode()) if message_ids else None
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            return int(urlsafe_base64_decode(cursor).decode())
+        except (ValueError, UnicodeDecodeError):
+            raise NotFound("Invalid cursor")
+
+    def get_next_link(self):
+        if not self.has_more:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), 'before', self.cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),    # older matches
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class MessageSearchView(generics.ListAPIView):
+    """
+    Full-text search of message history: ?q= matches messages containing every word of the
+    query, in one room (rooms/<room_id>/messages/search/) or in all rooms of the user.
+    Newest first, with a highlighted snippet per result
+    """
+    serializer_class = MessageSearchSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = MessageSearchPagination
+
+    def get_queryset(self):
+        user = self.request.user
+        room_id = self.kwargs.get('room_id')
+
+        if room_id is not None and not ChatRoomMember.objects.filter(room_id=room_id, user=user).exists():
+            self.search_terms = []
+            return MessageToken.objects.none()
+
+        postings, self.search_terms = search_postings(self.request.query_params.get('q', ''), user, room_id)
+        return postings
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['search_terms'] = getattr(self, 'search_terms', [])
+        return context
+
+
 class MyInboxView(generics.ListAPIView):
-    serializer_class = MessageSerializer
+    serializer_class = InboxSerializer
     permission_classes = [IsAuthenticated]
     pagination_class = ChatPagination
 
@@ -107,26 +325,13 @@ class MyInboxView(generics.ListAPIView):
         user_id = self.kwargs['user_id']
 
         if self.request.user.id != int(user_id):
-            return Message.objects.none()
+            return ChatRoomMember.objects.none()
         
-
-        rooms = ChatRoom.objects.filter(members__user=user).distinct() # get all rooms of the user 
-
-        # Get the last message for each room
-        last_message_ids = (
-            Message.objects.filter(room=OuterRef("pk"))
-            .order_by("-created_at")
-            .values("id")[:1] 
-        )    
-
-        rooms = rooms.annotate(last_message_ids=Subquery(last_message_ids)).exclude(last_message_ids=None)
-
-        message = (Message.objects.filter(id__in=rooms.values("last_message_ids"))
-        .select_related('sender', 'room')
-        .order_by("-created_at")
+        # one row per conversation from the summary kept on the membership, read through member_inbox_idx
+        return (ChatRoomMember.objects.filter(user=user, last_message__isnull=False)
+        .select_related('room', 'other_user', 'last_message__sender')
+        .order_by('-last_activity_at', '-id')
         )
-
-        return message
     
 
 class GetOrCreatePrivateRoomView(generics.CreateAPIView):    # get or create private chat room between two users
@@ -190,7 +395,7 @@ class GetOrCreatePrivateRoomView(generics.CreateAPIView):    # get or create pri
 class GetMessageView(generics.ListAPIView): 
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
-    pagination_class = ChatPagination
+    pagination_class = MessageCursorPagination
     
     def get_queryset(self):
         user = self.request.user
@@ -201,23 +406,39 @@ class GetMessageView(generics.ListAPIView):
         if not room:
             return Message.objects.none()
         
-        unread_messages = Message.objects.filter(
-            room__id=room_id).exclude(
-                sender=user
-            )
-
-        for message in unread_messages:
-            if user.id not in message.read_by:
-                message.read_by.append(user.id)
-                message.save(update_fields=['read_by'])    #mark messages as read by adding user id to read_by list
+        mark_room_read(room_id, user.id)    #move the user's read watermark to the newest message
 
-        return Message.objects.filter(room_id=room_id).select_related('sender').order_by('created_at')
+        return Message.objects.filter(room_id=room_id).select_related('sender')   # ordered by the cursor paginator
 
 
 
 class SendMessageView(generics.CreateAPIView):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
+    throttle_classes = [UserRateThrottle, MessageSendThrottle]
+
+    def create(self, request, *args, **kwargs):
+        if INGEST_MODE != "write_behind":
+            return super().create(request, *args, **kwargs)
+
+        # write-behind: queue the message, broadcast it now and answer 202; the id follows in "message_stored"
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        room = get_room_info(self.kwargs['room_id'])
+        if room is None or request.user.id not in room.member_ids:
+            raise PermissionDenied("You are not a member of this chat room.")
+
+        client_id = request.data.get('client_id') or None
+        message, created = ingest_message(self.kwargs['room_id'], request.user.id, serializer.validated_data.get('message', ''), client_id)
+        payload = message_payload(message, request.user.username)
+
+        channel_layer = get_channel_layer()
+        if created and channel_layer is not None:
+            group_name = room_group_name(message.room_id)
+            event = record_event(group_name, chat_message_event(room, payload))
+            async_to_sync(channel_layer.group_send)(group_name, encode_chat_frames(event))
+        return Response(payload, status=status.HTTP_202_ACCEPTED)
 
     def perform_create(self, serializer):
         room_id = self.kwargs['room_id']
@@ -233,11 +454,10 @@ class SendMessageView(generics.CreateAPIView):
 class FileUploadView(generics.CreateAPIView):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
+    throttle_classes = [UserRateThrottle, MessageSendThrottle]
     parser_classes = [MultiPartParser, FormParser]
 
     def perform_create(self, serializer): #override post method to add room and sender before saving
-        print("FILES:", self.request.FILES)
-        print("DATA:", self.request.data)
         room_id = self.kwargs['room_id']
         
         room = get_object_or_404(ChatRoom, id=room_id)
@@ -253,6 +473,134 @@ class FileUploadView(generics.CreateAPIView):
     
 
 
+class UploadInitiateView(APIView):
+    """
+    Start a chunked upload: {"filename", "size", "kind": "image" | "document", "sha256"}.
+    Chunks are then sent with PATCH to the returned upload URL and the message is
+    created by the finalize call. With the optional sha256 a file already shared in
+    one of the user's rooms is not uploaded again: the upload starts complete.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [UserRateThrottle, MessageSendThrottle]     # each upload becomes a message
+
+    def post(self, request, room_id):
+        if not ChatRoomMember.objects.filter(room_id=room_id, user=request.user).exists():
+            return Response({"detail":"You are not a member of this chat room."}, status=status.HTTP_403_FORBIDDEN)
+
+        filename = os.path.basename(str(request.data.get('filename') or ''))
+        kind = request.data.get('kind', 'document')
+        try:
+            size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            size = -1
+
+        if not filename or kind not in dict(UploadSession.KIND_CHOICES):
+            return Response({"detail":"filename and kind (image or document) are required"}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 < size <= MAX_UPLOAD_SIZE:
+            return Response({"detail":f"size must be between 1 and {MAX_UPLOAD_SIZE} bytes"}, status=status.HTTP_400_BAD_REQUEST)
+
+        sha256 = str(request.data.get('sha256') or '').lower()
+        if sha256 and (len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256)):
+            return Response({"detail":"sha256 must be 64 hexadecimal characters"}, status=status.HTTP_400_BAD_REQUEST)
+
+        blob = shared_blob(request.user, sha256, size) if sha256 else None
+        session = UploadSession.objects.create(
+            room_id=room_id, uploader=request.user, kind=kind, filename=filename, size=size,
+            sha256=sha256, blob=blob or '', offset=size if blob else 0
+        )
+        if not blob:
+            create_part(session)
+        return Response(upload_status(session), status=status.HTTP_201_CREATED)
+
+
+def upload_status(session):
+    return {
+        "id": session.id,
+        "offset": session.offset,
+        "size": session.size,
+        "max_chunk_size": MAX_CHUNK_SIZE,
+        "duplicate": bool(session.blob),
+        "upload_url": f"/api/uploads/{session.id}/",
+    }
+
+
+class UploadChunkView(APIView):
+    """
+    GET returns the offset to resume from, PATCH appends a chunk sent as the raw request body
+    with an Upload-Offset header, DELETE abandons the upload
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, upload_id):
+        session = get_object_or_404(UploadSession, id=upload_id, uploader=request.user)
+        return Response(upload_status(session))
+
+    def patch(self, request, upload_id):
+        session = get_object_or_404(UploadSession, id=upload_id, uploader=request.user)
+
+        try:
+            offset = int(request.headers.get('Upload-Offset'))
+            length = int(request.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            return Response({"detail":"Upload-Offset and Content-Length headers are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if offset != session.offset:   # client resumes from the offset the server has
+            return Response({"detail":"Offset mismatch", "offset": session.offset}, status=status.HTTP_409_CONFLICT)
+        if length > MAX_CHUNK_SIZE or offset + length > session.size:
+            return Response({"detail":"Chunk too large"}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        written = append_chunk(session, request.stream, length)   # streamed, request.data is never parsed
+
+        # conditional update: a concurrent PATCH for the same offset loses instead of double counting
+        if not UploadSession.objects.filter(id=session.id, offset=offset).update(offset=offset + written, updated_at=timezone.now()):
+            session.refresh_from_db()
+            return Response({"detail":"Offset mismatch", "offset": session.offset}, status=status.HTTP_409_CONFLICT)
+
+        session.offset = offset + written
+        return Response(upload_status(session))
+
+    def delete(self, request, upload_id):
+        session = get_object_or_404(UploadSession, id=upload_id, uploader=request.user)
+        discard_part(session)
+        session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadFinalizeView(APIView):
+    """
+    Create the message once every byte is received; optional {"message"} caption
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, upload_id):
+        session = get_object_or_404(UploadSession, id=upload_id, uploader=request.user)
+
+        if session.offset != session.size:
+            return Response({"detail":"Upload is incomplete", "offset": session.offset}, status=status.HTTP_409_CONFLICT)
+        if not ChatRoomMember.objects.filter(room_id=session.room_id, user=request.user).exists():
+            return Response({"detail":"You are not a member of this chat room."}, status=status.HTTP_403_FORBIDDEN)
+
+        with transaction.atomic():
+            # the session row is locked so a repeated finalize cannot create a second message
+            if not UploadSession.objects.select_for_update().filter(id=session.id).exists():
+                return Response({"detail":"Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+            try:
+                name = finalize_part(session)
+            except ValueError as e:
+                discard_part(session)
+                session.delete()
+                return Response({"detail":str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            message = Message(room_id=session.room_id, sender=request.user, message=request.data.get('message', ''))
+            getattr(message, session.kind).name = name
+            message.save()
+            session.delete()
+
+        serializer = MessageSerializer(message, context={"request": request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
 class UpdateProfileView(generics.RetrieveUpdateAPIView):
     serializer_class = ProfileSerializer
     permission_classes = [IsAuthenticated]
@@ -351,24 +699,52 @@ class RemoveGroupMemberView(generics.DestroyAPIView):
         return Response({"detail":"User removed from group successfully"}, status=status.HTTP_200_OK)
 
 
+class UserSearchPagination(LimitOffsetPagination):
+    default_limit = 10
+    max_limit = 50
+
+
 class SearchUserView(generics.ListAPIView):
+    """
+    Typeahead search by prefix of username, full name, email or any of their words,
+    through the UserSearchTerm index; ranked, paginated with ?limit=&offset=
+    """
     serializer_class = ProfileSerializer
     permission_classes = [IsAuthenticated]
-    #queryset = Profile.objects.all()
+    pagination_class = UserSearchPagination
 
     def get_queryset(self):
 
-        username = self.kwargs.get('username')
-        logged_in_user = self.request.user
+        query = self.kwargs.get('username') or self.request.query_params.get('q', '')
 
-        users = Profile.objects.filter(
-            (Q(user__username__icontains=username) |
-            Q(full_name__icontains=username) |
-            Q(user__email__icontains=username))
-            &
-            ~Q(user=logged_in_user)#not logged in user/except logged in user
-        )
-        return users
+        return search_users(query, exclude_user=self.request.user)   #not logged in user/except logged in user
+
+
+class PresenceView(APIView):
+    """
+    Online state and last seen time of many users: ?ids=1,2,3, answered from the cache
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        ids = [part for part in request.query_params.get('ids', '').split(',') if part.strip()]
+        if not all(part.strip().isdigit() for part in ids):
+            return Response({"detail":"ids must be a comma separated list of user ids"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > MAX_PRESENCE_IDS:
+            return Response({"detail":f"At most {MAX_PRESENCE_IDS} ids per request"}, status=status.HTTP_400_BAD_REQUEST)
+
+        presence = get_presence(int(part) for part in ids)
+        return Response({"results": list(presence.values())}, status=status.HTTP_200_OK)
+
+
+class SocketMetricsView(APIView):
+    """
+    Outbound queue depth and slow consumer actions of the sockets served by this process
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(socket_metrics(), status=status.HTTP_200_OK)
 
 
 def chat_test(request):